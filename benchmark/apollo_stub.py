@@ -0,0 +1,237 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A local stand-in for Apollo, the email lookup service and Mailgun, serving
+synthetic annotations. Run from the repository root:
+python -m benchmark.apollo_stub --organisms 5 --genes 1000 --latency 0.01
+"""
+import argparse
+import email
+import gzip
+import json
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from benchmark.synthetic_data import SyntheticGenes
+
+apollo_path = "/apollo/"
+email_path = "/email"
+mailgun_path = "/mailgun/messages"
+
+
+class StubServer(ThreadingHTTPServer):
+    """The stub server, with the synthetic data and the count of each request."""
+
+    daemon_threads = True
+
+    def __init__(
+        self, address, synthetic_genes, latency=0.0, throttle_every=0
+    ) -> None:
+        super().__init__(address, StubHandler)
+        self.synthetic_genes = synthetic_genes
+        self.latency = latency
+        # Answer one Mailgun request in throttle_every with a 429
+        self.throttle_every = throttle_every
+        self.request_counts = Counter()
+        self.sent_emails = list()
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, endpoint) -> int:
+        with self.lock:
+            self.request_counts[endpoint] += 1
+            return self.request_counts[endpoint]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are sent apart, keep-alive connections would wait
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        time.sleep(server.latency)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        path = self.path.split("?")[0]
+        synthetic_genes = server.synthetic_genes
+
+        if path == email_path:
+            server.count("email")
+            user_id = json.loads(body)["query"]["userId"]
+            owner = f"annotator{user_id - 1000}.{user_id}"
+            self._send_json({"email": synthetic_genes.email(owner)})
+        elif path == mailgun_path:
+            mailgun_count = server.count("mailgun")
+            if server.throttle_every and mailgun_count % server.throttle_every == 0:
+                self.send_response(429)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            form = _form_fields(self.headers.get("Content-Type", ""), body)
+            subject = form.get("subject", [None])[0]
+            with server.lock:
+                # A batch send has a "to" field for each recipient
+                for to in form.get("to", list()):
+                    server.sent_emails.append((to, subject))
+            self._send_json({"id": "<stub@example.org>", "message": "Queued."})
+        elif path.endswith("annotationEditor/getRecentAnnotations"):
+            server.count("getRecentAnnotations")
+            self._send_json(synthetic_genes.recent_genes())
+        elif path.endswith("organism/findAllOrganisms"):
+            server.count("findAllOrganisms")
+            self._send_json(
+                [
+                    {"id": index, "commonName": organism}
+                    for index, organism in enumerate(synthetic_genes.organisms)
+                ]
+            )
+        elif path.endswith("annotationEditor/getGff3"):
+            server.count("getGff3")
+            gene_ids = [
+                feature["uniquename"] for feature in json.loads(body)["features"]
+            ]
+            self._send_text(synthetic_genes.genes_gff(gene_ids))
+        elif path.endswith("IOService/write"):
+            server.count("IOService/write")
+            organism = json.loads(body)["organism"]
+            if organism not in synthetic_genes.organisms:
+                self._send_text(f"No organism {organism}", status=400)
+            else:
+                self._send_text(synthetic_genes.organism_gff(organism))
+        elif path.endswith("sequence/sequenceByName"):
+            server.count("sequenceByName")
+            mrna_id = json.loads(body)["featureName"]
+            self._send_text(synthetic_genes.cds_sequence(mrna_id))
+        else:
+            server.count("unknown")
+            self._send_text(f"No endpoint {path}", status=404)
+
+    def _send_json(self, data):
+        self._send_answer(json.dumps(data).encode(), "application/json", 200)
+
+    def _send_text(self, text, status=200):
+        self._send_answer(text.encode(), "text/plain", status)
+
+    def _send_answer(self, answer, content_type, status):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if "gzip" in self.headers.get("Accept-Encoding", "") and len(answer) > 1024:
+            answer = gzip.compress(answer, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, *args):
+        pass
+
+
+def _form_fields(content_type, body):
+    """Return the values of each text field of a form, url encoded or multipart."""
+    if content_type.startswith("multipart/"):
+        message = email.message_from_bytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        fields = dict()
+        for part in message.get_payload():
+            if not part.get_filename():
+                name = part.get_param("name", header="content-disposition")
+                value = part.get_payload(decode=True).decode(errors="replace")
+                fields.setdefault(name, list()).append(value)
+        return fields
+    return urllib.parse.parse_qs(body.decode())
+
+
+def start_stub_server(
+    synthetic_genes, latency=0.0, port=0, throttle_every=0
+) -> StubServer:
+    """Serve the synthetic genes in a background thread, until server.shutdown()."""
+    server = StubServer(("127.0.0.1", port), synthetic_genes, latency, throttle_every)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stub_config(server, out_dir, organism_file):
+    """Return the sections of a report config that point to the stub server."""
+    return {
+        "APOLLO": {
+            "base_url": server.base_url + apollo_path,
+            "username": "stub",
+            "password": "stub",
+        },
+        "MAILGUN": {"url": server.base_url + mailgun_path, "api_key": "stub"},
+        "EMAIL": {
+            "base_url": server.base_url + email_path,
+            "client_id": "stub",
+            "client_secret": "stub",
+            "from_address": "apollo@example.org",
+            "moderator": "moderator@example.org",
+            "summary_subject": "Annotation summary",
+            "error_subject": "Annotation errors",
+        },
+        "SETUP": {
+            "mode": "live",
+            "organism_file": str(organism_file),
+            "dir": str(out_dir),
+            "days": "1",
+        },
+        "PIPELINE": {"summary_annotation": "yes", "recent_annotation": "no"},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve synthetic Apollo, email lookup and Mailgun endpoints"
+    )
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--organisms", type=int, default=2)
+    parser.add_argument("--genes", type=int, default=100, help="Genes per organism")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to each answer"
+    )
+    parser.add_argument(
+        "--throttle_every",
+        type=int,
+        default=0,
+        help="Answer one Mailgun request in this many with a 429",
+    )
+    args = parser.parse_args()
+
+    synthetic_genes = SyntheticGenes(organisms=args.organisms, genes=args.genes)
+    server = StubServer(
+        ("127.0.0.1", args.port),
+        synthetic_genes,
+        args.latency,
+        args.throttle_every,
+    )
+    print(f"Apollo:  {server.base_url}{apollo_path}")
+    print(f"Email:   {server.base_url}{email_path}")
+    print(f"Mailgun: {server.base_url}{mailgun_path}")
+    print("Organisms: " + ", ".join(synthetic_genes.organisms))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(dict(server.request_counts))
+
+
+if __name__ == "__main__":
+    main()
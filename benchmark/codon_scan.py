@@ -0,0 +1,94 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compare the batch codon scan with the former codon by codon loop.
+Run from the repository root: python -m benchmark.codon_scan
+"""
+import argparse
+import random
+import time
+from module import codon_scan
+
+
+def loop_scan(sequence):
+    """The codon checks as done before codon_scan, one codon at a time."""
+    errors = dict()
+    if sequence[0:3] != "ATG":
+        errors["start_codon"] = "no start codon"
+    last_codon = sequence[-3:]
+    if not (last_codon == "TAA" or last_codon == "TAG" or last_codon == "TGA"):
+        errors["stop_codon"] = "no stop codon"
+    internal_stop_codon_count = 0
+    for i in range(0, len(sequence) - 3, 3):
+        codon = sequence[i : i + 3]
+        if codon == "TAA" or codon == "TAG" or codon == "TGA":
+            internal_stop_codon_count += 1
+            errors["no_internal_stop_codon"] = (
+                str(internal_stop_codon_count) + " internal stop codon"
+            )
+    return errors
+
+
+def random_cds(length, generator):
+    middle = "".join(generator.choice("ACGT") for _ in range(length - 6))
+    return "ATG" + middle + "TGA"
+
+
+def best_time(function, repeats):
+    timings = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the codon checks")
+    parser.add_argument("--transcripts", type=int, default=2000)
+    parser.add_argument(
+        "--lengths",
+        type=int,
+        nargs="+",
+        default=[300, 3000, 30000],
+        help="CDS lengths to test",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    generator = random.Random(args.seed)
+    print("length\ttranscripts\tloop (s)\tbatch (s)\tspeedup")
+    for length in args.lengths:
+        count = max(args.transcripts * 300 // length, 10)
+        sequences = [random_cds(length, generator) for _ in range(count)]
+
+        loop_errors = [loop_scan(sequence) for sequence in sequences]
+        batch_errors = codon_scan.scan_coding_sequences(sequences)
+        if loop_errors != batch_errors:
+            raise ValueError(f"The batch scan differs from the loop at length {length}")
+
+        loop_time = best_time(
+            lambda: [loop_scan(sequence) for sequence in sequences], args.repeats
+        )
+        batch_time = best_time(
+            lambda: codon_scan.scan_coding_sequences(sequences), args.repeats
+        )
+        print(
+            f"{length}\t{count}\t{loop_time:.4f}\t{batch_time:.4f}"
+            f"\t{loop_time / batch_time:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Run ApolloReporter end to end against the local stub server, and report
+the time of each stage, the requests made and the peak memory.
+Run from the repository root:
+python -m benchmark.end_to_end --organisms 5 --genes 2000 --latency 0.005
+"""
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import tempfile
+import time
+from pathlib import Path
+from benchmark.apollo_stub import start_stub_server, stub_config
+from benchmark.synthetic_data import SyntheticGenes
+from module.apollo_reporter import ApolloReporter
+from module.run_report import stage_names
+from run_apollo_report import run_pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the report pipeline against the local stub server"
+    )
+    parser.add_argument("--mode", choices=("summary", "recent"), default="summary")
+    parser.add_argument("--organisms", type=int, default=2)
+    parser.add_argument("--genes", type=int, default=500, help="Genes per organism")
+    parser.add_argument("--owners", type=int, default=20)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to each answer"
+    )
+    parser.add_argument(
+        "--throttle_every",
+        type=int,
+        default=0,
+        help="Answer one Mailgun request in this many with a 429",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=list(),
+        metavar="SECTION.KEY=VALUE",
+        help="Config value to set, e.g. APOLLO.sequence_workers=8",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="*",
+        choices=stage_names,
+        metavar="STAGE",
+        help="Profile the given stages, or all of them, to --profile_dir",
+    )
+    parser.add_argument(
+        "--profile_dir", default="profile", help="Dir to write the profiles to"
+    )
+    parser.add_argument("--json", help="File to write the results to")
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the output of the pipeline"
+    )
+    args = parser.parse_args()
+
+    synthetic_genes = SyntheticGenes(
+        organisms=args.organisms, genes=args.genes, owners=args.owners
+    )
+    server = start_stub_server(
+        synthetic_genes, latency=args.latency, throttle_every=args.throttle_every
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        organism_file = Path(temp_dir) / "organisms.txt"
+        organism_file.write_text("\n".join(synthetic_genes.organisms) + "\n")
+        config = configparser.ConfigParser()
+        config.read_dict(
+            stub_config(server, Path(temp_dir) / "out", organism_file)
+        )
+        config["PIPELINE"]["summary_annotation"] = (
+            "yes" if args.mode == "summary" else "no"
+        )
+        config["PIPELINE"]["recent_annotation"] = (
+            "yes" if args.mode == "recent" else "no"
+        )
+        for setting in args.set:
+            name, value = setting.split("=", 1)
+            section, key = name.split(".", 1)
+            config[section][key] = value
+
+        reporter = ApolloReporter(config)
+        if args.profile is not None:
+            reporter.enable_profiling(args.profile, args.profile_dir)
+        pipeline_args = argparse.Namespace(
+            nosend=False, full_summary=False, resume=False
+        )
+        output = contextlib.redirect_stdout(io.StringIO())
+        if args.verbose:
+            output = contextlib.nullcontext()
+        status = "failed"
+        start = time.perf_counter()
+        try:
+            with output:
+                run_pipeline(reporter, config, pipeline_args)
+            status = "finished"
+        finally:
+            total_seconds = time.perf_counter() - start
+            try:
+                reporter.write_run_report(status)
+            finally:
+                # The spooled emails are written to the temporary dir
+                reporter.close()
+    server.shutdown()
+    server.server_close()
+
+    run_report = reporter.run_report.to_dict()
+    results = {
+        "mode": args.mode,
+        "organisms": args.organisms,
+        "genes_per_organism": args.genes,
+        "latency": args.latency,
+        "throttle_every": args.throttle_every,
+        "settings": args.set,
+        "total_seconds": total_seconds,
+        "peak_memory_mb": run_report["peak_rss_bytes"] / 2**20,
+        "run_report": run_report,
+        "requests": dict(sorted(server.request_counts.items())),
+        "emails_sent": len(server.sent_emails),
+    }
+    print(f"total {total_seconds:.2f} seconds, peak {results['peak_memory_mb']:.1f} MB")
+    for endpoint, count in results["requests"].items():
+        print(f"{endpoint:<24}{count:>8} requests")
+    print(f"{results['emails_sent']} emails sent")
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Time the hot paths of the validation on synthetic files of growing size,
+and compare the results with those of a previous run.
+Run from the repository root:
+python -m benchmark.hot_paths --genes 1000 10000 --json results.json
+python -m benchmark.hot_paths --genes 1000 10000 --compare results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from benchmark.synthetic_data import SyntheticGenes
+from module import annotation_quality_report as report, codon_scan, gff_file
+from module.transcript import GenomeSequences
+
+organism = "synthetic_0"
+
+
+class HotPathCase:
+    """The data of the benchmarks of one size, so that each only times its step."""
+
+    def __init__(self, genes, data_dir: Path) -> None:
+        self.synthetic_genes = SyntheticGenes(organisms=1, genes=genes)
+        self.gff_path = data_dir / f"{genes}.gff"
+        self.genome_path = data_dir / f"{genes}.fa"
+        self.synthetic_genes.write_gff(organism, self.gff_path)
+        self.synthetic_genes.write_genome(organism, self.genome_path)
+        with open(self.gff_path) as gff_file_handle:
+            self.feature_fields = [
+                line.rstrip().split("\t") for line in gff_file_handle if line[0] != "#"
+            ]
+        self.cds_sequences = [
+            self.synthetic_genes.cds_sequence(self.synthetic_genes.mrna_id(0, index))
+            for index in range(genes)
+        ]
+        self.email_dir = data_dir / f"{genes}_emails"
+        self.email_dir.mkdir()
+
+    def new_gff(self):
+        return gff_file.HandleGFF([(organism, str(self.gff_path))], {}, "moderator")
+
+    def read_gff(self):
+        gff_file_object = self.new_gff()
+        gff_file_object.read_gff_file()
+        return gff_file_object
+
+    def validated_gff(self):
+        gff_file_object = self.read_gff()
+        gff_file_object.scan_gff_for_errors()
+        gff_file_object.scan_mrna_sequence(genome=self.genome())
+        return gff_file_object
+
+    def genome(self):
+        return GenomeSequences(genome_files={organism: str(self.genome_path)})
+
+    def benchmarks(self):
+        """Return (name, item count, setup, step) of each benchmark.
+
+        setup is run before each timing, and its result given to step.
+        """
+        return [
+            (
+                "extract_fields_from_gff",
+                len(self.feature_fields),
+                lambda: self.feature_fields,
+                lambda feature_fields: list(
+                    map(gff_file.extract_fields_from_gff, feature_fields)
+                ),
+            ),
+            (
+                "read_gff_file",
+                len(self.feature_fields),
+                self.new_gff,
+                lambda gff_file_object: gff_file_object.read_gff_file(),
+            ),
+            (
+                "scan_gff_for_errors",
+                len(self.feature_fields),
+                self.read_gff,
+                lambda gff_file_object: gff_file_object.scan_gff_for_errors(),
+            ),
+            (
+                "scan_coding_sequences",
+                len(self.cds_sequences),
+                lambda: self.cds_sequences,
+                codon_scan.scan_coding_sequences,
+            ),
+            (
+                "scan_mrna_sequence_genome",
+                self.synthetic_genes.genes,
+                lambda: (self.read_gff(), self.genome()),
+                lambda data: data[0].scan_mrna_sequence(genome=data[1]),
+            ),
+            (
+                "error_emails",
+                self.synthetic_genes.genes,
+                lambda: self.validated_gff().errors,
+                report.error_emails,
+            ),
+            (
+                "write_email_texts",
+                self.synthetic_genes.genes,
+                lambda: self.validated_gff().errors,
+                lambda errors: report.write_email_texts(errors, self.email_dir),
+            ),
+        ]
+
+
+def run_benchmark(setup, step, repeats):
+    """Return the best time of step over repeats, and the memory peak of a run."""
+    timings = list()
+    for _ in range(repeats):
+        data = setup()
+        start = time.perf_counter()
+        step(data)
+        timings.append(time.perf_counter() - start)
+
+    # Another run for the memory, tracemalloc slows the code down
+    data = setup()
+    tracemalloc.start()
+    step(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare_results(results, baseline, threshold):
+    """Print the time ratio with the baseline, return the regressed benchmarks."""
+    baseline_times = {
+        (result["benchmark"], result["genes"]): result["seconds"]
+        for result in baseline["results"]
+    }
+    print(f"\nCompared with {baseline['commit']} ({baseline['date']}):")
+    regressions = list()
+    for result in results:
+        key = (result["benchmark"], result["genes"])
+        if key not in baseline_times:
+            continue
+        ratio = result["seconds"] / baseline_times[key]
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"{key[0]:<28}{key[1]:>9}{ratio:>9.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the validation hot paths on synthetic data"
+    )
+    parser.add_argument(
+        "--genes", type=int, nargs="+", default=[1000, 10000], help="Sizes to test"
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--only", nargs="+", help="Names of the benchmarks to run, all by default"
+    )
+    parser.add_argument("--json", help="File to write the results to")
+    parser.add_argument("--compare", help="Results of a previous run to compare to")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="Time ratio from which a benchmark is a regression",
+    )
+    args = parser.parse_args()
+
+    results = list()
+    print(f"{'benchmark':<28}{'genes':>9}{'items':>9}{'seconds':>10}{'peak MB':>9}")
+    with tempfile.TemporaryDirectory() as data_dir:
+        for genes in args.genes:
+            case = HotPathCase(genes, Path(data_dir))
+            for name, items, setup, step in case.benchmarks():
+                if args.only and name not in args.only:
+                    continue
+                # The validation prints each error, they are not part of the timing
+                with contextlib.redirect_stdout(io.StringIO()):
+                    seconds, peak = run_benchmark(setup, step, args.repeats)
+                results.append(
+                    {
+                        "benchmark": name,
+                        "genes": genes,
+                        "items": items,
+                        "seconds": seconds,
+                        "items_per_second": items / seconds if seconds else None,
+                        "peak_memory_mb": peak / 1e6,
+                    }
+                )
+                print(
+                    f"{name:<28}{genes:>9}{items:>9}{seconds:>10.4f}{peak / 1e6:>9.1f}"
+                )
+
+    run = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "repeats": args.repeats,
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(run, json_file, indent=1)
+    if args.compare:
+        with open(args.compare) as json_file:
+            baseline = json.load(json_file)
+        if compare_results(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Synthetic Apollo annotations for the benchmarks, the same for a given size.
+Write them as files from the repository root:
+python -m benchmark.synthetic_data /tmp/synthetic --genes 10000
+"""
+import argparse
+import random
+from pathlib import Path
+
+sense_codons = [
+    first + second + third
+    for first in "ACGT"
+    for second in "ACGT"
+    for third in "ACGT"
+    if first + second + third not in ("TAA", "TAG", "TGA")
+]
+
+
+class SyntheticGenes:
+    """Gene models of a set of organisms, made up from their position.
+
+    Each gene has its own part of a single scaffold, chr1. Most genes are
+    coding, with an mRNA of exon_count exons that are all coding, one gene
+    in pseudogene_every is a pseudogene and one in ncrna_every has an ncRNA.
+    One gene in error_every has an internal stop codon in its CDS and one in
+    gff_error_every has an exon that goes past its mRNA. One gene in
+    recent_every was annotated recently. The owners are "annotatorN.N" so
+    that the email lookup finds a user id.
+    """
+
+    intron_length = 100
+
+    def __init__(
+        self,
+        organisms=2,
+        genes=100,
+        owners=10,
+        exon_count=3,
+        exon_length=300,
+        recent_every=7,
+        error_every=23,
+        gff_error_every=29,
+        pseudogene_every=31,
+        ncrna_every=37,
+        seed=1,
+    ) -> None:
+        self.organisms = [f"synthetic_{index}" for index in range(organisms)]
+        self.genes = genes
+        self.owners = owners
+        self.exon_count = exon_count
+        self.exon_length = exon_length - exon_length % 3
+        self.recent_every = recent_every
+        self.error_every = error_every
+        self.gff_error_every = gff_error_every
+        self.pseudogene_every = pseudogene_every
+        self.ncrna_every = ncrna_every
+        self.seed = seed
+
+    @property
+    def gene_length(self) -> int:
+        """Length of the part of the scaffold of each gene, its last intron included."""
+        return self.exon_count * (self.exon_length + self.intron_length)
+
+    def gene_id(self, organism_index, gene_index) -> str:
+        return f"gene-{organism_index}-{gene_index}"
+
+    def mrna_id(self, organism_index, gene_index) -> str:
+        return f"mrna-{organism_index}-{gene_index}"
+
+    def parse_id(self, feature_id):
+        """Return the (organism index, gene index) of a gene or mRNA id."""
+        _, organism_index, gene_index = feature_id.split("-")
+        return int(organism_index), int(gene_index)
+
+    def gene_kind(self, gene_index) -> str:
+        if gene_index % self.pseudogene_every == 1:
+            return "pseudogene"
+        if gene_index % self.ncrna_every == 2:
+            return "ncrna"
+        return "gene"
+
+    def owner(self, gene_index) -> str:
+        owner_index = gene_index % self.owners
+        return f"annotator{owner_index}.{owner_index + 1000}"
+
+    def email(self, user_id) -> str:
+        return user_id.rsplit(".", 1)[0] + "@example.org"
+
+    def gene_gff(self, organism_index, gene_index) -> str:
+        gene_id = self.gene_id(organism_index, gene_index)
+        mrna_id = self.mrna_id(organism_index, gene_index)
+        owner = self.owner(gene_index)
+        name = f"SYN{organism_index}_{gene_index:06d}"
+        status = "Finished annotating" if gene_index % 3 else "Unfinished"
+        kind = self.gene_kind(gene_index)
+        begin = gene_index * self.gene_length + 1
+        end = begin + self.gene_length - self.intron_length - 1
+        gene_attribs = (
+            f"owner={owner};ID={gene_id};date_last_modified=2020-01-01;"
+            f"Name={name};status={status}"
+        )
+        if kind == "pseudogene":
+            return f"chr1\t.\tpseudogene\t{begin}\t{end}\t.\t+\t.\t{gene_attribs}\n"
+
+        lines = [f"chr1\t.\tgene\t{begin}\t{end}\t.\t+\t.\t{gene_attribs}"]
+        if kind == "ncrna":
+            rna_id = f"ncrna-{organism_index}-{gene_index}"
+            lines.append(
+                f"chr1\t.\tncRNA\t{begin}\t{end}\t.\t+\t.\towner={owner};"
+                f"Parent={gene_id};ID={rna_id};Name={name}-RA"
+            )
+            lines.append(
+                f"chr1\t.\texon\t{begin}\t{end}\t.\t+\t.\t"
+                f"Parent={rna_id};ID={rna_id}-exon0"
+            )
+            return "\n".join(lines) + "\n"
+
+        lines.append(
+            f"chr1\t.\tmRNA\t{begin}\t{end}\t.\t+\t.\towner={owner};"
+            f"Parent={gene_id};ID={mrna_id};Name={name}-RA;status={status}"
+        )
+        for exon_index in range(self.exon_count):
+            exon_begin = begin + exon_index * (self.exon_length + self.intron_length)
+            exon_end = exon_begin + self.exon_length - 1
+            cds_end = exon_end
+            if (
+                exon_index == self.exon_count - 1
+                and gene_index % self.gff_error_every == 5
+            ):
+                exon_end += 10
+            lines.append(
+                f"chr1\t.\texon\t{exon_begin}\t{exon_end}\t.\t+\t.\t"
+                f"Parent={mrna_id};ID={mrna_id}-exon{exon_index}"
+            )
+            lines.append(
+                f"chr1\t.\tCDS\t{exon_begin}\t{cds_end}\t.\t+\t0\t"
+                f"Parent={mrna_id};ID={mrna_id}-cds"
+            )
+        return "\n".join(lines) + "\n"
+
+    def organism_gff(self, organism) -> str:
+        return "".join(self.iter_organism_gff(organism))
+
+    def iter_organism_gff(self, organism):
+        organism_index = self.organisms.index(organism)
+        yield "##gff-version 3\n"
+        for gene_index in range(self.genes):
+            yield self.gene_gff(organism_index, gene_index)
+
+    def genes_gff(self, gene_ids) -> str:
+        return "##gff-version 3\n" + "".join(
+            self.gene_gff(*self.parse_id(gene_id)) for gene_id in gene_ids
+        )
+
+    def recent_genes(self):
+        """Return the {gene id: organism} of the recently annotated genes."""
+        return {
+            self.gene_id(organism_index, gene_index): organism
+            for organism_index, organism in enumerate(self.organisms)
+            for gene_index in range(0, self.genes, self.recent_every)
+        }
+
+    def cds_sequence(self, mrna_id) -> str:
+        organism_index, gene_index = self.parse_id(mrna_id)
+        generator = random.Random(f"{self.seed}-{organism_index}-{gene_index}")
+        codon_count = self.exon_count * self.exon_length // 3
+        codons = ["ATG"]
+        codons += generator.choices(sense_codons, k=codon_count - 2)
+        if gene_index % self.error_every == 0:
+            codons[codon_count // 2] = "TGA"
+        codons.append("TAA")
+        return "".join(codons)
+
+    def iter_genome(self, organism):
+        """Yield the chr1 sequence of organism, one gene part at a time.
+
+        The exons of each gene hold its CDS, so that the CDS assembled from
+        the genome is cds_sequence.
+        """
+        organism_index = self.organisms.index(organism)
+        for gene_index in range(self.genes):
+            generator = random.Random(f"{self.seed}-{organism_index}-{gene_index}-dna")
+            if self.gene_kind(gene_index) == "gene":
+                cds = self.cds_sequence(self.mrna_id(organism_index, gene_index))
+            else:
+                cds = "".join(
+                    generator.choices("ACGT", k=self.exon_count * self.exon_length)
+                )
+            for exon_index in range(self.exon_count):
+                exon_begin = exon_index * self.exon_length
+                yield cds[exon_begin : exon_begin + self.exon_length]
+                yield "".join(generator.choices("ACGT", k=self.intron_length))
+
+    def write_gff(self, organism, gff_path) -> None:
+        with open(gff_path, "w") as gff_file:
+            gff_file.writelines(self.iter_organism_gff(organism))
+
+    def write_genome(self, organism, fasta_path, line_length=60) -> None:
+        with open(fasta_path, "w") as fasta_file:
+            fasta_file.write(">chr1\n")
+            buffer = ""
+            for sequence in self.iter_genome(organism):
+                buffer += sequence
+                line_count = len(buffer) // line_length
+                for line_index in range(line_count):
+                    line_begin = line_index * line_length
+                    fasta_file.write(buffer[line_begin : line_begin + line_length])
+                    fasta_file.write("\n")
+                buffer = buffer[line_count * line_length :]
+            if buffer:
+                fasta_file.write(buffer + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write synthetic Apollo gff3 and genome fasta files"
+    )
+    parser.add_argument("out_dir", help="Dir to write <organism>.gff and .fa to")
+    parser.add_argument("--organisms", type=int, default=1)
+    parser.add_argument("--genes", type=int, default=1000, help="Genes per organism")
+    parser.add_argument("--owners", type=int, default=10)
+    parser.add_argument("--exons", type=int, default=3, help="Exons per mRNA")
+    parser.add_argument("--exon_length", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    synthetic_genes = SyntheticGenes(
+        organisms=args.organisms,
+        genes=args.genes,
+        owners=args.owners,
+        exon_count=args.exons,
+        exon_length=args.exon_length,
+        seed=args.seed,
+    )
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for organism in synthetic_genes.organisms:
+        synthetic_genes.write_gff(organism, out_dir / f"{organism}.gff")
+        synthetic_genes.write_genome(organism, out_dir / f"{organism}.fa")
+        print(f"{organism}: {out_dir / organism}.gff and .fa")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,11 +14,8 @@ limitations under the License.
 import argparse
 import configparser
 import json
-import sys
 from module import annotation_quality_report as report
 
-sys.setrecursionlimit(2500)
-
 
 def main():
     parser = argparse.ArgumentParser(
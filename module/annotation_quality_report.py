@@ -11,17 +11,29 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 import requests
 from requests.exceptions import ConnectionError
 import datetime
+import json
+import os
+import shutil
+import time
 import urllib.parse
 import re
-from module import gff_file
+from module import gff_file, web_session
 from module.annotator import AnnotatorSummary
+from module.run_report import stage as run_report_stage
 from module.validation_error import ValidationError
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+download_headers = {"Accept-Encoding": "gzip"}
+BATCH_RETRY_DELAY = 1.0
+# Maximum number of recipients of a Mailgun batch send
+MAILGUN_BATCH_LIMIT = 1000
+
 
 def get_recent_genes_from_apollo(base_url, username, password, days=1):
     webservice_data = {"username": username, "password": password, "days": days}
@@ -59,12 +71,19 @@ def get_organisms(base_url, username, password):
             raise Exception(f"Response error: {response.status_code}")
 
 
-def get_email(base_url, client_id, client_secret, user_id):
+def get_user_number(user_id):
+    """Return the numeric id at the end of an owner like "name.1234", or None."""
     user_obj = re.match(r".*\.(\d+?)$", user_id, flags=0)
-
     if user_obj:
-        upenn_id = int(user_obj.group(1))
-    else:
+        return int(user_obj.group(1))
+    return None
+
+
+def get_email(
+    base_url, client_id, client_secret, user_id, session=None, timeout=None
+):
+    upenn_id = get_user_number(user_id)
+    if upenn_id is None:
         return False
 
     body = {
@@ -72,35 +91,140 @@ def get_email(base_url, client_id, client_secret, user_id):
         "client_secret": client_secret,
         "query": {"userId": upenn_id},
     }
-    response = requests.post(base_url, json=body)
+    response = (session or requests).post(base_url, json=body, timeout=timeout)
     if response.status_code == requests.codes.ok:
         return response.json()["email"]
     else:
         return False
 
 
-def get_gff(base_url, username, password, genes, out_dir):
-    features = list()
-
-    print(f"Get gff for {len(genes)} genes")
-    for key in genes:
-        features.append({"uniquename": key})
+def get_gff(
+    base_url,
+    username,
+    password,
+    genes,
+    out_dir,
+    stats=None,
+    batch_size=None,
+    workers=1,
+    timeout=None,
+    retries=3,
+):
+    """Download the gff of the genes to out_dir.
 
-    webservice_data = {"username": username, "password": password, "features": features}
+    The genes are requested batch_size at a time (all at once by default),
+    with up to workers requests running at the same time. A batch that
+    fails is retried, and the batches are joined in order once they are all
+    downloaded. Returns the path of the gff, or False if a batch failed.
+    """
+    gene_ids = list(genes)
+    print(f"Get gff for {len(gene_ids)} genes")
+    batch_size = batch_size or max(len(gene_ids), 1)
+    batches = [
+        gene_ids[start : start + batch_size]
+        for start in range(0, len(gene_ids), batch_size)
+    ]
     url = urllib.parse.urljoin(base_url, "annotationEditor/getGff3")
-
-    response = requests.post(url, json=webservice_data)
     time_stamp = str(datetime.datetime.now().date())
     file_name = out_dir + "apollo_" + time_stamp + ".gff"
-    if response.status_code == requests.codes.ok:
-        file_handle = open(file_name, "w")
-        file_handle.write(response.text)
-        return file_name
-    else:
-        return False
+    batch_file_names = [
+        f"{file_name}.batch{index}" for index in range(len(batches))
+    ]
+
+    start_time = time.perf_counter()
+    batch_stats = [dict() for _ in batches]
+    # The batches are retried by _get_gene_batch_gff, not by the session
+    session = web_session.create_session(pool_size=workers, retries=0)
+    try:
+        with session, ThreadPoolExecutor(max_workers=workers) as executor:
+            downloads = [
+                executor.submit(
+                    _get_gene_batch_gff,
+                    session,
+                    url,
+                    {
+                        "username": username,
+                        "password": password,
+                        "features": [{"uniquename": key} for key in batch],
+                    },
+                    batch_file_name,
+                    batch_stat,
+                    timeout,
+                    retries,
+                )
+                for batch, batch_file_name, batch_stat in zip(
+                    batches, batch_file_names, batch_stats
+                )
+            ]
+            if not all([download.result() for download in downloads]):
+                return False
+        _join_gff_files(batch_file_names, file_name)
+    finally:
+        for batch_file_name in batch_file_names:
+            if os.path.exists(batch_file_name):
+                os.remove(batch_file_name)
+
+    if stats is not None:
+        seconds = time.perf_counter() - start_time
+        transferred_bytes = sum(stat["transferred_bytes"] for stat in batch_stats)
+        stats["transferred_bytes"] = transferred_bytes
+        stats["written_bytes"] = sum(stat["written_bytes"] for stat in batch_stats)
+        stats["seconds"] = seconds
+        stats["throughput"] = transferred_bytes / seconds if seconds else 0.0
+        stats["batches"] = len(batches)
+    return file_name
+
+
+def _get_gene_batch_gff(
+    session, url, webservice_data, file_name, stats, timeout, retries
+) -> bool:
+    genes_count = len(webservice_data["features"])
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(BATCH_RETRY_DELAY * 2 ** (attempt - 1))
+        deadline = time.perf_counter() + timeout if timeout else None
+        try:
+            with session.post(
+                url,
+                json=webservice_data,
+                headers=download_headers,
+                stream=True,
+                timeout=timeout,
+            ) as response:
+                if response.status_code == requests.codes.ok:
+                    stream_to_file(response, file_name, stats, deadline)
+                    return True
+                error = f"code {response.status_code}"
+        except requests.RequestException as exception:
+            error = str(exception)
+        print(
+            f"Gff of {genes_count} genes not retrieved,"
+            f" attempt {attempt + 1}: {error}"
+        )
+    return False
+
 
+def _join_gff_files(gff_file_names, file_name) -> None:
+    """Concatenate gff files, only keeping the ##gff-version line of the first one."""
+    with open(file_name, "wb") as file_handle:
+        for index, gff_file_name in enumerate(gff_file_names):
+            with open(gff_file_name, "rb") as gff_file_handle:
+                first_line = gff_file_handle.readline()
+                if index == 0 or not first_line.startswith(b"##gff-version"):
+                    file_handle.write(first_line)
+                shutil.copyfileobj(gff_file_handle, file_handle)
 
-def download_gff(base_url, username, password, organism, out_dir):
+
+def download_gff(
+    base_url, username, password, organism, out_dir, timeout=None, stats=None
+):
+    """Download the gff export of an organism to out_dir.
+
+    Returns the path of the gff, or False if the export failed. The
+    timeout is the most Apollo can wait between two reads, and the most the
+    whole download can take. The transfer figures are added to the stats
+    dict if one is given.
+    """
     webservice_data = {
         "username": username,
         "password": password,
@@ -113,18 +237,57 @@ def download_gff(base_url, username, password, organism, out_dir):
     }
 
     url = urllib.parse.urljoin(base_url, "/IOService/write")
-    response = requests.post(url, json=webservice_data)
-
     time_stamp = str(datetime.datetime.now().date())
     file_name = out_dir + "apollo_" + time_stamp + ".gff"
 
-    if response.status_code == requests.codes.ok:
-        file_handle = open(file_name, "w")
-        file_handle.write(response.text)
-        return file_name
-    else:
-        print(organism + ": " + str(response.text) + "\n")
-        return False
+    deadline = time.perf_counter() + timeout if timeout else None
+    with requests.post(
+        url,
+        json=webservice_data,
+        headers=download_headers,
+        stream=True,
+        timeout=timeout,
+    ) as response:
+        if response.status_code == requests.codes.ok:
+            stream_to_file(response, file_name, stats, deadline)
+            return file_name
+        else:
+            print(organism + ": " + str(response.text) + "\n")
+            return False
+
+
+def stream_to_file(response, file_name, stats=None, deadline=None) -> None:
+    """Write a streamed response body to file_name, chunk by chunk.
+
+    The body is written to a .part file first, so an interrupted download
+    doesn't leave a truncated gff behind. Once the time.perf_counter()
+    deadline is passed, the download stops with a requests.Timeout.
+    """
+    start_time = time.perf_counter()
+    written_bytes = 0
+    part_file_name = file_name + ".part"
+    try:
+        with open(part_file_name, "wb") as file_handle:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if deadline is not None and time.perf_counter() > deadline:
+                    raise requests.Timeout(
+                        f"Download of {file_name} stopped after its deadline"
+                    )
+                file_handle.write(chunk)
+                written_bytes += len(chunk)
+        os.replace(part_file_name, file_name)
+    finally:
+        if os.path.exists(part_file_name):
+            os.remove(part_file_name)
+
+    if stats is not None:
+        seconds = time.perf_counter() - start_time
+        # Bytes read from the connection, before the gzip decoding
+        transferred_bytes = response.raw.tell() or written_bytes
+        stats["transferred_bytes"] = transferred_bytes
+        stats["written_bytes"] = written_bytes
+        stats["seconds"] = seconds
+        stats["throughput"] = transferred_bytes / seconds if seconds else 0.0
 
 
 def validate_gff(base_url, username, password, gff_file_path, gene_organism, moderator):
@@ -134,10 +297,40 @@ def validate_gff(base_url, username, password, gff_file_path, gene_organism, mod
     """
     gff_file_object = gff_file.HandleGFF(gff_file_path, gene_organism, moderator)
     gff_file_object.read_gff_file()
-    gff_file_object.scan_gff_for_errors()
-    gff_file_object.scan_mrna_sequence(
-        base_url=base_url, username=username, password=password
-    )
+    return validate_parsed_gff(base_url, username, password, gff_file_object)
+
+
+def validate_parsed_gff(
+    base_url,
+    username,
+    password,
+    gff_file_object,
+    genome=None,
+    sequence_fetcher=None,
+    sequence_cache=None,
+    run_report=None,
+):
+    """Validate a gff that has already been read with HandleGFF.read_gff_file
+
+    The same parsed object can be shared with the summary stage, so the file
+    is only read once. The coding sequences are assembled from the genome
+    if one is given, instead of being retrieved from Apollo. The two scans
+    are measured as stages of the run_report if one is given.
+    Returns None if there are no errors.
+    """
+    with run_report_stage(run_report, "structural_scan") as counts:
+        gff_file_object.scan_gff_for_errors()
+        counts["features"] = len(gff_file_object.store)
+    with run_report_stage(run_report, "sequence_scan") as counts:
+        gff_file_object.scan_mrna_sequence(
+            base_url=base_url,
+            username=username,
+            password=password,
+            genome=genome,
+            sequence_fetcher=sequence_fetcher,
+            sequence_cache=sequence_cache,
+        )
+        counts["transcripts"] = len(gff_file_object.transcripts)
 
     if gff_file_object.errors != {}:
         return gff_file_object
@@ -158,18 +351,78 @@ def _group_errors(errors: List[ValidationError], attrib_name: str) -> Dict[str,
     return groups
 
 
-def write_email_texts(errors_dict: Dict[str, List[ValidationError]], out_dir: Path) -> None:
+class EmailMessage:
+    """An email to an annotator, rendered in memory.
+
+    body is the list of the lines of the text, with their line ends, and
+    footer the lines added after it. gene_list is the text of the list of
+    unfinished genes of a summary, attached if not empty. spool_name is the
+    name of the file of the email in the spool dir.
+    """
+
+    def __init__(self, user_id, body, spool_name, gene_list=None, footer=None):
+        self.user_id = user_id
+        self.body = body
+        self.spool_name = spool_name
+        self.gene_list = gene_list
+        self.footer = footer or list()
+
+    @property
+    def lines(self) -> List[str]:
+        return self.body + self.footer
+
+
+def error_emails(errors_dict: Dict[str, List[ValidationError]]) -> List[EmailMessage]:
+    """Return the error email of each owner of the errors."""
     # First group by owner
     errors = list(errors_dict.values())
     ownership = _group_errors(errors, "owner")
 
-    # Then write one file for each owner
+    # Then an email for each owner
+    messages = list()
+    time_stamp = str(datetime.datetime.now().date())
     for owner, owner_errors in ownership.items():
         owner_text = _get_owner_error_text(owner, owner_errors)
-        time_stamp = str(datetime.datetime.now().date())
-        owner_file = out_dir / f"{owner}_{time_stamp}.error"
-        with owner_file.open('w') as owner_fh:
-            owner_fh.write(owner_text + "\n")
+        # The first line of the text is the owner
+        body = (owner_text + "\n").splitlines(keepends=True)[1:]
+        messages.append(EmailMessage(owner, body, f"{owner}_{time_stamp}.error"))
+    return messages
+
+
+def write_email_texts(errors_dict: Dict[str, List[ValidationError]], out_dir: Path) -> None:
+    write_email_spool(error_emails(errors_dict), out_dir)
+
+
+def write_email_spool(messages: List[EmailMessage], out_dir: Path) -> None:
+    """Write each email to its file in out_dir, the user id on the first line.
+
+    The gene list of a summary is written next to it, as <user id>.gene_list.
+    """
+    for message in messages:
+        with (out_dir / message.spool_name).open("w") as file_handle:
+            file_handle.write(message.user_id + "\n")
+            file_handle.writelines(message.body)
+        if message.gene_list is not None:
+            gene_list_name = out_dir / f"{message.user_id}.gene_list"
+            gene_list_name.write_text(message.gene_list)
+
+
+def read_email_spool(out_dir: Path, file_extension) -> List[EmailMessage]:
+    """Return the emails written to out_dir with file_extension."""
+    messages = list()
+    _, _, file_list = next(os.walk(str(out_dir)), (None, None, []))
+    for file_name in file_list:
+        if os.path.splitext(file_name)[1] != "." + file_extension:
+            continue
+        with (out_dir / file_name).open("r") as file_handle:
+            user_id = file_handle.readline().rstrip()
+            body = file_handle.readlines()
+        gene_list = None
+        gene_list_name = out_dir / f"{user_id}.gene_list"
+        if file_extension == "summary" and gene_list_name.exists():
+            gene_list = gene_list_name.read_text()
+        messages.append(EmailMessage(user_id, body, file_name, gene_list))
+    return messages
 
 
 def _get_owner_error_text(owner: str, errors: List[ValidationError]) -> str:
@@ -263,45 +516,49 @@ def write_summary_text(summary: AnnotatorSummary, out_dir: Path) -> None:
 
     The files are not created if there are no annotations for that user.
     """
+    message = summary_email(summary)
+    if message is not None:
+        write_email_spool([message], out_dir)
+
+
+def summary_email(summary: AnnotatorSummary) -> Optional[EmailMessage]:
+    """Return the summary email of an annotator, with its list of unfinished genes.
+
+    There is no email if there are no annotations for that user.
+    """
     owner = summary.email
 
     # Do not create (and so do not send) an email if there is nothing for this annotator
     if not summary.has_changes():
         print(f"No changes for {owner}")
-        return
-
-    # Create the email summary file
-    file_name = out_dir / f"{owner}.summary"
-    with file_name.open("w") as file_handle:
-        file_handle.write(owner + "\n")
-        stats = {
-            "Finished protein-coding genes": summary.finished_mrna_count,
-            "Unfinished protein-coding genes": summary.total_mrna_count
-            - summary.finished_mrna_count,
-            "Finished ncRNAs genes": summary.finished_ncrna_count,
-            "Unfinished ncRNAs genes": summary.total_ncrna_count
-            - summary.finished_ncrna_count,
-            "Finished pseudogenes": summary.finished_pseudogene_count,
-            "Unfinished pseudogenes": summary.total_pseudogene_count
-            - summary.finished_pseudogene_count,
-            "Non Canonical splice site": summary.non_canonical_count,
-        }
-        file_handle.write("Dear Annotator (" + owner + ")," + "\n")
-        file_handle.write(
-            "Here is a summary of your annotation in Apollo hosted at VEuPathDB.org."
-            + "\n"
-        )
-        for item, count in stats.items():
-            if count > 0:
-                file_handle.write(f"{item}: {count}\n")
+        return None
+
+    stats = {
+        "Finished protein-coding genes": summary.finished_mrna_count,
+        "Unfinished protein-coding genes": summary.total_mrna_count
+        - summary.finished_mrna_count,
+        "Finished ncRNAs genes": summary.finished_ncrna_count,
+        "Unfinished ncRNAs genes": summary.total_ncrna_count
+        - summary.finished_ncrna_count,
+        "Finished pseudogenes": summary.finished_pseudogene_count,
+        "Unfinished pseudogenes": summary.total_pseudogene_count
+        - summary.finished_pseudogene_count,
+        "Non Canonical splice site": summary.non_canonical_count,
+    }
+    body = [
+        "Dear Annotator (" + owner + ")," + "\n",
+        "Here is a summary of your annotation in Apollo hosted at VEuPathDB.org."
+        + "\n",
+    ]
+    for item, count in stats.items():
+        if count > 0:
+            body.append(f"{item}: {count}\n")
 
-    # Create the gene_list file
-    gene_list_name = out_dir / f"{owner}.gene_list"
-    gene_list_name.touch()
+    # The gene list, empty if all the genes are finished
+    gene_list = ""
     if summary.has_unfinished():
-        gene_list = summary.get_unfinished()
-        with open(gene_list_name, "w") as gene_list_handle:
-            gene_list_handle.write("\n".join(gene_list) + "\n")
+        gene_list = "\n".join(summary.get_unfinished()) + "\n"
+    return EmailMessage(owner, body, f"{owner}.summary", gene_list)
 
 
 def send_email_mailgun(
@@ -313,7 +570,11 @@ def send_email_mailgun(
     subject,
     message,
     file_attached=None,
+    session=None,
+    timeout=None,
+    attachment=None,
 ):
+    """Send an email, with the file_attached, or the attachment text, if not empty."""
     api_auth = ("api", api_key)
     mail_data = {
         "from": from_address,
@@ -323,28 +584,27 @@ def send_email_mailgun(
         "text": message,
     }
     req = None
-    if _can_attach_file(file_attached):
+    if attachment is None and _can_attach_file(file_attached):
+        attachment = open(file_attached, "rb").read()
+    if attachment:
         try:
-            files_data = [
-                (
-                    "attachment",
-                    ("unfinished_genes.txt", open(file_attached, "rb").read()),
-                )
-            ]
-            req = requests.post(
+            files_data = [("attachment", ("unfinished_genes.txt", attachment))]
+            req = (session or requests).post(
                 url,
                 auth=api_auth,
                 data=mail_data,
                 files=files_data,
+                timeout=timeout,
             )
         except ConnectionError as error:
             print(f"Connection error sending to {email_address}: {error}")
     else:
         try:
-            req = requests.post(
+            req = (session or requests).post(
                 url,
                 auth=api_auth,
                 data=mail_data,
+                timeout=timeout,
             )
         except ConnectionError as error:
             print(
@@ -360,3 +620,94 @@ def _can_attach_file(file_attached: str) -> bool:
         and Path(file_attached).exists()
         and Path(file_attached).stat().st_size > 0
     )
+
+
+def send_batch_mailgun(
+    url,
+    api_key,
+    from_address,
+    recipients,
+    subject,
+    session=None,
+    timeout=None,
+):
+    """Send one email to each recipient, a list of (address, message), in one call.
+
+    The lines that end all the messages, like the footer, are the template
+    sent once, and the lines before are the "body" recipient variable of
+    each address. Mailgun sends a separate email to each address. There is
+    no bcc, as the moderator would get the template without the variables:
+    send it batch_moderator_copy instead.
+    """
+    messages = [list(message) for _, message in recipients]
+    footer_length = 0
+    shortest = min(len(message) for message in messages)
+    while footer_length < shortest and all(
+        message[-footer_length - 1] == messages[0][-footer_length - 1]
+        for message in messages
+    ):
+        footer_length += 1
+    footer = messages[0][len(messages[0]) - footer_length :]
+    recipient_variables = {
+        email_address: {"body": "".join(message[: len(message) - footer_length])}
+        for (email_address, _), message in zip(recipients, messages)
+    }
+    mail_data = {
+        "from": from_address,
+        "to": [email_address for email_address, _ in recipients],
+        "subject": subject,
+        "text": "%recipient.body%" + "".join(footer),
+        "recipient-variables": json.dumps(recipient_variables),
+    }
+    req = None
+    try:
+        req = (session or requests).post(
+            url, auth=("api", api_key), data=mail_data, timeout=timeout
+        )
+    except ConnectionError as error:
+        print(f"Connection error sending to {len(recipients)} recipients: {error}")
+    return req
+
+
+def batch_moderator_copy(recipients):
+    """Return the lines of one email with the messages of a batch, for the moderator."""
+    lines = list()
+    for email_address, message in recipients:
+        if lines:
+            lines.append("\n")
+        lines.append(f"To: {email_address}\n")
+        lines.extend(message)
+    return lines
+
+
+def split_mailgun_batches(emails, batch_size):
+    """Group the emails that can be sent in a Mailgun batch.
+
+    emails are the (user_id, email_address, moderator_email_address, subject,
+    message, optional attachment text) to send. Return lists of their
+    indices, each list to send in a batch call of up to batch_size
+    recipients, or alone.
+    Emails with an attachment are sent alone, as a batch has the same
+    attachments for all, and so are the emails to an address already in
+    the batch, like the moderator, as an address has one set of variables.
+    """
+    batch_size = min(batch_size, MAILGUN_BATCH_LIMIT)
+    batches = dict()
+    groups = list()
+    for index, email in enumerate(emails):
+        email_address, moderator_email_address, subject = email[1:4]
+        attachment = email[5] if len(email) > 5 else None
+        if attachment or batch_size < 2:
+            groups.append([index])
+            continue
+        key = (moderator_email_address, subject)
+        if key not in batches or len(batches[key][0]) >= batch_size:
+            batches[key] = (list(), set())
+            groups.append(batches[key][0])
+        batch, batch_addresses = batches[key]
+        if email_address in batch_addresses:
+            groups.append([index])
+        else:
+            batch.append(index)
+            batch_addresses.add(email_address)
+    return groups
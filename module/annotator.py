@@ -75,6 +75,13 @@ class AnnotatorSummary:
     def add_non_canonical(self):
         self.non_canonical_count += 1
 
+    def add(self, kind, name=None, finished=False):
+        """Add a gene, pseudogene, mrna, ncrna or non_canonical annotation."""
+        if kind == "non_canonical":
+            self.add_non_canonical()
+        else:
+            getattr(self, "add_" + kind)(name, finished)
+
     def has_changes(self) -> bool:
         return self.total_gene_count + self.total_pseudogene_count > 0
 
@@ -11,54 +11,223 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+from concurrent.futures import ThreadPoolExecutor
 import inspect
-import json
 import os
 import sys
+import time
 from pathlib import Path
 import shutil
 
+import requests
+
 from module import annotation_quality_report as report, gff_file
+from module.email_resolver import AddressCache, EmailResolver
+from module.export_cache import ExportCache
+from module.mail_dispatch import MailgunDispatcher, write_delivery_report
 from module.gff_file import HandleGFF
+from module.run_manifest import RunManifest
+from module.run_report import RunReport, StageProfiler
+from module.sequence_cache import SequenceCache
+from module.summary_state import SummaryState
+from module.transcript import ApolloSequenceFetcher, GenomeSequences
 
 root_path = Path(inspect.getfile(sys.modules[__name__])).parent / ".."
 summary_footer_path = root_path / "summary_static_footer.txt"
 error_footer_path = root_path / "error_static_footer.txt"
 
 
+def format_download_stats(stats) -> str:
+    megabytes = stats["transferred_bytes"] / 1e6
+    written_megabytes = stats["written_bytes"] / 1e6
+    return (
+        f"{megabytes:.1f} MB transferred ({written_megabytes:.1f} MB written)"
+        f" in {stats['seconds']:.1f}s, {stats['throughput'] / 1e6:.2f} MB/s"
+    )
+
+
 class ApolloReporter:
     def __init__(self, config) -> None:
         self.config = config
-
-    def prepare_summary_gff(self):
+        self.failed_organisms = dict()
+        self.download_stats = dict()
+        self.run_manifest = None
+        self.run_report = RunReport()
+        self.sequence_fetcher = None
+        self.genomes = None
+        self.email_resolver = None
+        self.mail_dispatcher = None
+        self.deliveries = list()
+        self.spool_executor = None
+        self.spool_futures = list()
+
+    def load_run_manifest(self, resume=False) -> RunManifest:
+        """Start the checkpoints of the run, or continue those of the last run.
+
+        The manifest is run_manifest from the SETUP config, or a file next to
+        the output dir, as the output dir is deleted at each run.
+        """
+        setup_config = self.config["SETUP"]
+        out_dir = Path(setup_config["dir"])
+        default_path = out_dir.parent / (out_dir.name + ".run_manifest.json")
+        manifest_path = (
+            self._get_persistent_path("run_manifest", "run manifest") or default_path
+        )
+        self.run_manifest = RunManifest(manifest_path, resume=resume)
+        if self.run_manifest.resumed:
+            print(f"Resume the run from {manifest_path}")
+        return self.run_manifest
+
+    def prepare_summary_gff(self, organisms=None):
+        """Download the gff of each organism, those of the organism file by default.
+
+        The organisms are downloaded download_workers at a time. Returns the
+        list of (organism, gff path), in the order of the organism file, for
+        read_gff. An organism that fails is reported and left out, the
+        others are still returned. With an export_cache, the organisms
+        without recent annotations use their previous export. When the run
+        is resumed, the organisms already downloaded are not downloaded again.
+        """
         config = self.config
         gff_dir = config["SETUP"]["dir"]
-        organism_file = config["SETUP"]["organism_file"]
-        self._make_new_directory(gff_dir)
-        organism_file_handle = open(organism_file)
-        master_gff_file_name = gff_dir + "/master.gff"
-        master_gff_file_handle = open(master_gff_file_name, "w")
-
-        gene_to_organism_lookup = dict()
-        for organism_line in organism_file_handle:
-            organism = organism_line.rstrip()
-            gff_file_path = self.download_organism_gff(organism, gff_dir)
-
-            if not gff_file_path:
-                continue
-
-            self._join_gff_to_master(
-                organism, gff_file_path, master_gff_file_handle, gene_to_organism_lookup
+        downloaded = self._get_downloaded_organisms()
+        if not downloaded:
+            self._make_new_directory(gff_dir)
+        if organisms is None:
+            organisms = self.read_organism_file()
+
+        gff_files = list()
+        self.failed_organisms = dict()
+        self.download_stats = dict()
+        export_cache = self.load_export_cache()
+        with self.run_report.stage("download") as counts:
+            downloads = self.download_organism_gffs(
+                organisms, gff_dir, export_cache, downloaded
             )
+            for organism, gff_file_path in downloads:
+                if gff_file_path:
+                    gff_files.append((organism, gff_file_path))
+                    if self.run_manifest is not None and organism not in downloaded:
+                        self.run_manifest.add_item(
+                            "summary_download", organism, gff_file_path
+                        )
+            counts["organisms"] = len(gff_files)
+            counts["failed_organisms"] = len(self.failed_organisms)
+            if export_cache is not None:
+                counts["cached_organisms"] = export_cache.hits
+            self._count_download_bytes(counts)
+        if downloaded:
+            print(f"{len(downloaded)} organisms downloaded before the resume")
+
+        if export_cache is not None:
+            print(
+                f"Export cache: {export_cache.hits} organisms reused,"
+                f" {export_cache.misses} exported"
+            )
+        if self.failed_organisms:
+            print(f"No gff for {len(self.failed_organisms)} organisms:")
+            for organism, reason in self.failed_organisms.items():
+                print(f"  {organism}: {reason}")
 
-        master_gff_file_handle.close()
-        organism_lookup_file_name = gff_dir + "/organism_lookup.json"
-        with open(organism_lookup_file_name, "w") as outfile:
-            json.dump(gene_to_organism_lookup, outfile)
+        return gff_files
 
-        return gene_to_organism_lookup, master_gff_file_name
+    def read_organism_file(self):
+        with open(self.config["SETUP"]["organism_file"]) as organism_file_handle:
+            return [line.rstrip() for line in organism_file_handle if line.strip()]
 
-    def download_organism_gff(self, organism_name, out_dir):
+    def _count_download_bytes(self, counts) -> None:
+        counts["transferred_bytes"] = sum(
+            stats["transferred_bytes"] for stats in self.download_stats.values()
+        )
+        counts["written_bytes"] = sum(
+            stats["written_bytes"] for stats in self.download_stats.values()
+        )
+
+    def _get_downloaded_organisms(self):
+        """Return the organism gffs of the run being resumed that are still there."""
+        if self.run_manifest is None:
+            return dict()
+        return {
+            organism: gff_file_path
+            for organism, gff_file_path in self.run_manifest.get_items(
+                "summary_download"
+            ).items()
+            if os.path.exists(gff_file_path)
+        }
+
+    def download_organism_gffs(
+        self, organisms, out_dir, export_cache=None, downloaded=None
+    ):
+        """Yield (organism, gff file path or False) in the order of organisms.
+
+        The organisms in downloaded, a dict of gff paths, are not downloaded.
+        """
+        apollo_config = self.config["APOLLO"]
+        workers = int(apollo_config.get("download_workers") or 1)
+        timeout = apollo_config.get("download_timeout")
+        timeout = float(timeout) if timeout else None
+
+        cached_gffs = dict(downloaded or dict())
+        export_time = time.time()
+        missing_organisms = [
+            organism for organism in organisms if organism not in cached_gffs
+        ]
+        if export_cache is not None and missing_organisms:
+            changed_organisms = self.get_changed_organisms(
+                export_cache, missing_organisms
+            )
+            for organism in dict.fromkeys(missing_organisms):
+                cached_gff = export_cache.get(organism, changed_organisms)
+                if cached_gff:
+                    cached_gffs[organism] = str(cached_gff)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # A repeated organism is downloaded once, in its own directory
+            downloads = {
+                organism: executor.submit(
+                    self.download_organism_gff, organism, out_dir, timeout
+                )
+                for organism in dict.fromkeys(organisms)
+                if organism not in cached_gffs
+            }
+            for organism in organisms:
+                if organism in cached_gffs:
+                    yield organism, cached_gffs[organism]
+                    continue
+                try:
+                    gff_file_path = downloads[organism].result()
+                except (requests.RequestException, OSError) as error:
+                    print(f"{organism}: {error}")
+                    self.failed_organisms[organism] = str(error)
+                    gff_file_path = False
+                else:
+                    if not gff_file_path:
+                        self.failed_organisms[organism] = "export failed"
+                    elif export_cache is not None:
+                        export_cache.put(organism, gff_file_path, export_time)
+                yield organism, gff_file_path
+
+    def get_changed_organisms(self, export_cache, organisms):
+        """Return the organisms with recent annotations since their cached export.
+
+        If the recent annotations can't be retrieved, all the organisms are
+        considered changed.
+        """
+        apollo_config = self.config["APOLLO"]
+        days = export_cache.recent_days(organisms)
+        try:
+            recent_genes = report.get_recent_genes_from_apollo(
+                apollo_config["base_url"],
+                apollo_config["username"],
+                apollo_config["password"],
+                days,
+            )
+        except Exception as error:
+            print(f"No recent annotations, all the organisms are exported: {error}")
+            return set(organisms)
+        return set(recent_genes.values())
+
+    def download_organism_gff(self, organism_name, out_dir, timeout=None):
         config = self.config
         apollo_url = config["APOLLO"]["base_url"]
         apollo_user_name = config["APOLLO"]["username"]
@@ -66,41 +235,21 @@ class ApolloReporter:
         clean_organism_name = organism_name.replace("/", "")
         organism_new_dir = out_dir + "/" + clean_organism_name + "/"
         self._make_new_directory(organism_new_dir)
+        stats = dict()
         gff_file_name = report.download_gff(
             apollo_url,
             apollo_user_name,
             apollo_password,
             organism_name,
             organism_new_dir,
+            timeout=timeout,
+            stats=stats,
         )
+        if gff_file_name:
+            self.download_stats[organism_name] = stats
+            print(f"{organism_name}: {format_download_stats(stats)}")
         return gff_file_name
 
-    def _join_gff_to_master(
-        self, organism, gff_file_name, master_gff_file_handle, gene_organism
-    ):
-        gff_file_handle = open(gff_file_name, "r")
-        for line in gff_file_handle:
-            fields = line.rstrip().split("\t")
-            if len(fields) != 9:
-                continue  # skip line as not GFF
-            (
-                feature_type,
-                owner,
-                scaffold,
-                strand,
-                feature_id,
-                parent_id,
-                name,
-                locus,
-                status,
-                partial,
-            ) = gff_file.extract_fields_from_gff(fields)
-
-            if feature_type == "gene":
-                gene_organism[feature_id] = organism
-
-            master_gff_file_handle.write(line)
-
     @staticmethod
     def _make_new_directory(new_dir):
         if os.path.exists(new_dir):
@@ -110,6 +259,11 @@ class ApolloReporter:
             os.mkdir(new_dir)
 
     def prepare_recent_gff(self):
+        """Download the gff of the genes annotated in the last days.
+
+        Returns the recent genes and the path of their gff, no genes if
+        none were changed.
+        """
         config = self.config
         base_url = config["APOLLO"]["base_url"]
         username = config["APOLLO"]["username"]
@@ -117,67 +271,398 @@ class ApolloReporter:
         days = int(config["SETUP"]["days"])
         out_dir = config["SETUP"]["dir"]
 
+        checkpoint = self._get_recent_gff_checkpoint("recent_download")
+        if checkpoint is not None:
+            return checkpoint
         self._make_new_directory(out_dir)
 
-        recent_apollo_genes = report.get_recent_genes_from_apollo(
-            base_url, username, password, days
-        )
-        gff_file_path = False
-        if recent_apollo_genes:
-            gff_file_path = report.get_gff(
-                base_url, username, password, recent_apollo_genes, out_dir
+        with self.run_report.stage("download") as counts:
+            recent_apollo_genes = report.get_recent_genes_from_apollo(
+                base_url, username, password, days
             )
-        else:
+            counts["genes"] = len(recent_apollo_genes)
+            gff_file_path = False
+            if recent_apollo_genes:
+                stats = dict()
+                gff_file_path = self.get_recent_gff(
+                    recent_apollo_genes, out_dir, stats
+                )
+                if gff_file_path:
+                    self.download_stats["recent"] = stats
+                    print(f"Recent genes: {format_download_stats(stats)}")
+                    self._set_recent_gff_checkpoint(
+                        "recent_download", recent_apollo_genes, gff_file_path
+                    )
+                    self._count_download_bytes(counts)
+        if not recent_apollo_genes:
             print("No genes have been changed")
-            exit()
         return recent_apollo_genes, gff_file_path
 
-    def prepare_summary_emails(
-        self, master_gff_file_name, gene_organism, file_extension
-    ):
-        config = self.config
-        email_dir = Path(config["SETUP"]["dir"])
-        footer_text = self.load_summary_footer()
+    def _get_recent_gff_checkpoint(self, stage):
+        """Return the (recent genes, gff path) of the resumed run, or None."""
+        if self.run_manifest is None or not self.run_manifest.is_done(stage):
+            return None
+        items = self.run_manifest.get_items(stage)
+        if items["gff"] and not os.path.exists(items["gff"]):
+            return None
+        print("The recent genes were downloaded before the resume")
+        return items["genes"], items["gff"]
+
+    def _set_recent_gff_checkpoint(self, stage, genes, gff_file_path):
+        if self.run_manifest is None:
+            return
+        self.run_manifest.add_item(stage, "genes", genes)
+        self.run_manifest.add_item(stage, "gff", gff_file_path)
+        self.run_manifest.set_done(stage)
+
+    def get_recent_gff(self, genes, out_dir, stats=None):
+        """Download the gff of genes in batches, as set in the APOLLO config."""
+        apollo_config = self.config["APOLLO"]
+        timeout = apollo_config.get("download_timeout")
+        return report.get_gff(
+            apollo_config["base_url"],
+            apollo_config["username"],
+            apollo_config["password"],
+            genes,
+            out_dir,
+            stats,
+            batch_size=int(apollo_config.get("gff_batch_size") or 500),
+            workers=int(apollo_config.get("gff_workers") or 1),
+            timeout=float(timeout) if timeout else None,
+            retries=int(apollo_config.get("request_retries") or 3),
+        )
 
+    def load_summary_state(self):
+        """Return the state of the incremental summary, None if it is not set."""
+        state_path = self._get_persistent_path("summary_state", "summary state")
+        if not state_path:
+            return None
+        return SummaryState(state_path)
+
+    def update_summary_state(self, summary_state: SummaryState, full_rebuild=False):
+        """Bring the summary state up to date and return the HandleGFF read for it.
+
+        All the organisms are read, and so checked for errors, unless
+        incremental_summary is set. Then only the organisms annotated since
+        the last update are downloaded and read again, their genes replace
+        those of the state, so the deleted genes are dropped. An organism
+        whose only change since the last update is a deleted gene is not
+        listed by the recent annotations, its gene stays until the next full
+        read. All the organisms are still read if the state is empty, older
+        than summary_state_days, or with full_rebuild. A full rebuild is
+        also a consistency check: the owners whose summary differs from the
+        previous state are reported.
+        """
+        setup_config = self.config["SETUP"]
+        incremental = setup_config.get("incremental_summary") == "yes"
+        max_age_days = setup_config.get("summary_state_days")
+        update_time = time.time()
+        if (
+            incremental
+            and not full_rebuild
+            and not summary_state.is_empty()
+            and not (max_age_days and summary_state.age_days() > float(max_age_days))
+        ):
+            return self._update_recent_summary_state(summary_state, update_time)
+
+        gff_file_object = self.read_gff(
+            self.prepare_summary_gff(), keep_gene_summaries=True
+        )
+        if (incremental or full_rebuild) and not summary_state.is_empty():
+            different_owners = summary_state.compare(gff_file_object.annotators)
+            if different_owners:
+                print(f"The summary state differs for {len(different_owners)} owners:")
+                for owner in different_owners:
+                    print(f"  {owner}")
+            else:
+                print("The summary state is consistent with a full read")
+        summary_state.rebuild(
+            gff_file_object.gene_summaries, gff_file_object.gene_organism, update_time
+        )
+        summary_state.save()
+        return gff_file_object
+
+    def _update_recent_summary_state(self, summary_state, update_time):
+        changed_organisms = self._get_changed_summary_organisms(
+            summary_state, update_time
+        )
+        gene_summaries = dict()
+        gff_file_object = None
+        if changed_organisms:
+            organism_gffs = self.prepare_summary_gff(changed_organisms)
+            if self.failed_organisms:
+                raise Exception("The changed organisms could not be downloaded")
+            gff_file_object = self.read_gff(organism_gffs, keep_gene_summaries=True)
+            gene_summaries = gff_file_object.gene_summaries
+
+        deleted_genes = summary_state.update(
+            gene_summaries,
+            gff_file_object.gene_organism if gff_file_object else dict(),
+            changed_organisms,
+            update_time,
+        )
+        print(
+            f"Summary state: {len(changed_organisms)} organisms read again,"
+            f" {len(gene_summaries)} genes updated, {len(deleted_genes)} deleted,"
+            f" {len(summary_state.genes)} in total"
+        )
+        summary_state.save()
+        return gff_file_object
+
+    def _get_changed_summary_organisms(self, summary_state, update_time):
+        """Return the organisms of the organism file annotated since the last update.
+
+        When resumed, the same organisms are read again even if the state
+        was saved.
+        """
+        stage = "summary_state_organisms"
+        if self.run_manifest is not None and self.run_manifest.is_done(stage):
+            print("The changed organisms were listed before the resume")
+            return self.run_manifest.get_items(stage)["organisms"]
+
+        apollo_config = self.config["APOLLO"]
+        with self.run_report.stage("download") as counts:
+            recent_genes = report.get_recent_genes_from_apollo(
+                apollo_config["base_url"],
+                apollo_config["username"],
+                apollo_config["password"],
+                summary_state.recent_days(update_time),
+            )
+            recent_organisms = set(recent_genes.values())
+            changed_organisms = [
+                organism
+                for organism in dict.fromkeys(self.read_organism_file())
+                if organism in recent_organisms
+            ]
+            counts["genes"] = len(recent_genes)
+            counts["changed_organisms"] = len(changed_organisms)
+        if self.run_manifest is not None:
+            self.run_manifest.add_item(stage, "organisms", changed_organisms)
+            self.run_manifest.set_done(stage)
+        return changed_organisms
+
+    def read_gff(
+        self, gff_files, gene_organism=None, keep_gene_summaries=False
+    ) -> HandleGFF:
+        """Parse a gff once, so it can be shared by the summary and error stages.
+
+        gff_files is a gff path, or the list of (organism, gff path) from
+        prepare_summary_gff that are read as one.
+
+        With stream_gene_blocks, the gff is validated one gene block at a time
+        while it is read, and only the summaries and the errors are kept.
+        """
+        config = self.config
+        if gene_organism is None:
+            gene_organism = dict()
         gff_file_object = gff_file.HandleGFF(
-            master_gff_file_name, gene_organism, config["EMAIL"]["moderator"]
+            gff_files,
+            gene_organism,
+            config["EMAIL"]["moderator"],
+            keep_gene_summaries=keep_gene_summaries,
         )
-        gff_file_object.read_gff_file()
-        self._write_email_body(gff_file_object, email_dir)
+        with self.run_report.stage("parse") as counts:
+            self._read_gff_file(gff_file_object)
+            counts["genes"] = gff_file_object.gene_count
+            counts["transcripts"] = gff_file_object.transcript_count
+        return gff_file_object
 
-        messages = list()
-        annotation_summary_emails = self._collect_files(email_dir, file_extension)
-        for email in annotation_summary_emails:
-            email_address, email_message = self._compose_message(
-                email_dir, email, footer_text
+    def _read_gff_file(self, gff_file_object: HandleGFF) -> None:
+        config = self.config
+        if config["SETUP"].get("stream_gene_blocks") == "yes":
+            sequence_cache = self.load_sequence_cache()
+            try:
+                gff_file_object.errors = dict(
+                    gff_file_object.iter_gene_block_errors(
+                        base_url=config["APOLLO"]["base_url"],
+                        username=config["APOLLO"]["username"],
+                        password=config["APOLLO"]["password"],
+                        genome=self.load_genomes(),
+                        sequence_fetcher=self.load_sequence_fetcher(),
+                        sequence_cache=sequence_cache,
+                    )
+                )
+            finally:
+                if sequence_cache is not None:
+                    sequence_cache.close()
+        else:
+            gff_file_object.read_gff_file()
+
+    def load_genomes(self):
+        """Return the genomes from genome_dir to check the CDS, None if it is not set."""
+        genome_dir = self.config["SETUP"].get("genome_dir")
+        if not genome_dir:
+            return None
+        if self.genomes is None:
+            self.genomes = GenomeSequences(genome_dir=genome_dir)
+        return self.genomes
+
+    def _get_persistent_path(self, key, label):
+        """Return the path of key in the SETUP config, for a file kept between runs.
+
+        Such a file can't be in the output dir, that is deleted at each run:
+        it is then reported and not used. Returns None if it is not set or
+        not used.
+        """
+        path = self.config["SETUP"].get(key)
+        if not path:
+            return None
+        output_dir = Path(self.config["SETUP"]["dir"]).resolve()
+        resolved_path = Path(path).resolve()
+        if resolved_path == output_dir or output_dir in resolved_path.parents:
+            print(f"The {label} {path} is in the output dir, not used")
+            return None
+        return path
+
+    def load_export_cache(self):
+        """Return the cache of the organism exports, None if it is not set."""
+        setup_config = self.config["SETUP"]
+        cache_dir = self._get_persistent_path("export_cache", "export cache")
+        if not cache_dir:
+            return None
+        max_age_days = setup_config.get("export_cache_days")
+        return ExportCache(
+            cache_dir, max_age_days=float(max_age_days) if max_age_days else None
+        )
+
+    def load_sequence_cache(self):
+        """Return the on-disk cache of the CDS sequences, None if it is not set."""
+        setup_config = self.config["SETUP"]
+        cache_path = self._get_persistent_path("sequence_cache", "sequence cache")
+        if not cache_path:
+            return None
+        max_entries = setup_config.get("sequence_cache_size")
+        max_age_days = setup_config.get("sequence_cache_days")
+        return SequenceCache(
+            cache_path,
+            max_entries=int(max_entries) if max_entries else None,
+            max_age_days=float(max_age_days) if max_age_days else None,
+        )
+
+    def enable_profiling(self, stages=None, profile_dir=None) -> StageProfiler:
+        """Profile the stages, all by default, to the profile dir of the output dir."""
+        profile_dir = Path(profile_dir or Path(self.config["SETUP"]["dir"]) / "profile")
+        self.run_report.profiler = StageProfiler(profile_dir, stages)
+        return self.run_report.profiler
+
+    def write_run_report(self, status="finished") -> None:
+        """Write the run report to run_report, and run_report_prometheus if set.
+
+        The profiles are written too when profiling is enabled, and the
+        status of each email sent to delivery_report if set.
+        """
+        self.run_report.finish(status)
+        print(self.run_report.format())
+        profiler = self.run_report.profiler
+        if profiler is not None:
+            profiler.write()
+            print(profiler.format_summary())
+            print(f"Profiles written to {profiler.profile_dir}")
+        setup_config = self.config["SETUP"]
+        json_path = setup_config.get("run_report")
+        if json_path:
+            self.run_report.write_json(json_path)
+        prometheus_path = setup_config.get("run_report_prometheus")
+        if prometheus_path:
+            self.run_report.write_prometheus(prometheus_path)
+        delivery_report_path = setup_config.get("delivery_report")
+        if delivery_report_path:
+            write_delivery_report(self.deliveries, delivery_report_path)
+
+    def close(self) -> None:
+        """Wait for the spooled emails, then close the sessions of the run."""
+        try:
+            self.wait_email_spool()
+        finally:
+            if self.spool_executor is not None:
+                self.spool_executor.shutdown()
+                self.spool_executor = None
+            clients = (
+                self.sequence_fetcher,
+                self.genomes,
+                self.email_resolver,
+                self.mail_dispatcher,
             )
-            messages.append((email_address, email_message))
+            for client in clients:
+                if client is not None:
+                    client.close()
+            self.sequence_fetcher = None
+            self.genomes = None
+            self.email_resolver = None
+            self.mail_dispatcher = None
+
+    def load_sequence_fetcher(self):
+        """Return the ApolloSequenceFetcher of the run, set up from the APOLLO config."""
+        if self.sequence_fetcher is not None:
+            return self.sequence_fetcher
+        apollo_config = self.config["APOLLO"]
+        timeout = apollo_config.get("request_timeout")
+        self.sequence_fetcher = ApolloSequenceFetcher(
+            apollo_config["base_url"],
+            apollo_config["username"],
+            apollo_config["password"],
+            workers=int(apollo_config.get("sequence_workers") or 1),
+            timeout=float(timeout) if timeout else None,
+            retries=int(apollo_config.get("request_retries") or 3),
+        )
+        return self.sequence_fetcher
+
+    def prepare_summary_emails(self, gff_file_object, file_extension):
+        """Return the summary emails of the annotators, and spool them.
+
+        gff_file_object is a HandleGFF, or a SummaryState: anything with the
+        annotator summaries.
+        """
+        footer_text = self.load_summary_footer()
+
+        with self.run_report.stage("summary_render") as counts:
+            messages = list()
+            for annotator_object in gff_file_object.annotators.values():
+                message = report.summary_email(annotator_object)
+                if message is not None:
+                    message.footer = footer_text
+                    messages.append(message)
+            counts["emails"] = len(messages)
+        self.spool_emails(messages)
         return messages
 
-    @staticmethod
-    def _write_email_body(file_object, out_dir: Path):
-        for owner, annotator_object in file_object.annotators.items():
-            report.write_summary_text(annotator_object, out_dir)
+    def load_written_emails(self, file_extension):
+        """Return the emails spooled by a previous run, to send them on resume."""
+        email_dir = Path(self.config["SETUP"]["dir"])
+        if file_extension == "summary":
+            footer_text = self.load_summary_footer()
+        else:
+            footer_text = self.load_error_footer()
+        messages = report.read_email_spool(email_dir, file_extension)
+        for message in messages:
+            message.footer = footer_text
+        return messages
 
-    @staticmethod
-    def _collect_files(out_dir: Path, filter_term):
-        file_filtered_list = list()
-        _, _, file_list = next(os.walk(str(out_dir)), (None, None, []))
-        for file_name in file_list:
-            _, file_extension = os.path.splitext(file_name)
-            if "." + filter_term == file_extension:
-                file_filtered_list.append(file_name)
-        return file_filtered_list
+    def spool_emails(self, messages) -> None:
+        """Write the emails to the output dir in the background.
+
+        The spool is an archive of the emails of the run, and what --resume
+        sends without rendering them again. It is not written if the SETUP
+        email_spool is "no".
+        """
+        if not self.email_spool_enabled():
+            return
+        if self.spool_executor is None:
+            self.spool_executor = ThreadPoolExecutor(max_workers=1)
+        email_dir = Path(self.config["SETUP"]["dir"])
+        self.spool_futures.append(
+            self.spool_executor.submit(report.write_email_spool, messages, email_dir)
+        )
 
-    @staticmethod
-    def _compose_message(out_dir: Path, email_body, footer):
-        email_path = out_dir / email_body
-        with email_path.open("r") as email_fh:
-            address = email_fh.readline().rstrip()
-            message = email_fh.readlines()
-            message += footer
+    def wait_email_spool(self) -> bool:
+        """Wait for the spooled emails to be written, return False without a spool."""
+        for future in self.spool_futures:
+            future.result()
+        self.spool_futures = list()
+        return self.email_spool_enabled()
 
-        return address, message
+    def email_spool_enabled(self) -> bool:
+        return self.config["SETUP"].get("email_spool", "yes") != "no"
 
     def load_error_footer(self):
         config = self.config
@@ -199,36 +684,39 @@ class ApolloReporter:
         with static_footer.open("r") as footer_fh:
             return footer_fh.readlines()
 
-    def prepare_error_emails(
-        self, master_gff_file_name, gene_organism_lookup, file_extension
-    ):
+    def prepare_error_emails(self, gff_file_object: HandleGFF, file_extension):
         config = self.config
-        email_dir = Path(config["SETUP"]["dir"])
         apollo_url = config["APOLLO"]["base_url"]
         footer_text = self.load_error_footer()
         messages = list()
 
-        gff_file_object = report.validate_gff(
-            apollo_url,
-            config["APOLLO"]["username"],
-            config["APOLLO"]["password"],
-            master_gff_file_name,
-            gene_organism_lookup,
-            config["EMAIL"]["moderator"],
-        )
+        sequence_cache = self.load_sequence_cache()
+        try:
+            gff_file_object = report.validate_parsed_gff(
+                apollo_url,
+                config["APOLLO"]["username"],
+                config["APOLLO"]["password"],
+                gff_file_object,
+                genome=self.load_genomes(),
+                sequence_fetcher=self.load_sequence_fetcher(),
+                sequence_cache=sequence_cache,
+                run_report=self.run_report,
+            )
+        finally:
+            if sequence_cache is not None:
+                sequence_cache.close()
 
         if not gff_file_object:
             print("No error was found")
             return messages
 
-        report.write_email_texts(gff_file_object.errors, email_dir)
-
-        annotation_error_emails = self._collect_files(email_dir, file_extension)
-        for email in annotation_error_emails:
-            email_address, email_message = self._compose_message(
-                email_dir, email, footer_text
-            )
-            messages.append((email_address, email_message))
+        with self.run_report.stage("error_render") as counts:
+            messages = report.error_emails(gff_file_object.errors)
+            for message in messages:
+                message.footer = footer_text
+            counts["errors"] = len(gff_file_object.errors)
+            counts["emails"] = len(messages)
+        self.spool_emails(messages)
         return messages
 
     @staticmethod
@@ -249,16 +737,75 @@ class ApolloReporter:
 
         report.sort_and_write_errors_old(error_lookup_table, sort_order_list, 0, email_dir)
 
-    def send_emails(self, email_type, list_of_emails):
-        config = self.config
-        email_dir = config["SETUP"]["dir"]
-        mailgun_url = config["MAILGUN"]["url"]
-        mailgun_key = config["MAILGUN"]["api_key"]
-        from_address = config["EMAIL"]["from_address"]
-        email_url = config["EMAIL"]["base_url"]
-        client_id = config["EMAIL"]["client_id"]
-        client_secret = config["EMAIL"]["client_secret"]
+    def load_email_resolver(self) -> EmailResolver:
+        """Return the EmailResolver of the run, set up from the EMAIL config."""
+        if self.email_resolver is not None:
+            return self.email_resolver
+        email_config = self.config["EMAIL"]
+        setup_config = self.config["SETUP"]
+        address_cache = None
+        cache_path = self._get_persistent_path("address_cache", "address cache")
+        if cache_path:
+            max_age_days = setup_config.get("address_cache_days")
+            address_cache = AddressCache(
+                cache_path, max_age_days=float(max_age_days) if max_age_days else None
+            )
+        timeout = email_config.get("lookup_timeout")
+        self.email_resolver = EmailResolver(
+            email_config["base_url"],
+            email_config["client_id"],
+            email_config["client_secret"],
+            address_cache=address_cache,
+            workers=int(email_config.get("lookup_workers") or 1),
+            timeout=float(timeout) if timeout else None,
+        )
+        return self.email_resolver
+
+    def resolve_addresses(self, user_ids):
+        """Resolve the addresses of all the user_ids before sending."""
+        email_resolver = self.load_email_resolver()
+        stats_before = dict(email_resolver.stats)
+        with self.run_report.stage("address_lookup") as counts:
+            addresses = email_resolver.resolve_all(user_ids)
+            for key, value in email_resolver.stats.items():
+                counts[key] = value - stats_before[key]
+            counts["moderator_fallbacks"] = sum(
+                1 for email_address in addresses.values() if not email_address
+            )
+        if counts["moderator_fallbacks"]:
+            print(
+                f"{counts['moderator_fallbacks']} users without an email address,"
+                " sent to the moderator"
+            )
+        return addresses
+
+    def load_mail_dispatcher(self) -> MailgunDispatcher:
+        """Return the MailgunDispatcher of the run, set up from the MAILGUN config."""
+        if self.mail_dispatcher is not None:
+            return self.mail_dispatcher
+        mailgun_config = self.config["MAILGUN"]
+        rate = mailgun_config.get("send_rate")
+        burst = mailgun_config.get("send_burst")
+        timeout = mailgun_config.get("send_timeout")
+        self.mail_dispatcher = MailgunDispatcher(
+            mailgun_config["url"],
+            mailgun_config["api_key"],
+            self.config["EMAIL"]["from_address"],
+            workers=int(mailgun_config.get("send_workers") or 1),
+            rate=float(rate) if rate else None,
+            burst=int(burst) if burst else None,
+            timeout=float(timeout) if timeout else None,
+            retries=int(mailgun_config.get("send_retries") or 3),
+        )
+        return self.mail_dispatcher
+
+    def send_emails(self, email_type, list_of_emails, checkpoint=None):
+        """Send the EmailMessages with Mailgun.
 
+        With a checkpoint, the users are recorded in the run manifest as
+        their email is sent, and those recorded by the resumed run are skipped.
+        """
+        config = self.config
         mode = config["SETUP"]["mode"]
 
         if email_type == "summary":
@@ -266,31 +813,71 @@ class ApolloReporter:
         else:
             subject = config["EMAIL"]["error_subject"]
 
-        for email in list_of_emails:
-            user_id, email_message = email
-            email_address = report.get_email(
-                email_url, client_id, client_secret, user_id
+        sent_users = dict()
+        if self.run_manifest is not None and checkpoint:
+            sent_users = self.run_manifest.get_items(checkpoint)
+            if sent_users:
+                print(f"{len(sent_users)} {email_type} emails sent before the resume")
+
+        list_of_emails = [
+            message for message in list_of_emails if message.user_id not in sent_users
+        ]
+        addresses = dict()
+        if mode == "live":
+            addresses = self.resolve_addresses(
+                [message.user_id for message in list_of_emails]
             )
+
+        emails = list()
+        for message in list_of_emails:
+            user_id = message.user_id
+            email_address = addresses.get(user_id)
             moderators = config["EMAIL"]["moderator"]
             moderator_email_address = moderators
             if not email_address:
                 email_address = config["EMAIL"]["moderator"]
 
-            if email_type == "summary":
-                file_attached = email_dir + "/" + user_id + ".gene_list"
-            else:
-                file_attached = None
-
             if mode != "live":
                 email_address = config["EMAIL"]["moderator"]
 
-            report.send_email_mailgun(
-                mailgun_url,
-                mailgun_key,
-                from_address,
-                email_address,
-                moderator_email_address,
-                subject,
-                email_message,
-                file_attached,
+            emails.append(
+                (
+                    user_id,
+                    email_address,
+                    moderator_email_address,
+                    subject,
+                    message.lines,
+                    message.gene_list,
+                )
             )
+
+        def record_delivery(delivery):
+            delivery["email_type"] = email_type
+            self.deliveries.append(delivery)
+            sent = delivery["status"] == "sent"
+            if sent and self.run_manifest is not None and checkpoint:
+                self.run_manifest.add_item(checkpoint, delivery["user_id"])
+
+        # The summaries share their layout, they can be sent in batch calls,
+        # but not with their own gene list attached
+        batch_size = None
+        if email_type == "summary":
+            batch_size = int(config["MAILGUN"].get("batch_size") or 0)
+            with_gene_list = sum(1 for email in emails if email[5])
+            if batch_size and with_gene_list:
+                print(
+                    f"{with_gene_list} of {len(emails)} summary emails have a gene"
+                    " list attached, they are not batched"
+                )
+        mail_dispatcher = self.load_mail_dispatcher()
+        stats_before = dict(mail_dispatcher.stats)
+        with self.run_report.stage("send") as counts:
+            deliveries = mail_dispatcher.send_all(
+                emails, on_delivery=record_delivery, batch_size=batch_size
+            )
+            for key, value in mail_dispatcher.stats.items():
+                counts[key] = value - stats_before[key]
+        all_sent = all(delivery["status"] == "sent" for delivery in deliveries)
+
+        if self.run_manifest is not None and checkpoint and all_sent:
+            self.run_manifest.set_done(checkpoint)
@@ -0,0 +1,110 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from typing import Dict, List
+
+start_codon = "ATG"
+stop_codons = ("TAA", "TAG", "TGA")
+
+
+def _byte_table(values: Dict[str, int]) -> bytes:
+    table = bytearray(256)
+    for base, value in values.items():
+        table[ord(base)] = value
+    return bytes(table)
+
+
+# A stop codon is T, then A or G, then A or G but not GG. The second and
+# third bases are coded on two bits so that they share a bit exactly when
+# they make a stop: A=01 G=10 for the second base, A=11 G=01 for the third.
+first_base_table = _byte_table({"T": 1})
+second_base_table = _byte_table({"A": 1, "G": 2})
+third_base_table = _byte_table({"A": 3, "G": 1})
+
+
+def internal_codon_count(length: int) -> int:
+    """Number of codons checked for internal stops, all but the last full one."""
+    return max((length - 1) // 3, 0)
+
+
+def in_frame_stop_flags(sequence: bytes) -> bytes:
+    """Return one byte per codon of sequence, 1 if it is a stop codon, else 0.
+
+    The codons are compared all at once: each base position of the codons is
+    translated to bit flags and the flags are combined as big integers,
+    instead of slicing the sequence one codon at a time.
+    """
+    codon_count = len(sequence) // 3
+    if not codon_count:
+        return bytes()
+    end = codon_count * 3
+    first = int.from_bytes(sequence[0:end:3].translate(first_base_table), "big")
+    second = int.from_bytes(sequence[1:end:3].translate(second_base_table), "big")
+    third = int.from_bytes(sequence[2:end:3].translate(third_base_table), "big")
+    shared = second & third
+    # Move the bit 1 of each byte to its bit 0, the first base flags mask the rest
+    stop = first & (shared | (shared >> 1))
+    return stop.to_bytes(codon_count, "big")
+
+
+def count_internal_stop_codons(sequence: str) -> int:
+    return count_internal_stop_codons_batch([sequence])[0]
+
+
+def count_internal_stop_codons_batch(sequences: List[str]) -> List[int]:
+    """Count the in-frame stop codons before the last codon of each sequence.
+
+    The checked codons of all the sequences are joined, every part being a
+    whole number of codons, so a single pass gives the flags of the batch.
+    """
+    pieces = list()
+    bounds = list()
+    codon_position = 0
+    for sequence in sequences:
+        codon_count = internal_codon_count(len(sequence))
+        pieces.append(sequence[: codon_count * 3])
+        bounds.append((codon_position, codon_position + codon_count))
+        codon_position += codon_count
+
+    flags = in_frame_stop_flags("".join(pieces).encode("ascii", "replace"))
+    return [flags.count(1, begin, end) for begin, end in bounds]
+
+
+def scan_coding_sequences(sequences: List[str]) -> List[Dict[str, str]]:
+    """Return the codon errors of each coding sequence.
+
+    The error names and texts are those of the CodingSequence checks, with
+    a frame error when the length is not a multiple of 3.
+    """
+    internal_stop_counts = count_internal_stop_codons_batch(sequences)
+    sequence_errors = list()
+    for sequence, internal_stop_count in zip(sequences, internal_stop_counts):
+        errors = dict()
+        if sequence[0:3] != start_codon:
+            errors["start_codon"] = "no start codon"
+        if sequence[-3:] not in stop_codons:
+            errors["stop_codon"] = "no stop codon"
+        if internal_stop_count:
+            errors["no_internal_stop_codon"] = (
+                str(internal_stop_count) + " internal stop codon"
+            )
+        if len(sequence) % 3:
+            errors["frame"] = frame_error_text(len(sequence))
+        sequence_errors.append(errors)
+    return sequence_errors
+
+
+def frame_error_text(length: int) -> str:
+    return f"a length of {length}, not a multiple of 3"
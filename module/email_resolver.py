@@ -0,0 +1,166 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from module import annotation_quality_report as report, web_session
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class AddressCache:
+    """Email addresses kept between runs, by the numeric user id of the owners.
+
+    An address is used for max_age_days after it was looked up, then it is
+    looked up again in case the user changed it.
+    """
+
+    def __init__(self, cache_path, max_age_days=None) -> None:
+        self.cache_path = Path(cache_path)
+        self.max_age_days = max_age_days
+        self.addresses = dict()
+        if self.cache_path.exists():
+            with self.cache_path.open("r") as cache_file:
+                self.addresses = json.load(cache_file)
+
+    def get(self, user_number, now=None):
+        """Return the cached address of a user, or None if missing or too old."""
+        now = now or time.time()
+        entry = self.addresses.get(str(user_number))
+        if entry is None or (
+            self.max_age_days is not None
+            and now - entry["resolved"] > self.max_age_days * SECONDS_PER_DAY
+        ):
+            return None
+        return entry["email"]
+
+    def put(self, user_number, email, resolve_time=None) -> None:
+        self.addresses[str(user_number)] = {
+            "email": email,
+            "resolved": resolve_time or time.time(),
+        }
+
+    def save(self) -> None:
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = Path(str(self.cache_path) + ".tmp")
+        with temp_path.open("w") as cache_file:
+            json.dump(self.addresses, cache_file, indent=1, sort_keys=True)
+        os.replace(temp_path, self.cache_path)
+
+
+class EmailResolver:
+    """Look up the email addresses of the owners, several requests at a time.
+
+    The addresses are resolved once per run, the summary and the error
+    emails share them, and are looked up in the address_cache first. An
+    owner without a numeric user id, or that the lookup service doesn't
+    know, resolves to False so that the caller can use the moderator.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        client_id,
+        client_secret,
+        address_cache: AddressCache = None,
+        workers=1,
+        timeout=None,
+        retries=3,
+    ) -> None:
+        self.base_url = base_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.address_cache = address_cache
+        self.workers = max(int(workers), 1)
+        self.timeout = timeout
+        self.session = web_session.create_session(
+            pool_size=self.workers, retries=retries
+        )
+        self.addresses = dict()
+        self.stats = {
+            "cache_hits": 0,
+            "lookups": 0,
+            "not_found": 0,
+            "no_user_id": 0,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def lookup(self, user_id):
+        try:
+            return report.get_email(
+                self.base_url,
+                self.client_id,
+                self.client_secret,
+                user_id,
+                session=self.session,
+                timeout=self.timeout,
+            )
+        except (requests.RequestException, ValueError, KeyError) as error:
+            print(f"No email address for {user_id}: {error}")
+            return False
+
+    def resolve_all(self, user_ids):
+        """Resolve the distinct user_ids, return the {user id: address or False}."""
+        to_look_up = list()
+        for user_id in dict.fromkeys(user_ids):
+            if user_id in self.addresses:
+                continue
+            user_number = report.get_user_number(user_id)
+            if user_number is None:
+                self.stats["no_user_id"] += 1
+                self.addresses[user_id] = False
+                continue
+            cached_email = None
+            if self.address_cache is not None:
+                cached_email = self.address_cache.get(user_number)
+            if cached_email:
+                self.stats["cache_hits"] += 1
+                self.addresses[user_id] = cached_email
+            else:
+                to_look_up.append((user_id, user_number))
+
+        if to_look_up:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                emails = executor.map(
+                    self.lookup, [user_id for user_id, _ in to_look_up]
+                )
+                for (user_id, user_number), email in zip(to_look_up, emails):
+                    self.stats["lookups"] += 1
+                    self.addresses[user_id] = email
+                    if not email:
+                        self.stats["not_found"] += 1
+                    elif self.address_cache is not None:
+                        self.address_cache.put(user_number, email)
+            if self.address_cache is not None:
+                self.address_cache.save()
+
+        return {user_id: self.addresses[user_id] for user_id in user_ids}
+
+    def resolve(self, user_id):
+        return self.resolve_all([user_id])[user_id]
@@ -0,0 +1,109 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import json
+import math
+import os
+import shutil
+import time
+from pathlib import Path
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class ExportCache:
+    """Organism gff exports kept between summary runs.
+
+    Each organism has its last export in cache_dir, with the time the
+    export was started in manifest.json. An export can be used again if the
+    organism has no recent annotation since then. Apollo doesn't list the
+    deleted genes as recent, so an export older than max_age_days is
+    always made again.
+    """
+
+    manifest_name = "manifest.json"
+
+    def __init__(self, cache_dir, max_age_days=None) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.cache_dir / ExportCache.manifest_name
+        self.manifest = dict()
+        if self.manifest_path.exists():
+            with self.manifest_path.open("r") as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+    def get_gff_path(self, organism) -> Path:
+        clean_organism_name = organism.replace("/", "")
+        return self.cache_dir / (clean_organism_name + ".gff")
+
+    def recent_days(self, organisms, now=None) -> int:
+        """Days of recent annotations that cover the cached exports of organisms."""
+        now = now or time.time()
+        export_times = [
+            self.manifest[organism]["exported"]
+            for organism in organisms
+            if organism in self.manifest
+        ]
+        if not export_times:
+            return 1
+        return max(math.ceil((now - min(export_times)) / SECONDS_PER_DAY), 1)
+
+    def get(self, organism, changed_organisms, now=None):
+        """Return the cached gff of an unchanged organism, or None."""
+        now = now or time.time()
+        entry = self.manifest.get(organism)
+        gff_path = self.get_gff_path(organism)
+        if (
+            entry is None
+            or organism in changed_organisms
+            or not gff_path.exists()
+            or (
+                self.max_age_days is not None
+                and now - entry["exported"] > self.max_age_days * SECONDS_PER_DAY
+            )
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return gff_path
+
+    def put(self, organism, gff_file_path, export_time) -> Path:
+        """Keep a copy of a new export, started at export_time."""
+        gff_path = self.get_gff_path(organism)
+        temp_path = Path(str(gff_path) + ".tmp")
+        shutil.copyfile(gff_file_path, temp_path)
+        os.replace(temp_path, gff_path)
+
+        self.manifest[organism] = {
+            "exported": export_time,
+            "bytes": gff_path.stat().st_size,
+        }
+        self._save_manifest()
+        self.stored += 1
+        return gff_path
+
+    def _save_manifest(self) -> None:
+        temp_path = Path(str(self.manifest_path) + ".tmp")
+        with temp_path.open("w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "stored": self.stored}
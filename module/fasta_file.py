@@ -0,0 +1,171 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import mmap
+import os
+from pathlib import Path
+from typing import Dict, Tuple
+
+
+class IndexedFasta:
+    """Random access to the sequences of a fasta file.
+
+    The file is memory mapped and a samtools style .fai index is loaded, or
+    built and saved next to the file if it is missing or older than the
+    fasta. Subsequences are read straight from the mapped file, so a whole
+    scaffold is never copied to get a few exons.
+    """
+
+    def __init__(self, fasta_path) -> None:
+        self.fasta_path = Path(fasta_path)
+        self.index_path = Path(str(fasta_path) + ".fai")
+        self.index = self._load_index()
+        self._file_handle = self.fasta_path.open("rb")
+        self._map = None
+        if self.fasta_path.stat().st_size > 0:
+            self._map = mmap.mmap(
+                self._file_handle.fileno(), 0, access=mmap.ACCESS_READ
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file_handle.close()
+
+    def __contains__(self, name) -> bool:
+        return name in self.index
+
+    def __getitem__(self, name) -> "FastaRecord":
+        if name not in self.index:
+            raise KeyError(name)
+        return FastaRecord(self, name)
+
+    def names(self):
+        return list(self.index)
+
+    def length(self, name) -> int:
+        return self.index[name][0]
+
+    def fetch(self, name, start: int, end: int) -> str:
+        """Return the sequence from start to end (0-based, end excluded)."""
+        length, offset, line_bases, line_width = self.index[name]
+        start = max(start, 0)
+        end = min(end, length)
+        if start >= end:
+            return ""
+        first_byte = offset + (start // line_bases) * line_width + start % line_bases
+        last_byte = offset + (end // line_bases) * line_width + end % line_bases
+        sequence = self._map[first_byte:last_byte]
+        return sequence.replace(b"\n", b"").replace(b"\r", b"").decode("ascii")
+
+    def _load_index(self) -> Dict[str, Tuple[int, int, int, int]]:
+        if (
+            self.index_path.exists()
+            and self.index_path.stat().st_mtime >= self.fasta_path.stat().st_mtime
+        ):
+            return read_fasta_index(self.index_path)
+
+        index = build_fasta_index(self.fasta_path)
+        try:
+            write_fasta_index(index, self.index_path)
+        except OSError as error:
+            print(f"Could not save the index of {self.fasta_path}: {error}")
+        return index
+
+
+class FastaRecord:
+    """One sequence of an IndexedFasta, that can be sliced like a str."""
+
+    def __init__(self, fasta: IndexedFasta, name) -> None:
+        self.fasta = fasta
+        self.name = name
+
+    def __len__(self) -> int:
+        return self.fasta.length(self.name)
+
+    def __getitem__(self, item) -> str:
+        if not isinstance(item, slice) or item.step not in (None, 1):
+            raise TypeError("Only contiguous slices of a fasta record are supported")
+        start, end, _ = item.indices(len(self))
+        return self.fasta.fetch(self.name, start, end)
+
+
+def build_fasta_index(fasta_path) -> Dict[str, Tuple[int, int, int, int]]:
+    """Index a fasta file as name -> (length, offset, line bases, line width)."""
+    index = dict()
+    name = None
+    length = offset = line_bases = line_width = 0
+    last_line_short = False
+
+    with open(fasta_path, "rb") as file_handle:
+        position = 0
+        for line in file_handle:
+            line_start = position
+            position += len(line)
+            if line.startswith(b">"):
+                if name is not None:
+                    index[name] = (length, offset, line_bases, line_width)
+                name = line[1:].split()[0].decode()
+                length = line_bases = line_width = 0
+                offset = position
+                last_line_short = False
+                continue
+
+            bases = len(line.rstrip(b"\r\n"))
+            if bases == 0:
+                if line_bases == 0:
+                    offset = position
+                else:
+                    last_line_short = True
+                continue
+            if line_bases == 0:
+                line_bases = bases
+                line_width = len(line)
+            elif last_line_short or bases > line_bases:
+                raise ValueError(
+                    f"Lines of different lengths in {name} at byte {line_start}"
+                    f" of {fasta_path}, the fasta can't be indexed"
+                )
+            last_line_short = bases < line_bases
+            length += bases
+
+    if name is not None:
+        index[name] = (length, offset, line_bases, line_width)
+    return index
+
+
+def read_fasta_index(index_path) -> Dict[str, Tuple[int, int, int, int]]:
+    index = dict()
+    with open(index_path, "r") as file_handle:
+        for line in file_handle:
+            name, length, offset, line_bases, line_width = line.split("\t")[:5]
+            index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+    return index
+
+
+def write_fasta_index(index: Dict[str, Tuple[int, int, int, int]], index_path) -> None:
+    temp_path = str(index_path) + ".tmp"
+    with open(temp_path, "w") as file_handle:
+        for name, values in index.items():
+            line = [name] + [str(value) for value in values]
+            file_handle.write("\t".join(line) + "\n")
+    os.replace(temp_path, index_path)
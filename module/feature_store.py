@@ -0,0 +1,272 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+from array import array
+from collections.abc import Mapping
+
+NO_ROW = -1
+NO_CODE = -1
+
+
+class StringPool:
+    """Intern repeated strings (scaffolds, owners, types) as integer codes."""
+
+    def __init__(self):
+        self.codes = dict()
+        self.values = list()
+
+    def code(self, value) -> int:
+        if value is None:
+            return NO_CODE
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def value(self, code: int):
+        if code == NO_CODE:
+            return None
+        return self.values[code]
+
+
+class FeatureStore:
+    """Column oriented storage for the features of a gff.
+
+    Each feature id gets an integer row. Types, owners, scaffolds and strands
+    are kept as StringPool codes and the coordinates in int arrays, instead of
+    one dict entry per feature and field. A row is also created for a parent
+    that is referenced before its own line; it only becomes a feature once it
+    is added.
+    """
+
+    def __init__(self):
+        self.index = dict()
+        self.ids = list()
+        # Rows of the added features, in the order they were added
+        self.rows = array("i")
+
+        self.parent = array("i")
+        self.type_code = array("h")
+        self.owner_code = array("i")
+        self.scaffold_code = array("i")
+        self.strand_code = array("b")
+        self.begin = array("q")
+        self.end = array("q")
+        self.phase = array("b")
+        self.has_fields = bytearray()
+
+        self.types = StringPool()
+        self.owners = StringPool()
+        self.scaffolds = StringPool()
+        self.strands = StringPool()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_row(self, feature_id) -> int:
+        row = self.index.get(feature_id)
+        if row is None:
+            row = self._append_row(
+                feature_id,
+                NO_CODE,
+                NO_CODE,
+                NO_CODE,
+                NO_CODE,
+                0,
+                0,
+                NO_CODE,
+                False,
+            )
+        return row
+
+    def _append_row(
+        self,
+        feature_id,
+        type_code,
+        owner_code,
+        scaffold_code,
+        strand_code,
+        begin,
+        end,
+        phase,
+        has_fields,
+    ) -> int:
+        row = len(self.ids)
+        self.index[feature_id] = row
+        self.ids.append(feature_id)
+        self.parent.append(NO_ROW)
+        self.type_code.append(type_code)
+        self.owner_code.append(owner_code)
+        self.scaffold_code.append(scaffold_code)
+        self.strand_code.append(strand_code)
+        self.begin.append(begin)
+        self.end.append(end)
+        self.phase.append(phase)
+        self.has_fields.append(1 if has_fields else 0)
+        return row
+
+    def is_feature(self, row: int) -> bool:
+        return self.type_code[row] != NO_CODE
+
+    def add_feature(
+        self,
+        feature_id,
+        feature_type,
+        owner,
+        parent_id,
+        scaffold,
+        strand,
+        begin: int,
+        end: int,
+        has_fields: bool,
+        phase: int = NO_CODE,
+    ) -> int:
+        """Add a feature, has_fields tells if its scaffold, strand and position are checked."""
+        type_code = self.types.code(feature_type)
+        owner_code = self.owners.code(owner)
+        scaffold_code = self.scaffolds.code(scaffold)
+        strand_code = self.strands.code(strand)
+
+        row = self.index.get(feature_id)
+        if row is None:
+            row = self._append_row(
+                feature_id,
+                type_code,
+                owner_code,
+                scaffold_code,
+                strand_code,
+                begin,
+                end,
+                phase,
+                has_fields,
+            )
+            self.rows.append(row)
+        else:
+            if not self.is_feature(row):
+                self.rows.append(row)
+            self.type_code[row] = type_code
+            self.owner_code[row] = owner_code
+            self.scaffold_code[row] = scaffold_code
+            self.strand_code[row] = strand_code
+            self.begin[row] = begin
+            self.end[row] = end
+            self.phase[row] = phase
+            if has_fields:
+                self.has_fields[row] = 1
+
+        if parent_id:
+            self.parent[row] = self.get_row(parent_id)
+        return row
+
+    def feature_type(self, row: int):
+        return self.types.value(self.type_code[row])
+
+    def owner(self, row: int):
+        return self.owners.value(self.owner_code[row])
+
+    def scaffold(self, row: int):
+        return self.scaffolds.value(self.scaffold_code[row])
+
+    def strand(self, row: int):
+        return self.strands.value(self.strand_code[row])
+
+    def position(self, row: int):
+        return self.begin[row], self.end[row]
+
+
+class _FeatureView(Mapping):
+    """Read only dict-like access to one column of a FeatureStore, by feature id."""
+
+    def __init__(self, store: FeatureStore):
+        self.store = store
+
+    def _row(self, feature_id) -> int:
+        row = self.store.index.get(feature_id)
+        if row is None or not self._has_value(row):
+            raise KeyError(feature_id)
+        return row
+
+    def _has_value(self, row: int) -> bool:
+        return self.store.is_feature(row)
+
+    def __contains__(self, feature_id):
+        row = self.store.index.get(feature_id)
+        return row is not None and self._has_value(row)
+
+    def __iter__(self):
+        store = self.store
+        for row in store.rows:
+            if self._has_value(row):
+                yield store.ids[row]
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class FeatureTypeView(_FeatureView):
+    def __getitem__(self, feature_id):
+        return self.store.feature_type(self._row(feature_id))
+
+
+class FeatureOwnerView(_FeatureView):
+    def __getitem__(self, feature_id):
+        return self.store.owner(self._row(feature_id))
+
+
+class ParentView(_FeatureView):
+    def _has_value(self, row: int) -> bool:
+        return self.store.is_feature(row) and self.store.parent[row] != NO_ROW
+
+    def __getitem__(self, feature_id):
+        store = self.store
+        return store.ids[store.parent[self._row(feature_id)]]
+
+
+class FieldsView(Mapping):
+    """Dict-like access to the checked fields, keyed by (field, feature_id)."""
+
+    field_names = ("scaffold", "strand", "position")
+
+    def __init__(self, store: FeatureStore):
+        self.store = store
+
+    def __getitem__(self, key):
+        field, feature_id = key
+        store = self.store
+        row = store.index.get(feature_id)
+        if row is None or not store.has_fields[row]:
+            raise KeyError(key)
+        if field == "scaffold":
+            return store.scaffold(row)
+        elif field == "strand":
+            return store.strand(row)
+        elif field == "position":
+            return store.position(row)
+        raise KeyError(key)
+
+    def __iter__(self):
+        store = self.store
+        for row in store.rows:
+            if store.has_fields[row]:
+                feature_id = store.ids[row]
+                for field in FieldsView.field_names:
+                    yield field, feature_id
+
+    def __len__(self):
+        store = self.store
+        checked_rows = sum(1 for row in store.rows if store.has_fields[row])
+        return checked_rows * len(FieldsView.field_names)
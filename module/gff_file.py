@@ -11,11 +11,17 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from typing import Dict, List
-from module import annotator, transcript, validation_error
+import itertools
+from array import array
+from typing import Dict, Iterator, List, Tuple
+from module import annotator, codon_scan, feature_store, transcript, validation_error
+from module.feature_store import NO_CODE, NO_ROW
+from module.sequence_cache import SequenceCache
 
 any_organism = "ANY_ORGANISM"
 MAX_ITERATION = 6
+CODON_SCAN_BATCH = 256
+UNRESOLVED = -1
 
 top_level_feat = set(("gene", "pseudogene"))
 sub_prot_feat = set(
@@ -51,280 +57,677 @@ allowed_feature = top_level_feat.union(sub_prot_feat).union(non_coding_feat)
 
 
 class HandleGFF:
-    def __init__(self, file_path, gene_organism, moderator):
+    def __init__(self, file_path, gene_organism, moderator, keep_gene_summaries=False):
+        """file_path is a gff path, or a list of (organism, gff path).
+
+        The genes of the gff files given with their organism are added to
+        gene_organism while they are read. With keep_gene_summaries, the
+        annotations of each gene in the annotator summaries are kept in
+        gene_summaries, see SummaryState.
+        """
         self.file_path = file_path
+        if isinstance(file_path, (list, tuple)):
+            self.gff_files = list(file_path)
+        else:
+            self.gff_files = [(None, file_path)]
         self.gene_organism = gene_organism
         self.moderator = moderator
-        self.feature_type = dict()
-        self.gene_meta_info = dict()
-        self.feature_owner = dict()
-        self.child_parent_relationship = dict()
-        self.transcripts = list()
         self.annotators = dict()
+        self.gene_summaries = dict() if keep_gene_summaries else None
         self.parent_name = dict()
-
-        self.fields = dict()
+        # Genes and transcripts read, that the store of a gene block forgets
+        self.gene_count = 0
+        self.transcript_count = 0
+        self._summary_counted = False
+        self._reset_features()
+
+    def _reset_features(self):
+        """Forget all the features read so far, the annotator summaries are kept."""
+        self.gene_meta_info = dict()
+        self.gene_last_modified = dict()
+        self.transcripts = list()
         self.errors = dict()
 
+        # All the features are kept in a FeatureStore, the dicts are views on it
+        self.store = feature_store.FeatureStore()
+        self.feature_type = feature_store.FeatureTypeView(self.store)
+        self.feature_owner = feature_store.FeatureOwnerView(self.store)
+        self.child_parent_relationship = feature_store.ParentView(self.store)
+        self.fields = feature_store.FieldsView(self.store)
+
+        # Gene, mRNA, owner and depth of each store row, see build_ancestry_index
+        self.ancestor_gene = array("i")
+        self.ancestor_mrna = array("i")
+        self.ancestor_owner = array("i")
+        self.ancestor_depth = array("b")
+        self.lineage_errors = dict()
+
     def read_gff_file(self):
-        with open(self.file_path, "r") as file_handle:
-            line_number = 0
-            disqualified_features = list()
-            finished_gene_status = False
-            for line in file_handle:
-                fields = line.rstrip().split("\t")
-                line_number += 1
-                if len(fields) != 9:
-                    finished_gene_status = False
-                    continue  # skip line as not GFF
-                (
-                    feature_type,
-                    owner,
-                    scaffold,
-                    strand,
-                    feature_id,
-                    parent_id,
-                    name,
-                    locus,
-                    status,
-                    partial,
-                ) = extract_fields_from_gff(fields)
+        self._read_features(self._iter_gff_features())
+        self.build_ancestry_index()
+
+    def _iter_gff_features(self):
+        """Yield the features of all the gff files, as filter_gff_features does.
+
+        The feature lines of the files given with an organism are numbered
+        one after the other, as if they were joined in a single gff.
+        """
+        line_numbers = itertools.count(1)
+        for organism, file_path in self.gff_files:
+            with open(file_path, "r") as file_handle:
+                if organism is None:
+                    yield from filter_gff_features(file_handle)
+                    continue
+
+                feature_lines = (
+                    line for line in file_handle if line.rstrip().count("\t") == 8
+                )
+                numbered_lines = (
+                    (line_number, line)
+                    for line, line_number in zip(feature_lines, line_numbers)
+                )
+                for gff_line in filter_numbered_gff_features(numbered_lines):
+                    _, _, gff_fields = gff_line
+                    if gff_fields[0] == "gene":
+                        self.gene_organism[gff_fields[4]] = organism
+                    yield gff_line
+
+    def iter_gene_block_errors(
+        self,
+        base_url=None,
+        username=None,
+        password=None,
+        fasta_file=None,
+        genome: transcript.GenomeSequences = None,
+        sequence_fetcher: transcript.ApolloSequenceFetcher = None,
+        sequence_cache: SequenceCache = None,
+    ):
+        """Read and validate the gff one gene block at a time.
+
+        Apollo writes each gene followed by its descendants, so a block can be
+        validated and dropped as soon as it is complete: only the current block
+        is kept in memory, while the annotator summaries cover the whole file.
+        Blocks with a feature whose parent is not in the same block go to a
+        fallback buffer that is validated at the end of the file. The ids of
+        the validated blocks are kept, so that the blocks with the parents of
+        the fallback features are read again and validated with them.
+
+        Yields (feature_id, ValidationError) for each error found.
+        """
+        if base_url and sequence_fetcher is None:
+            # Share one pooled session between all the blocks
+            with transcript.ApolloSequenceFetcher(
+                base_url, username, password
+            ) as sequence_fetcher:
+                yield from self.iter_gene_block_errors(
+                    base_url,
+                    username,
+                    password,
+                    fasta_file,
+                    genome,
+                    sequence_fetcher,
+                    sequence_cache,
+                )
+            return
+
+        self._reset_features()
+        checks = (
+            base_url,
+            username,
+            password,
+            fasta_file,
+            genome,
+            sequence_fetcher,
+            sequence_cache,
+        )
+        fallback_lines = list()
+        fallback_ids = set()
+        fallback_missing = set()
+        # Block index of each feature of the validated blocks
+        validated_blocks = dict()
+
+        blocks = enumerate(split_gene_blocks(self._iter_gff_features()))
+        for block_index, block_lines in blocks:
+            block_ids, missing_parents = _get_block_lineage(block_lines)
+            if missing_parents or not fallback_missing.isdisjoint(block_ids):
+                fallback_lines += block_lines
+                fallback_missing -= block_ids
+                fallback_missing |= missing_parents - fallback_ids
+                fallback_ids |= block_ids
+                continue
+
+            yield from self._validate_block(block_lines, *checks)
+            for feature_id in block_ids:
+                validated_blocks[feature_id] = block_index
+
+        if fallback_lines:
+            print(f"Validating {len(fallback_lines)} gff lines out of order")
+            reread_indices = {
+                validated_blocks[parent_id]
+                for parent_id in fallback_missing
+                if parent_id in validated_blocks
+            }
+            reread_lines = list()
+            if reread_indices:
+                # Their summaries are counted already, their errors are found again
+                blocks = enumerate(split_gene_blocks(self._iter_gff_features()))
+                for block_index, block_lines in blocks:
+                    if block_index in reread_indices:
+                        reread_lines += block_lines
+                fallback_lines = sorted(
+                    fallback_lines + reread_lines, key=lambda gff_line: gff_line[0]
+                )
+                _, fallback_missing = _get_block_lineage(fallback_lines)
+            fallback_lines = _drop_orphan_features(fallback_lines, fallback_missing)
+            yield from self._validate_block(
+                fallback_lines,
+                *checks,
+                counted_lines={line_number for line_number, _, _ in reread_lines},
+            )
+
+    def _validate_block(
+        self,
+        block_lines,
+        base_url,
+        username,
+        password,
+        fasta_file,
+        genome,
+        sequence_fetcher,
+        sequence_cache,
+        counted_lines=frozenset(),
+    ):
+        self._read_features(block_lines, counted_lines)
+        if len(self.store):
+            self.build_ancestry_index()
+            self.scan_gff_for_errors()
+            if base_url or fasta_file or genome or sequence_fetcher:
+                self.scan_mrna_sequence(
+                    base_url=base_url,
+                    username=username,
+                    password=password,
+                    fasta_file=fasta_file,
+                    genome=genome,
+                    sequence_fetcher=sequence_fetcher,
+                    sequence_cache=sequence_cache,
+                )
+        block_errors = self.errors
+        self._reset_features()
+        yield from block_errors.items()
+
+    def _add_to_summary(self, gene_id, owner, kind, name=None, finished=False):
+        """Add an annotation to the summary of its owner.
+
+        With keep_gene_summaries, it is also kept with the gene it belongs
+        to, so the summaries can be updated one gene at a time later on.
+        """
+        if self._summary_counted:
+            return
+        self.annotators[owner].add(kind, name, finished)
+        if self.gene_summaries is not None:
+            gene_summary = self.gene_summaries.setdefault(gene_id, list())
+            gene_summary.append((owner, kind, name, finished))
+
+    def _read_features(self, gff_features, counted_lines=frozenset()):
+        """Add the features to the store, and their annotations to the summaries.
+
+        The annotations of the lines in counted_lines are not added again.
+        """
+        finished_gene_status = False
+        for line_number, fields, gff_fields in gff_features:
+            self._summary_counted = line_number in counted_lines
+            if not fields:
+                finished_gene_status = False
+                continue  # skip line as not GFF
+            (
+                feature_type,
+                owner,
+                scaffold,
+                strand,
+                feature_id,
+                parent_id,
+                name,
+                locus,
+                status,
+                partial,
+                last_modified,
+            ) = gff_fields
+            if owner is not None:
+                owner = self.get_first_owner(owner)
+
+            if feature_type in top_level_feat and not self._summary_counted:
+                self.gene_count += 1
+
+            if feature_type == "gene":
+                finished_gene_status = False
+                self.gene_meta_info[feature_id] = (name, locus)
+                self.gene_last_modified[feature_id] = last_modified
                 if owner is not None:
-                    owner = self.get_first_owner(owner)
-                if feature_type not in allowed_feature:
-                    disqualified_features.append(feature_id)
+                    if owner not in self.annotators:
+                        self.annotators[owner] = annotator.AnnotatorSummary(owner)
 
-                if feature_id in disqualified_features:
-                    continue
-                if parent_id in disqualified_features:
-                    disqualified_features.append(feature_id)
-                    continue
+                    if status == "Finished" or status == "Finished annotating":
+                        finished_gene_status = True
+                    self._add_to_summary(
+                        feature_id, owner, "gene", name, finished_gene_status
+                    )
+                else:
+                    owner = self.moderator
+                    print("No owner for Gene: " + feature_id)
+
+            elif feature_type == "pseudogene":
+                finished_gene_status = False
+                self.gene_meta_info[feature_id] = (name, locus)
+                self.gene_last_modified[feature_id] = last_modified
+                if owner is not None:
+                    if owner not in self.annotators:
+                        self.annotators[owner] = annotator.AnnotatorSummary(owner)
+                    if status == "Finished" or status == "Finished annotating":
+                        finished_gene_status = True
+                    self._add_to_summary(
+                        feature_id, owner, "pseudogene", name, finished_gene_status
+                    )
+                else:
+                    owner = self.moderator
+                    print("No owner for Pseudogene: " + feature_id)
 
-                if feature_type == "gene":
-                    finished_gene_status = False
-                    self.gene_meta_info[feature_id] = (name, locus)
-                    if owner is not None:
-                        if owner not in self.annotators:
-                            self.annotators[owner] = annotator.AnnotatorSummary(owner)
+            elif feature_type == "mRNA":
+                organism = self.gene_organism.get(parent_id)
+                if not organism:
+                    organism = any_organism
 
-                        if status == "Finished" or status == "Finished annotating":
-                            finished_gene_status = True
-                        self.annotators[owner].add_gene(name, finished_gene_status)
-                    else:
-                        owner = self.moderator
-                        print("No owner for Gene: " + feature_id)
-
-                elif feature_type == "pseudogene":
-                    finished_gene_status = False
-                    self.gene_meta_info[feature_id] = (name, locus)
-                    if owner is not None:
-                        if owner not in self.annotators:
-                            self.annotators[owner] = annotator.AnnotatorSummary(owner)
-                        if status == "Finished" or status == "Finished annotating":
-                            finished_gene_status = True
-                        self.annotators[owner].add_pseudogene(
-                            name, finished_gene_status
+                if owner is not None:
+                    if owner not in self.annotators:
+                        self.annotators[owner] = annotator.AnnotatorSummary(owner)
+
+                    parent_name, _ = self.gene_meta_info[parent_id]
+                    if finished_gene_status:
+                        self._add_to_summary(
+                            parent_id, owner, "mrna", parent_name, True
                         )
+
+                        # Save the transcript for checking
+                        if not partial:
+                            self.transcripts.append(
+                                (feature_id, organism, scaffold)
+                            )
+                            if not self._summary_counted:
+                                self.transcript_count += 1
                     else:
-                        owner = self.moderator
-                        print("No owner for Pseudogene: " + feature_id)
-
-                elif feature_type == "mRNA":
-                    organism = self.gene_organism.get(parent_id)
-                    if not organism:
-                        organism = any_organism
-
-                    if owner is not None:
-                        if owner not in self.annotators:
-                            self.annotators[owner] = annotator.AnnotatorSummary(owner)
-
-                        parent_name, _ = self.gene_meta_info[parent_id]
-                        if finished_gene_status:
-                            self.annotators[owner].add_mrna(parent_name, True)
-
-                            # Save the transcript for checking
-                            if not partial:
-                                self.transcripts.append(
-                                    (feature_id, organism, scaffold)
-                                )
-                        else:
-                            self.annotators[owner].add_mrna(parent_name, False)
-                    else:
-                        owner = self.moderator
-                        print("No owner for mRNA: " + feature_id)
+                        self._add_to_summary(
+                            parent_id, owner, "mrna", parent_name, False
+                        )
+                else:
+                    owner = self.moderator
+                    print("No owner for mRNA: " + feature_id)
 
-                elif feature_type in non_coding_feat:
-                    organism = self.gene_organism.get(parent_id)
-                    if not organism:
-                        organism = any_organism
+            elif feature_type in non_coding_feat:
+                organism = self.gene_organism.get(parent_id)
+                if not organism:
+                    organism = any_organism
 
-                    if owner is not None:
-                        if owner not in self.annotators:
-                            self.annotators[owner] = annotator.AnnotatorSummary(owner)
+                if owner is not None:
+                    if owner not in self.annotators:
+                        self.annotators[owner] = annotator.AnnotatorSummary(owner)
 
-                        parent_name, _ = self.gene_meta_info[parent_id]
-                        self.annotators[owner].add_ncrna(
-                            parent_name, finished_gene_status
-                        )
-                    else:
-                        owner = self.moderator
-                        print("No owner for ncRNA: " + feature_id)
-
-                if feature_id in self.child_parent_relationship:
-                    feature_id = feature_id + "_" + str(line_number)
-
-                if feature_type in [
-                    "non_canonical_five_prime_splice_site",
-                    "non_canonical_three_prime_splice_site",
-                ]:
-                    owner = self.get_parent_owner(parent_id)
-                    self.annotators[owner].add_non_canonical()
-
-                self.feature_owner[feature_id] = owner
-                self.feature_type[feature_id] = feature_type
-
-                if finished_gene_status:
-                    self.fields[("scaffold", feature_id)] = scaffold
-                    self.fields[("strand", feature_id)] = strand
-                    self.fields[("position", feature_id)] = (
-                        int(fields[3]),
-                        int(fields[4]),
+                    parent_name, _ = self.gene_meta_info[parent_id]
+                    self._add_to_summary(
+                        parent_id, owner, "ncrna", parent_name, finished_gene_status
                     )
-
-                if parent_id:
-                    self.child_parent_relationship[feature_id] = parent_id
-                elif feature_type in top_level_feat:
-                    self.child_parent_relationship[
-                        feature_id
-                    ] = feature_id  # to avoid checking if ID exists
+                else:
+                    owner = self.moderator
+                    print("No owner for ncRNA: " + feature_id)
+
+            if feature_id in self.child_parent_relationship:
+                feature_id = feature_id + "_" + str(line_number)
+
+            if feature_type in [
+                "non_canonical_five_prime_splice_site",
+                "non_canonical_three_prime_splice_site",
+            ]:
+                owner = self.get_parent_owner(parent_id)
+                gene_id = None
+                if self.gene_summaries is not None:
+                    gene_id = self.get_gene_id(parent_id)
+                self._add_to_summary(gene_id, owner, "non_canonical")
+
+            if not parent_id:
+                if feature_type in top_level_feat:
+                    parent_id = feature_id  # to avoid checking if ID exists
                 else:
                     print("Feature not recognized", feature_type, feature_id)
 
+            phase = NO_CODE
+            if fields[7].isdigit():
+                phase = int(fields[7])
+
+            # Scaffold, strand and position are only checked for finished genes
+            self.store.add_feature(
+                feature_id,
+                feature_type,
+                owner,
+                parent_id,
+                scaffold,
+                strand,
+                int(fields[3]),
+                int(fields[4]),
+                finished_gene_status,
+                phase,
+            )
+        self._summary_counted = False
+
     @staticmethod
     def get_first_owner(owner):
         owners = owner.rstrip().split(",")
         return owners[0]
 
-    def get_gene_id(self, feature_id, iteration=0):
-        if iteration > MAX_ITERATION:
-            raise RecursionError(f"Too many iteration for id {feature_id}")
-        if feature_id == self.child_parent_relationship[feature_id]:
-            return feature_id
-        else:
-            parent_id = self.child_parent_relationship[feature_id]
-            iteration += 1
-            return self.get_gene_id(parent_id, iteration)
-
-    def get_parent_owner(self, feature_id, iteration=0):
-        if iteration > MAX_ITERATION:
-            raise RecursionError(f"Too many iteration for id {feature_id}")
-        if self.feature_owner[feature_id]:
-            return self.feature_owner[feature_id]
-        else:
-            parent_id = self.child_parent_relationship[feature_id]
-            iteration += 1
-            return self.get_parent_owner(parent_id)
-
-    def get_mrna_id(self, feature_id, iteration=0):
-        if iteration > MAX_ITERATION:
-            raise RecursionError(f"Too many iteration for id {feature_id}")
-        if self.feature_type[feature_id] == "mRNA":
-            return feature_id
-        elif self.feature_type[feature_id] in top_level_feat:
+    def build_ancestry_index(self):
+        """Resolve the gene, mRNA and owner of every feature in one pass.
+
+        The parent chains are walked iteratively and each feature is resolved
+        only once. Features with a cycle, a missing parent or a chain deeper
+        than MAX_ITERATION are reported and kept in lineage_errors.
+        """
+        store = self.store
+        self.ancestor_gene = array("i")
+        self.ancestor_mrna = array("i")
+        self.ancestor_owner = array("i")
+        self.ancestor_depth = array("b")
+        self.lineage_errors = dict()
+        for row in store.rows:
+            if store.parent[row] == NO_ROW:
+                continue
+            try:
+                self._resolve_ancestry(row)
+            except (RecursionError, KeyError):
+                continue
+
+        for feature_id, error in self.lineage_errors.items():
+            print(f"Broken parent chain for {feature_id}: {error}")
+
+    def _resolve_ancestry(self, row):
+        store = self.store
+        missing_rows = len(store.ids) - len(self.ancestor_depth)
+        if missing_rows > 0:
+            self.ancestor_gene.extend([NO_ROW] * missing_rows)
+            self.ancestor_mrna.extend([NO_ROW] * missing_rows)
+            self.ancestor_owner.extend([NO_CODE] * missing_rows)
+            self.ancestor_depth.extend([UNRESOLVED] * missing_rows)
+
+        # Walk up until a resolved feature or a top level feature is found
+        path = list()
+        on_path = set()
+        current_row = row
+        error = None
+        while self.ancestor_depth[current_row] == UNRESOLVED:
+            current_id = store.ids[current_row]
+            parent_row = store.parent[current_row]
+            if current_id in self.lineage_errors:
+                error = self.lineage_errors[current_id]
+                break
+            if current_row in on_path:
+                error = RecursionError(f"Cycle in parents of id {current_id}")
+                break
+            if not store.is_feature(current_row) or parent_row == NO_ROW:
+                error = KeyError(f"No parent known for id {current_id}")
+                break
+            path.append(current_row)
+            on_path.add(current_row)
+            if parent_row == current_row:
+                break
+            current_row = parent_row
+
+        # Then resolve the path from the top down
+        for current_row in reversed(path):
+            if error is None:
+                error = self._add_ancestry(current_row)
+            if error is not None:
+                self.lineage_errors[store.ids[current_row]] = error
+
+        if store.ids[row] in self.lineage_errors:
+            raise self.lineage_errors[store.ids[row]]
+        return row
+
+    def _add_ancestry(self, row):
+        store = self.store
+        parent_row = store.parent[row]
+        owner_code = store.owner_code[row]
+
+        if parent_row == row:
+            self.ancestor_gene[row] = row
+            self.ancestor_owner[row] = owner_code
+            self.ancestor_depth[row] = 0
             return None
+
+        depth = self.ancestor_depth[parent_row] + 1
+        if depth > MAX_ITERATION:
+            return RecursionError(f"Too many iteration for id {store.ids[row]}")
+
+        feature_type = store.feature_type(row)
+        if feature_type == "mRNA":
+            mrna_row = row
+        elif feature_type in top_level_feat:
+            mrna_row = NO_ROW
         else:
-            parent_id = self.child_parent_relationship[feature_id]
-            iteration += 1
-            return self.get_mrna_id(parent_id, iteration)
+            mrna_row = self.ancestor_mrna[parent_row]
+        if not store.owners.value(owner_code):
+            owner_code = self.ancestor_owner[parent_row]
+
+        self.ancestor_gene[row] = self.ancestor_gene[parent_row]
+        self.ancestor_mrna[row] = mrna_row
+        self.ancestor_owner[row] = owner_code
+        self.ancestor_depth[row] = depth
+        return None
+
+    def get_gene_id(self, feature_id):
+        row = self._resolve_ancestry(self.store.index[feature_id])
+        return self.store.ids[self.ancestor_gene[row]]
+
+    def get_parent_owner(self, feature_id):
+        row = self._resolve_ancestry(self.store.index[feature_id])
+        return self.store.owners.value(self.ancestor_owner[row])
+
+    def get_mrna_id(self, feature_id):
+        row = self._resolve_ancestry(self.store.index[feature_id])
+        mrna_row = self.ancestor_mrna[row]
+        if mrna_row == NO_ROW:
+            return None
+        return self.store.ids[mrna_row]
 
     def scan_gff_for_errors(self):
-        for key, value in self.fields.items():
-            field, feature_id = key
-
-            if feature_id not in self.child_parent_relationship:
+        store = self.store
+        for row in store.rows:
+            parent_row = store.parent[row]
+            if not store.has_fields[row] or parent_row == NO_ROW:
+                continue
+            feature_id = store.ids[row]
+            if feature_id in self.lineage_errors:
                 continue
+            if not store.has_fields[parent_row]:
+                raise KeyError(("scaffold", store.ids[parent_row]))
 
-            parent_id = self.child_parent_relationship[feature_id]
-            parent_value = self.fields[(field, parent_id)]
-
-            gene_id = self.get_gene_id(feature_id)
-            owner = self.get_parent_owner(feature_id)
-            mrna_id = self.get_mrna_id(feature_id)
-
-            gene_name, locus = self.gene_meta_info[gene_id]
-            arguments = dict()
-            arguments["owner"] = owner
-            arguments["organism_name"] = self.gene_organism.get(gene_id)
-            if not arguments["organism_name"]:
-                arguments["organism_name"] = any_organism
-            arguments["gene_id"] = gene_id
-            arguments["mrna_id"] = mrna_id
-            arguments["gene_name"] = gene_name
-            arguments["locus"] = locus
-
-            if field == "position":
-                begin, end = value
-                parent_begin, parent_end = parent_value
-                if not (
-                    parent_begin <= begin <= parent_end
-                    and parent_begin <= end <= parent_end
-                ):
-                    arguments["field_type"] = field
-                    arguments["feature_type"] = self.feature_type[feature_id]
-                    arguments["feature_value"] = "Begin:{}..End:{}".format(begin, end)
-                    arguments["parent_id"] = parent_id
-                    arguments["parent_value"] = "Begin:{}..End:{}".format(
-                        parent_begin, parent_end
-                    )
+            if store.scaffold_code[row] != store.scaffold_code[parent_row]:
+                self._add_field_error(
+                    row, "scaffold", store.scaffold(row), store.scaffold(parent_row)
+                )
 
-                    self.add_validation_error(feature_id, "gff_error", **arguments)
+            if store.strand_code[row] != store.strand_code[parent_row]:
+                self._add_field_error(
+                    row, "strand", store.strand(row), store.strand(parent_row)
+                )
 
-            else:
-                if value != parent_value:
-                    arguments["field_type"] = field
-                    arguments["feature_type"] = self.feature_type[feature_id]
-                    arguments["feature_value"] = value
-                    arguments["parent_id"] = parent_id
-                    arguments["parent_value"] = parent_value
-                    self.add_validation_error(feature_id, "gff_error", **arguments)
+            begin, end = store.position(row)
+            parent_begin, parent_end = store.position(parent_row)
+            if not (
+                parent_begin <= begin <= parent_end
+                and parent_begin <= end <= parent_end
+            ):
+                self._add_field_error(
+                    row,
+                    "position",
+                    "Begin:{}..End:{}".format(begin, end),
+                    "Begin:{}..End:{}".format(parent_begin, parent_end),
+                )
+
+    def _add_field_error(self, row, field, feature_value, parent_value):
+        store = self.store
+        feature_id = store.ids[row]
+        arguments = self._get_error_arguments(feature_id)
+        arguments["field_type"] = field
+        arguments["feature_type"] = store.feature_type(row)
+        arguments["feature_value"] = feature_value
+        arguments["parent_id"] = store.ids[store.parent[row]]
+        arguments["parent_value"] = parent_value
+        self.add_validation_error(feature_id, "gff_error", **arguments)
+
+    def _get_error_arguments(self, feature_id):
+        gene_id = self.get_gene_id(feature_id)
+        gene_name, locus = self.gene_meta_info[gene_id]
+        arguments = dict()
+        arguments["owner"] = self.get_parent_owner(feature_id)
+        arguments["organism_name"] = self.gene_organism.get(gene_id)
+        if not arguments["organism_name"]:
+            arguments["organism_name"] = any_organism
+        arguments["gene_id"] = gene_id
+        arguments["mrna_id"] = self.get_mrna_id(feature_id)
+        arguments["gene_name"] = gene_name
+        arguments["locus"] = locus
+        return arguments
+
+    def get_cds_segments(self):
+        """Return the (begin, end, phase) of the CDS of each mRNA, by mRNA id."""
+        store = self.store
+        cds_code = store.types.code("CDS")
+        cds_segments = dict()
+        for row in store.rows:
+            if store.type_code[row] != cds_code or store.parent[row] == NO_ROW:
+                continue
+            mrna_id = store.ids[store.parent[row]]
+            phase = max(store.phase[row], 0)
+            segment = (store.begin[row], store.end[row], phase)
+            cds_segments.setdefault(mrna_id, list()).append(segment)
+        return cds_segments
+
+    def get_sequence_version(self, mrna_id, cds_segments):
+        """Return what the CDS sequence of an mRNA is cached against.
+
+        The date_last_modified of the gene only has the day, so the CDS
+        coordinates are added to catch the changes made on the same day.
+        """
+        store = self.store
+        gene_id = store.ids[store.parent[store.index[mrna_id]]]
+        segments = sorted(cds_segments.get(mrna_id, ()))
+        return f"{self.gene_last_modified.get(gene_id)}|{segments}"
+
+    def _read_cached_sequences(self, mrnas, sequence_cache, cds_segments, cached_ids):
+        for mrna in mrnas:
+            version = self.get_sequence_version(mrna.feature_name, cds_segments)
+            sequence = sequence_cache.get(
+                mrna.organism_name, mrna.sequence_name, mrna.feature_name, version
+            )
+            if sequence:
+                mrna.sequence = sequence
+                cached_ids.add(mrna.feature_name)
+            yield mrna
 
     def scan_mrna_sequence(
-        self, base_url=None, username=None, password=None, fasta_file=None
+        self,
+        base_url=None,
+        username=None,
+        password=None,
+        fasta_file=None,
+        genome: transcript.GenomeSequences = None,
+        sequence_fetcher: transcript.ApolloSequenceFetcher = None,
+        sequence_cache: SequenceCache = None,
     ):
-        for mrna_id, organism, scaffold in self.transcripts:
-            mrna = transcript.CodingSequence(mrna_id, organism, scaffold)
+        """Check the codons and the length of the CDS of the finished transcripts.
+
+        The coding sequences are assembled from the genome if one is given. For
+        the organisms without a genome fasta, they are retrieved from Apollo,
+        with the sequence_fetcher if one is given, or from the fasta_file. The
+        sequences from Apollo are looked up in the sequence_cache first, and
+        saved to it once fetched.
+        """
+        if base_url and sequence_fetcher is None:
+            with transcript.ApolloSequenceFetcher(
+                base_url, username, password
+            ) as sequence_fetcher:
+                return self.scan_mrna_sequence(
+                    base_url,
+                    username,
+                    password,
+                    fasta_file,
+                    genome,
+                    sequence_fetcher,
+                    sequence_cache,
+                )
+        if not (genome or sequence_fetcher or fasta_file):
+            return False
+
+        cds_segments = dict()
+        if genome or (sequence_fetcher and sequence_cache is not None):
+            cds_segments = self.get_cds_segments()
+        mrnas = (
+            transcript.CodingSequence(mrna_id, organism, scaffold)
+            for mrna_id, organism, scaffold in self.transcripts
+        )
+        genome_mrnas = list()
+        if genome:
+            apollo_mrnas = list()
+            for mrna in mrnas:
+                if genome.has_genome(mrna.organism_name):
+                    genome_mrnas.append(mrna)
+                else:
+                    apollo_mrnas.append(mrna)
+            mrnas = apollo_mrnas
+        cached_ids = set()
+        batch = list()
+        if sequence_fetcher:
+            if sequence_cache is not None:
+                mrnas = self._read_cached_sequences(
+                    mrnas, sequence_cache, cds_segments, cached_ids
+                )
+            mrnas = sequence_fetcher.fetch(mrnas)
 
-            if base_url:
+        for mrna in itertools.chain(genome_mrnas, mrnas):
+            mrna_id = mrna.feature_name
+            if genome and genome.has_genome(mrna.organism_name):
                 mrna.get_sequence(
-                    base_url=base_url, username=username, password=password
+                    genome=genome,
+                    strand=self.store.strand(self.store.index[mrna_id]),
+                    cds_segments=cds_segments.get(mrna_id),
                 )
-            elif fasta_file:
+            elif not sequence_fetcher:
                 mrna.get_sequence(fasta_file=fasta_file)
-            else:
-                return False
+            elif sequence_cache is not None and mrna.sequence:
+                if mrna_id not in cached_ids:
+                    sequence_cache.put(
+                        mrna.organism_name,
+                        mrna.sequence_name,
+                        mrna_id,
+                        self.get_sequence_version(mrna_id, cds_segments),
+                        mrna.sequence,
+                    )
 
             if not mrna.sequence:
                 print(f"No mRNA sequence could be used for {mrna_id}")
                 continue
 
-            mrna.coding_sequence_has_start_codon()
-            mrna.coding_sequence_has_stop_codon()
-            mrna.coding_sequence_no_internal_stop_codon()
-
+            batch.append(mrna)
+            if len(batch) == CODON_SCAN_BATCH:
+                self._add_sequence_errors(batch)
+                batch = list()
+        self._add_sequence_errors(batch)
+
+    def _add_sequence_errors(self, mrnas):
+        sequences = [mrna.sequence for mrna in mrnas]
+        for mrna, errors in zip(mrnas, codon_scan.scan_coding_sequences(sequences)):
+            mrna.errors = errors
+            mrna_id = mrna.feature_name
             if mrna.errors != {}:
-                gene_id = self.get_gene_id(mrna_id)
-                owner = self.get_parent_owner(mrna_id)
-
-                gene_name, locus = self.gene_meta_info[gene_id]
-                arguments = dict()
-                arguments["owner"] = owner
-                arguments["organism_name"] = self.gene_organism.get(gene_id)
-                if not arguments["organism_name"]:
-                    arguments["organism_name"] = any_organism
-                arguments["gene_id"] = gene_id
-                arguments["mrna_id"] = mrna_id
-                arguments["gene_name"] = gene_name
-                arguments["locus"] = locus
+                if mrna_id in self.lineage_errors:
+                    continue
+                arguments = self._get_error_arguments(mrna_id)
 
                 for key, value in mrna.errors.items():
                     arguments["error_name"] = key
@@ -358,6 +761,90 @@ class HandleGFF:
             )
 
 
+def filter_gff_features(file_handle) -> Iterator[Tuple]:
+    """Yield (line_number, fields, extracted fields) for the allowed gff features.
+
+    Features that are not allowed are dropped together with all their
+    descendants. Lines that are not gff features are yielded with empty fields
+    so the reader knows that a gene block has ended.
+    """
+    return filter_numbered_gff_features(enumerate(file_handle, 1))
+
+
+def filter_numbered_gff_features(numbered_lines) -> Iterator[Tuple]:
+    """Same as filter_gff_features, for (line_number, line) pairs."""
+    disqualified_features = set()
+    for line_number, line in numbered_lines:
+        fields = line.rstrip().split("\t")
+        if len(fields) != 9:
+            yield line_number, None, None
+            continue
+
+        gff_fields = extract_fields_from_gff(fields)
+        feature_type, _, _, _, feature_id, parent_id, _, _, _, _, _ = gff_fields
+        if (
+            feature_type not in allowed_feature
+            or feature_id in disqualified_features
+            or parent_id in disqualified_features
+        ):
+            disqualified_features.add(feature_id)
+            continue
+
+        yield line_number, fields, gff_fields
+
+
+def split_gene_blocks(gff_features: Iterator[Tuple]) -> Iterator[List[Tuple]]:
+    """Group the lines from filter_gff_features by gene (or pseudogene) block.
+
+    A block starts with a top level feature and ends before the next one, or
+    with the first line that is not a gff feature.
+    """
+    block_lines = list()
+    for gff_line in gff_features:
+        _, fields, gff_fields = gff_line
+        if fields and gff_fields[0] in top_level_feat and block_lines:
+            yield block_lines
+            block_lines = list()
+        block_lines.append(gff_line)
+        if not fields:
+            yield block_lines
+            block_lines = list()
+    if block_lines:
+        yield block_lines
+
+
+def _get_block_lineage(block_lines: List[Tuple]) -> Tuple[set, set]:
+    """Return the feature ids of a block, and the parent ids that are not in it."""
+    block_ids = set()
+    parent_ids = set()
+    for _, fields, gff_fields in block_lines:
+        if fields:
+            block_ids.add(gff_fields[4])
+            if gff_fields[5]:
+                parent_ids.add(gff_fields[5])
+    return block_ids, parent_ids - block_ids
+
+
+def _drop_orphan_features(gff_lines: List[Tuple], missing_ids: set) -> List[Tuple]:
+    """Remove the features descending from a parent that could not be found."""
+    orphan_ids = set(missing_ids)
+    orphan_count = -1
+    while orphan_count != len(orphan_ids):
+        orphan_count = len(orphan_ids)
+        for _, fields, gff_fields in gff_lines:
+            if fields and gff_fields[5] in orphan_ids:
+                orphan_ids.add(gff_fields[4])
+
+    kept_lines = list()
+    for gff_line in gff_lines:
+        _, fields, gff_fields = gff_line
+        if fields and gff_fields[5] in orphan_ids:
+            print(f"No parent found for {gff_fields[0]}: {gff_fields[4]}")
+            continue
+        kept_lines.append(gff_line)
+    return kept_lines
+
+
 def parse_attribs(attribs_field: str) -> Dict:
     """Returns the attribs as a Dict."""
     attribs_str = attribs_field.split(";")
@@ -380,6 +867,7 @@ def extract_fields_from_gff(fields: List) -> Dict:
     owner = attribs.get("owner")
     name = attribs.get("Name")
     status = attribs.get("status")
+    last_modified = attribs.get("date_last_modified")
     partial = False
     if (
         attribs.get("is_fmax_partial", "") == "true"
@@ -403,6 +891,7 @@ def extract_fields_from_gff(fields: List) -> Dict:
             locus,
             status,
             partial,
+            last_modified,
         )
     else:
         return False
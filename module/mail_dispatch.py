@@ -0,0 +1,310 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+import requests
+
+from module import annotation_quality_report as report, web_session
+
+RATE_LIMITED_DELAY = 1.0
+
+
+class TokenBucket:
+    """Let rate sends per second through, with bursts of up to burst sends.
+
+    Without a rate, only the pauses asked by a 429 answer slow the sends
+    down. A pause holds all the threads, as Mailgun limits the whole domain.
+    """
+
+    def __init__(self, rate=None, burst=None) -> None:
+        self.rate = rate
+        self.capacity = burst or max(rate or 1, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self.tokens = min(
+                        self.capacity, self.tokens + (now - self.updated) * self.rate
+                    )
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds) -> None:
+        with self.lock:
+            paused_until = time.monotonic() + seconds
+            if paused_until > self.paused_until:
+                self.paused_until = paused_until
+                # No burst after the pause
+                self.tokens = 0
+                self.updated = paused_until
+
+
+def retry_after_seconds(response, default) -> float:
+    """The seconds to wait from the Retry-After header, in seconds or as a date."""
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return default
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class MailgunDispatcher:
+    """Send the emails through Mailgun, several at a time, within a rate limit.
+
+    The sends share a pooled session. A 429 answer pauses all the sends for
+    its Retry-After, then the email or batch is sent again, up to retries
+    times. Each email gets a delivery, a dict with its user_id, address,
+    status, HTTP status, attempts, Mailgun message id and error.
+    """
+
+    def __init__(
+        self,
+        url,
+        api_key,
+        from_address,
+        workers=1,
+        rate=None,
+        burst=None,
+        timeout=None,
+        retries=3,
+    ) -> None:
+        self.url = url
+        self.api_key = api_key
+        self.from_address = from_address
+        self.workers = max(int(workers), 1)
+        self.timeout = timeout
+        self.retries = retries
+        self.token_bucket = TokenBucket(rate, burst)
+        # A failed POST may have been sent, only the 429 answers are sent again
+        self.session = web_session.create_session(pool_size=self.workers, retries=0)
+        self.stats = {"sent": 0, "failed": 0, "rate_limited": 0, "batches": 0}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def send(
+        self,
+        user_id,
+        email_address,
+        moderator_email_address,
+        subject,
+        message,
+        attachment=None,
+    ):
+        """Send one email, with the attachment text if any, return its delivery."""
+        delivery = _new_delivery(user_id, email_address)
+        self._deliver(
+            [delivery],
+            lambda: report.send_email_mailgun(
+                self.url,
+                self.api_key,
+                self.from_address,
+                email_address,
+                moderator_email_address,
+                subject,
+                message,
+                session=self.session,
+                timeout=self.timeout,
+                attachment=attachment,
+            ),
+        )
+        return delivery
+
+    def send_batch(self, emails):
+        """Send emails with the same subject and bcc in one batch call.
+
+        The emails are send() arguments, without attachment. Return their
+        deliveries, that share the status of the call. Once the batch is
+        sent, the bcc gets all its messages in one email of its own.
+        """
+        deliveries = [_new_delivery(email[0], email[1]) for email in emails]
+        moderator_email_address, subject = emails[0][2:4]
+        recipients = [(email[1], email[4]) for email in emails]
+        self._deliver(
+            deliveries,
+            lambda: report.send_batch_mailgun(
+                self.url,
+                self.api_key,
+                self.from_address,
+                recipients,
+                subject,
+                session=self.session,
+                timeout=self.timeout,
+            ),
+        )
+        if moderator_email_address and deliveries[0]["status"] == "sent":
+            self._deliver(
+                [_new_delivery(None, moderator_email_address)],
+                lambda: report.send_email_mailgun(
+                    self.url,
+                    self.api_key,
+                    self.from_address,
+                    moderator_email_address,
+                    None,
+                    subject,
+                    report.batch_moderator_copy(recipients),
+                    session=self.session,
+                    timeout=self.timeout,
+                ),
+                counted=False,
+            )
+        return deliveries
+
+    def _deliver(self, deliveries, post, counted=True) -> None:
+        attempts = 0
+        status = "failed"
+        http_status = None
+        message_id = None
+        error = None
+        while True:
+            self.token_bucket.acquire()
+            attempts += 1
+            try:
+                response = post()
+            except requests.RequestException as request_error:
+                error = str(request_error)
+                break
+            if response is None:
+                error = "no response"
+                break
+            http_status = response.status_code
+            if response.status_code == 429 and attempts <= self.retries:
+                delay = retry_after_seconds(
+                    response, RATE_LIMITED_DELAY * 2 ** (attempts - 1)
+                )
+                with self.lock:
+                    self.stats["rate_limited"] += 1
+                self.token_bucket.pause(delay)
+                continue
+            if response.ok:
+                status = "sent"
+                error = None
+                try:
+                    message_id = response.json().get("id")
+                except ValueError:
+                    pass
+            else:
+                error = response.text[:200]
+            break
+
+        for delivery in deliveries:
+            delivery.update(
+                status=status,
+                http_status=http_status,
+                attempts=attempts,
+                message_id=message_id,
+                error=error,
+            )
+        if counted:
+            with self.lock:
+                self.stats[status] += len(deliveries)
+                if len(deliveries) > 1:
+                    self.stats["batches"] += 1
+        if status != "sent":
+            addresses = ", ".join(delivery["to"] for delivery in deliveries)
+            print(f"Failed to send to {addresses}: {error}")
+
+    def send_all(self, emails, on_delivery=None, batch_size=None):
+        """Send the emails, a list of the send() arguments, return their deliveries.
+
+        With a batch_size, the emails without attachment are sent in batch
+        calls of up to batch_size recipients. on_delivery is called with
+        each delivery as it comes, in the calling thread, and the deliveries
+        are returned in the order of the emails.
+        """
+        if batch_size:
+            groups = report.split_mailgun_batches(emails, batch_size)
+        else:
+            groups = [[index] for index in range(len(emails))]
+        deliveries = [None] * len(emails)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = dict()
+            for group in groups:
+                if len(group) == 1:
+                    future = executor.submit(
+                        lambda email: [self.send(*email)], emails[group[0]]
+                    )
+                else:
+                    future = executor.submit(
+                        self.send_batch, [emails[index] for index in group]
+                    )
+                futures[future] = group
+            for future in as_completed(futures):
+                for index, delivery in zip(futures[future], future.result()):
+                    deliveries[index] = delivery
+                    if on_delivery is not None:
+                        on_delivery(delivery)
+        return deliveries
+
+
+def _new_delivery(user_id, email_address):
+    return {
+        "user_id": user_id,
+        "to": email_address,
+        "status": "failed",
+        "http_status": None,
+        "attempts": 0,
+        "message_id": None,
+        "error": None,
+    }
+
+
+def write_delivery_report(deliveries, report_path) -> None:
+    """Write the deliveries as a json list, with a count of each status."""
+    report_path = Path(report_path)
+    statuses = dict()
+    for delivery in deliveries:
+        statuses[delivery["status"]] = statuses.get(delivery["status"], 0) + 1
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = Path(str(report_path) + ".tmp")
+    with temp_path.open("w") as report_file:
+        json.dump(
+            {"statuses": statuses, "deliveries": deliveries}, report_file, indent=1
+        )
+    os.replace(temp_path, report_path)
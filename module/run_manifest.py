@@ -0,0 +1,74 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import json
+import os
+import time
+from pathlib import Path
+
+
+class RunManifest:
+    """The checkpoints of a run, saved after each change so a run can be resumed.
+
+    Each stage of the pipeline has a done flag and the items it completed,
+    e.g. the downloaded organisms or the users an email was sent to. With
+    resume, the manifest of the last run is loaded, unless that run
+    finished: the stages done are then skipped, and so are the items done
+    in the stage the run stopped at.
+    """
+
+    def __init__(self, manifest_path, resume=False) -> None:
+        self.manifest_path = Path(manifest_path)
+        self.resumed = False
+        self.run = {"started": time.time(), "finished": None, "stages": dict()}
+        if resume and self.manifest_path.exists():
+            with self.manifest_path.open("r") as manifest_file:
+                last_run = json.load(manifest_file)
+            if last_run["finished"] is None:
+                self.run = last_run
+                self.resumed = True
+        self.save()
+
+    def _get_stage(self, stage):
+        if stage not in self.run["stages"]:
+            self.run["stages"][stage] = {"done": False, "items": dict()}
+        return self.run["stages"][stage]
+
+    def is_done(self, stage) -> bool:
+        return stage in self.run["stages"] and self.run["stages"][stage]["done"]
+
+    def set_done(self, stage) -> None:
+        self._get_stage(stage)["done"] = True
+        self.save()
+
+    def get_items(self, stage):
+        if stage not in self.run["stages"]:
+            return dict()
+        return self.run["stages"][stage]["items"]
+
+    def add_item(self, stage, key, value=True) -> None:
+        self._get_stage(stage)["items"][key] = value
+        self.save()
+
+    def finish(self) -> None:
+        self.run["finished"] = time.time()
+        self.save()
+
+    def save(self) -> None:
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = Path(str(self.manifest_path) + ".tmp")
+        with temp_path.open("w") as manifest_file:
+            json.dump(self.run, manifest_file, indent=1)
+        os.replace(temp_path, self.manifest_path)
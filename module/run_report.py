@@ -0,0 +1,324 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+metric_prefix = "apollo_report"
+stage_names = (
+    "download",
+    "parse",
+    "structural_scan",
+    "sequence_scan",
+    "summary_render",
+    "error_render",
+    "address_lookup",
+    "send",
+)
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident memory of the process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in KB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def stage(run_report, name):
+    """Measure a stage with run_report, or nothing if it is None."""
+    if run_report is None:
+        return contextlib.nullcontext(dict())
+    return run_report.stage(name)
+
+
+class RunReport:
+    """Wall time, counts and peak memory of each stage of a run.
+
+    A stage is measured with "with run_report.stage(name) as counts:", the
+    counts dict taking what the stage wants to report (items, bytes). A
+    stage run more than once, like the send of each email, adds up.
+    """
+
+    def __init__(self, profiler=None) -> None:
+        self.started = time.time()
+        self.finished = None
+        self.status = "running"
+        self.stages = dict()
+        self.profiler = profiler
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        counts = dict()
+        profile = contextlib.nullcontext()
+        if self.profiler is not None:
+            profile = self.profiler.profile(name)
+        start = time.perf_counter()
+        try:
+            with profile:
+                yield counts
+        finally:
+            self.add(name, time.perf_counter() - start, counts)
+
+    def add(self, name, seconds, counts=None) -> None:
+        if name not in self.stages:
+            self.stages[name] = {"seconds": 0.0, "calls": 0, "counts": dict()}
+        stage_report = self.stages[name]
+        stage_report["seconds"] += seconds
+        stage_report["calls"] += 1
+        stage_report["peak_rss_bytes"] = peak_rss_bytes()
+        for key, value in (counts or dict()).items():
+            stage_report["counts"][key] = stage_report["counts"].get(key, 0) + value
+
+    def finish(self, status="finished") -> None:
+        self.finished = time.time()
+        self.status = status
+
+    def to_dict(self):
+        finished = self.finished or time.time()
+        return {
+            "started": self.started,
+            "finished": self.finished,
+            "status": self.status,
+            "seconds": finished - self.started,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "stages": self.stages,
+        }
+
+    def format(self) -> str:
+        lines = [f"{'stage':<20}{'seconds':>10}{'calls':>8}  counts"]
+        for name, stage_report in self.stages.items():
+            counts = ", ".join(
+                f"{key}={value}" for key, value in stage_report["counts"].items()
+            )
+            lines.append(
+                f"{name:<20}{stage_report['seconds']:>10.2f}"
+                f"{stage_report['calls']:>8}  {counts}"
+            )
+        return "\n".join(lines)
+
+    def write_json(self, json_path) -> None:
+        _write_atomic(json_path, json.dumps(self.to_dict(), indent=1) + "\n")
+
+    def write_prometheus(self, textfile_path) -> None:
+        """Write the report in the Prometheus text format, for a textfile collector."""
+        run = self.to_dict()
+        lines = list()
+
+        def add_metric(name, help_text, samples):
+            metric = f"{metric_prefix}_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for labels, value in samples:
+                label_text = ",".join(
+                    f'{key}="{_escape_label(label)}"' for key, label in labels
+                )
+                if label_text:
+                    label_text = "{" + label_text + "}"
+                lines.append(f"{metric}{label_text} {value}")
+
+        add_metric(
+            "run_seconds", "Wall time of the last run.", [((), run["seconds"])]
+        )
+        add_metric(
+            "run_finished",
+            "1 if the last run finished, 0 if it failed.",
+            [((), int(self.status == "finished"))],
+        )
+        add_metric(
+            "run_timestamp_seconds",
+            "Start time of the last run.",
+            [((), run["started"])],
+        )
+        add_metric(
+            "peak_rss_bytes",
+            "Peak resident memory of the run.",
+            [((), run["peak_rss_bytes"])],
+        )
+        add_metric(
+            "stage_seconds",
+            "Wall time of each stage.",
+            [
+                ((("stage", name),), stage_report["seconds"])
+                for name, stage_report in self.stages.items()
+            ],
+        )
+        add_metric(
+            "stage_peak_rss_bytes",
+            "Peak resident memory at the end of each stage.",
+            [
+                ((("stage", name),), stage_report["peak_rss_bytes"])
+                for name, stage_report in self.stages.items()
+            ],
+        )
+        add_metric(
+            "stage_count",
+            "Items counted by each stage.",
+            [
+                ((("stage", name), ("item", key)), value)
+                for name, stage_report in self.stages.items()
+                for key, value in stage_report["counts"].items()
+            ],
+        )
+        _write_atomic(textfile_path, "\n".join(lines) + "\n")
+
+
+class StageProfiler:
+    """cProfile and tracemalloc over the stages of a RunReport.
+
+    Only the stages in stages are profiled, all of them by default. A stage
+    run more than once adds up in the same profile. The threads started
+    during a stage, like those of its worker pools, are profiled with it up
+    to its end; before Python 3.12, the threads of a pool started before
+    the stage are not.
+    The times include the tracemalloc overhead, they are only comparable
+    between profiled runs.
+    """
+
+    def __init__(self, profile_dir, stages=None, top=20) -> None:
+        self.profile_dir = Path(profile_dir)
+        self.stages = set(stages) if stages else None
+        self.top = top
+        self.profiles = dict()
+        self.allocations = dict()
+        self.peaks = dict()
+        self.thread_stats = dict()
+        self._thread_profiles = list()
+        self._lock = threading.Lock()
+        self._active = False
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        # A single profiler can be active, an inner stage is part of the outer one
+        if self._active or (self.stages is not None and name not in self.stages):
+            yield
+            return
+
+        self._active = True
+        if name not in self.profiles:
+            self.profiles[name] = cProfile.Profile()
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start_snapshot = tracemalloc.take_snapshot()
+        # From Python 3.12, cProfile uses sys.monitoring and sees all the threads
+        profile_threads = sys.version_info < (3, 12)
+        if profile_threads:
+            threading.setprofile(self._start_thread_profile)
+        self.profiles[name].enable()
+        try:
+            yield
+        finally:
+            self.profiles[name].disable()
+            if profile_threads:
+                threading.setprofile(None)
+            with self._lock:
+                thread_profiles, self._thread_profiles = self._thread_profiles, list()
+            # A thread still running after the stage is not counted any more
+            self.thread_stats.setdefault(name, list()).extend(
+                pstats.Stats(profile) for profile in thread_profiles
+            )
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+            self._active = False
+            self.peaks[name] = max(self.peaks.get(name, 0), peak)
+            self._add_allocations(name, snapshot.compare_to(start_snapshot, "lineno"))
+
+    def _start_thread_profile(self, *args) -> None:
+        """Profile a thread started during the stage, from its first call."""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return  # Another profiler is active, the thread is left out
+        with self._lock:
+            self._thread_profiles.append(profile)
+
+    def get_stats(self, name) -> pstats.Stats:
+        """The profile of a stage, with those of its threads."""
+        stats = pstats.Stats(self.profiles[name])
+        for thread_stats in self.thread_stats.get(name, list()):
+            stats.add(thread_stats)
+        return stats
+
+    def _add_allocations(self, name, statistic_diffs) -> None:
+        allocations = self.allocations.setdefault(name, dict())
+        for statistic in statistic_diffs:
+            frame = statistic.traceback[0]
+            if frame.filename == tracemalloc.__file__:
+                continue
+            location = f"{frame.filename}:{frame.lineno}"
+            size, count = allocations.get(location, (0, 0))
+            allocations[location] = (
+                size + statistic.size_diff,
+                count + statistic.count_diff,
+            )
+
+    def write(self) -> None:
+        """Write <stage>.prof and <stage>.allocations.txt for each profiled stage."""
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        for name in self.profiles:
+            self.get_stats(name).dump_stats(str(self.profile_dir / f"{name}.prof"))
+            lines = [
+                f"Stage {name}: traced memory peak {self.peaks[name] / 1e6:.1f} MB",
+                f"Top {self.top} allocation sites still held at the end of the stage:",
+            ]
+            top_allocations = sorted(
+                self.allocations[name].items(), key=lambda item: -item[1][0]
+            )[: self.top]
+            for location, (size, count) in top_allocations:
+                lines.append(f"{size / 1e6:>10.2f} MB {count:>10} blocks  {location}")
+            (self.profile_dir / f"{name}.allocations.txt").write_text(
+                "\n".join(lines) + "\n"
+            )
+
+    def format_summary(self, count=5) -> str:
+        """The functions with the most own time in each profiled stage."""
+        lines = list()
+        for name in self.profiles:
+            stats = self.get_stats(name).stats
+            lines.append(f"{name} (peak {self.peaks[name] / 1e6:.1f} MB):")
+            hot_functions = sorted(stats.items(), key=lambda item: -item[1][2])
+            for (file_name, line, function), timing in hot_functions[:count]:
+                calls, own_time, total_time = timing[1], timing[2], timing[3]
+                lines.append(
+                    f"  {own_time:>8.3f}s own {total_time:>8.3f}s total"
+                    f" {calls:>9} calls  {Path(file_name).name}:{line}({function})"
+                )
+        return "\n".join(lines)
+
+
+def _escape_label(label) -> str:
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(path, text) -> None:
+    # The collectors must never read a half written file
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = Path(str(path) + ".tmp")
+    temp_path.write_text(text)
+    os.replace(temp_path, path)
@@ -0,0 +1,146 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import sqlite3
+import time
+from pathlib import Path
+
+COMMIT_EVERY = 500
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class SequenceCache:
+    """Coding sequences kept on disk between runs, in a sqlite file.
+
+    A sequence is stored by organism, scaffold and mRNA id along with a
+    version string, built from the date_last_modified of the gene. A lookup
+    with another version is a miss, the sequence is then fetched again and
+    replaces the old one. When the cache is closed, the entries not used for
+    max_age_days are removed, then the least recently used ones until there
+    are no more than max_entries.
+    """
+
+    def __init__(self, cache_path, max_entries=None, max_age_days=None) -> None:
+        self.cache_path = Path(cache_path)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self._pending = 0
+
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.cache_path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cds ("
+            " organism TEXT NOT NULL,"
+            " scaffold TEXT NOT NULL,"
+            " mrna_id TEXT NOT NULL,"
+            " version TEXT NOT NULL,"
+            " sequence TEXT NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (organism, scaffold, mrna_id))"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS cds_last_used ON cds (last_used)"
+        )
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM cds").fetchone()[0]
+
+    def get(self, organism, scaffold, mrna_id, version):
+        """Return the cached sequence, or None if it is missing or out of date."""
+        row = self.connection.execute(
+            "SELECT version, sequence FROM cds"
+            " WHERE organism = ? AND scaffold = ? AND mrna_id = ?",
+            (organism, scaffold, mrna_id),
+        ).fetchone()
+        if row is None or row[0] != version:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute(
+            "UPDATE cds SET last_used = ?"
+            " WHERE organism = ? AND scaffold = ? AND mrna_id = ?",
+            (time.time(), organism, scaffold, mrna_id),
+        )
+        self._count_change()
+        return row[1]
+
+    def put(self, organism, scaffold, mrna_id, version, sequence) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cds"
+            " (organism, scaffold, mrna_id, version, sequence, last_used)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (organism, scaffold, mrna_id, version, sequence, time.time()),
+        )
+        self.stored += 1
+        self._count_change()
+
+    def _count_change(self) -> None:
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self.connection.commit()
+            self._pending = 0
+
+    def evict(self) -> int:
+        """Remove the old and the least recently used entries, return their count."""
+        evicted = 0
+        if self.max_age_days is not None:
+            oldest_use = time.time() - self.max_age_days * SECONDS_PER_DAY
+            cursor = self.connection.execute(
+                "DELETE FROM cds WHERE last_used < ?", (oldest_use,)
+            )
+            evicted += cursor.rowcount
+        if self.max_entries is not None:
+            extra_entries = len(self) - self.max_entries
+            if extra_entries > 0:
+                cursor = self.connection.execute(
+                    "DELETE FROM cds WHERE rowid IN"
+                    " (SELECT rowid FROM cds ORDER BY last_used LIMIT ?)",
+                    (extra_entries,),
+                )
+                evicted += cursor.rowcount
+        self.connection.commit()
+        self.evicted += evicted
+        return evicted
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stored": self.stored,
+            "evicted": self.evicted,
+        }
+
+    def close(self) -> None:
+        if self.connection is None:
+            return
+        self.evict()
+        print(
+            f"CDS cache {self.cache_path}: {self.hits} hits, {self.misses} misses,"
+            f" {self.stored} stored, {self.evicted} evicted"
+        )
+        self.connection.close()
+        self.connection = None
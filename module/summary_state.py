@@ -0,0 +1,123 @@
+"""
+Copyright [2017-2020] EMBL-European Bioinformatics Institute
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+import json
+import math
+import os
+import time
+from pathlib import Path
+from typing import Dict, List
+from module.annotator import AnnotatorSummary
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class SummaryState:
+    """The annotations of each gene in the annotator summaries, kept between runs.
+
+    For each gene id, the state has its organism and the (owner, kind, name,
+    finished) annotations it adds to the summaries, from
+    HandleGFF.gene_summaries. The summaries are the same whatever the order
+    the genes are added in, so a run only has to replace the genes changed
+    since the last one to get the summaries of a full read.
+    """
+
+    def __init__(self, state_path) -> None:
+        self.state_path = Path(state_path)
+        self.updated = None
+        self.genes = dict()
+        if self.state_path.exists():
+            with self.state_path.open("r") as state_file:
+                state = json.load(state_file)
+            self.updated = state["updated"]
+            self.genes = state["genes"]
+
+    @property
+    def annotators(self) -> Dict[str, AnnotatorSummary]:
+        annotators = dict()
+        for gene in self.genes.values():
+            for owner, kind, name, finished in gene["summary"]:
+                if owner not in annotators:
+                    annotators[owner] = AnnotatorSummary(owner)
+                annotators[owner].add(kind, name, finished)
+        return annotators
+
+    def is_empty(self) -> bool:
+        return self.updated is None
+
+    def age_days(self, now=None) -> float:
+        now = now or time.time()
+        return (now - self.updated) / SECONDS_PER_DAY
+
+    def recent_days(self, now=None) -> int:
+        """Days of recent annotations that cover the time since the last update."""
+        return max(math.ceil(self.age_days(now)), 1)
+
+    def rebuild(self, gene_summaries, gene_organism, update_time) -> None:
+        """Replace the whole state with the genes of a full read."""
+        self.genes = dict()
+        self._set_genes(gene_summaries, gene_organism)
+        self.updated = update_time
+
+    def update(
+        self, gene_summaries, gene_organism, organisms, update_time
+    ) -> List[str]:
+        """Replace the genes of organisms with those of a new read of them.
+
+        A gene of organisms that is not in gene_summaries any more is
+        deleted. Returns the deleted gene ids.
+        """
+        organisms = set(organisms)
+        deleted_genes = [
+            gene_id
+            for gene_id, gene in self.genes.items()
+            if gene["organism"] in organisms and gene_id not in gene_summaries
+        ]
+        for gene_id in deleted_genes:
+            del self.genes[gene_id]
+        self._set_genes(gene_summaries, gene_organism)
+        self.updated = update_time
+        return deleted_genes
+
+    def _set_genes(self, gene_summaries, gene_organism) -> None:
+        for gene_id, gene_summary in gene_summaries.items():
+            if gene_id is None:
+                continue  # Annotation that could not be linked to a gene
+            self.genes[gene_id] = {
+                "organism": gene_organism.get(gene_id),
+                "summary": [list(annotation) for annotation in gene_summary],
+            }
+
+    def compare(self, annotators: Dict[str, AnnotatorSummary]) -> List[str]:
+        """Return the owners whose summary differs from those of annotators."""
+        state_annotators = self.annotators
+        different_owners = list()
+        for owner in sorted(set(state_annotators) | set(annotators)):
+            state_summary = state_annotators.get(owner)
+            summary = annotators.get(owner)
+            if (
+                state_summary is None
+                or summary is None
+                or vars(state_summary) != vars(summary)
+            ):
+                different_owners.append(owner)
+        return different_owners
+
+    def save(self) -> None:
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = Path(str(self.state_path) + ".tmp")
+        with temp_path.open("w") as state_file:
+            json.dump({"updated": self.updated, "genes": self.genes}, state_file)
+        os.replace(temp_path, self.state_path)
@@ -11,9 +11,16 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import requests
 import re
 import urllib.parse
+from module import codon_scan, fasta_file, web_session
+
+complement_table = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+genome_extensions = (".fa", ".fasta", ".fna")
 
 
 class CodingSequence:
@@ -27,37 +34,30 @@ class CodingSequence:
         self.sequence = str()
 
     def get_sequence(
-        self, base_url=None, username=None, password=None, fasta_file=None
+        self,
+        base_url=None,
+        username=None,
+        password=None,
+        fasta_file=None,
+        genome=None,
+        strand=None,
+        cds_segments=None,
+        session=None,
+        timeout=None,
     ):
-        if base_url:
-            url = urllib.parse.urljoin(base_url, "sequence/sequenceByName")
-            body = {
-                "username": username,
-                "password": password,
-                "organismString": self.organism_name,
-                "sequenceName": self.sequence_name,
-                "featureName": self.feature_name,
-                "type": CodingSequence.sequence_type,
-                "ignoreCache": "true",
-            }
-
-            response = requests.post(url, json=body)
-            seq = response.text
-            if response.status_code == requests.codes.ok:
-                matches = re.match(r"^([CTGAN]+)<", seq)
-                if matches:
-                    print(f"Remove weird html part at the end of {self.feature_name}")
-                    print(f"[{seq}]")
-                    seq = matches[1]
-                if not re.match(r"^[CGTAN]+$", seq):
-                    print(f"Incorrect CDS sequence: [{seq}]")
-                    return False
-                self.sequence = seq
-            else:
-                print(
-                    f"No sequence retrieved for {self.feature_name}: code {response.status_code}"
-                )
+        if genome:
+            seq = genome.get_cds_sequence(
+                self.organism_name, self.sequence_name, strand, cds_segments
+            )
+            if not seq:
+                print(f"No genome sequence could be used for {self.feature_name}")
                 return False
+            self.sequence = seq
+        elif base_url:
+            url = urllib.parse.urljoin(base_url, "sequence/sequenceByName")
+            body = self.get_request_body(username, password)
+            response = (session or requests).post(url, json=body, timeout=timeout)
+            return self.set_sequence_from_response(response)
         elif fasta_file:
             with open(fasta_file, "r") as file_handle:
                 for seq in file_handle:
@@ -66,6 +66,35 @@ class CodingSequence:
         else:
             return False
 
+    def get_request_body(self, username, password):
+        return {
+            "username": username,
+            "password": password,
+            "organismString": self.organism_name,
+            "sequenceName": self.sequence_name,
+            "featureName": self.feature_name,
+            "type": CodingSequence.sequence_type,
+            "ignoreCache": "true",
+        }
+
+    def set_sequence_from_response(self, response):
+        seq = response.text
+        if response.status_code == requests.codes.ok:
+            matches = re.match(r"^([CTGAN]+)<", seq)
+            if matches:
+                print(f"Remove weird html part at the end of {self.feature_name}")
+                print(f"[{seq}]")
+                seq = matches[1]
+            if not re.match(r"^[CGTAN]+$", seq):
+                print(f"Incorrect CDS sequence: [{seq}]")
+                return False
+            self.sequence = seq
+        else:
+            print(
+                f"No sequence retrieved for {self.feature_name}: code {response.status_code}"
+            )
+            return False
+
     def coding_sequence_has_start_codon(self):
         if self.sequence[0:3] == "ATG":
             return True
@@ -82,15 +111,189 @@ class CodingSequence:
             return False
 
     def coding_sequence_no_internal_stop_codon(self):
-        internal_stop_codon_count = 0
-        for i in range(0, len(self.sequence) - 3, 3):
-            codon = self.sequence[i : i + 3]
-            if codon == "TAA" or codon == "TAG" or codon == "TGA":
-                internal_stop_codon_count += 1
-                self.errors["no_internal_stop_codon"] = (
-                    str(internal_stop_codon_count) + " internal stop codon"
-                )
+        internal_stop_codon_count = codon_scan.count_internal_stop_codons(
+            self.sequence
+        )
         if internal_stop_codon_count:
+            self.errors["no_internal_stop_codon"] = (
+                str(internal_stop_codon_count) + " internal stop codon"
+            )
             return False
         else:
             return True
+
+    def coding_sequence_in_frame(self):
+        if len(self.sequence) % 3:
+            self.errors["frame"] = codon_scan.frame_error_text(len(self.sequence))
+            return False
+        else:
+            return True
+
+
+class ApolloSequenceFetcher:
+    """Retrieve coding sequences from Apollo, several requests at a time.
+
+    All requests go through one pooled session that retries failed
+    connections and 429/5xx answers. The sequences come back in the order
+    of the transcripts, at most chunk_size of them are held at once.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        username,
+        password,
+        workers=1,
+        timeout=None,
+        retries=3,
+        backoff_factor=0.5,
+        chunk_size=None,
+    ):
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.workers = max(int(workers), 1)
+        self.timeout = timeout
+        self.chunk_size = chunk_size or self.workers * 16
+        self.session = web_session.create_session(
+            pool_size=self.workers, retries=retries, backoff_factor=backoff_factor
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def fetch_sequence(self, mrna: CodingSequence) -> CodingSequence:
+        if mrna.sequence:
+            return mrna  # Already known, e.g. from a SequenceCache
+        try:
+            mrna.get_sequence(
+                base_url=self.base_url,
+                username=self.username,
+                password=self.password,
+                session=self.session,
+                timeout=self.timeout,
+            )
+        except requests.RequestException as error:
+            print(f"No sequence retrieved for {mrna.feature_name}: {error}")
+        return mrna
+
+    def fetch(self, mrnas):
+        """Yield each CodingSequence of mrnas once its sequence is retrieved."""
+        if self.workers == 1:
+            for mrna in mrnas:
+                yield self.fetch_sequence(mrna)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            chunk = list()
+            for mrna in mrnas:
+                chunk.append(mrna)
+                if len(chunk) == self.chunk_size:
+                    yield from executor.map(self.fetch_sequence, chunk)
+                    chunk = list()
+            yield from executor.map(self.fetch_sequence, chunk)
+
+
+class GenomeSequences:
+    """Assemble coding sequences from a genome fasta file per organism.
+
+    The genome of an organism is looked up in genome_files, then as
+    <organism>.fa, .fasta or .fna in genome_dir. The default_genome is used
+    for the organisms without their own file. Up to max_open genome files
+    are kept open, the least recently used is closed first.
+    """
+
+    def __init__(
+        self, genome_dir=None, genome_files=None, default_genome=None, max_open=4
+    ):
+        self.genome_dir = genome_dir
+        self.genome_files = dict(genome_files or {})
+        self.default_genome = default_genome
+        self.max_open = max(int(max_open), 1)
+        self.organism_genome_files = dict()
+        self.genomes = OrderedDict()
+
+    def get_genome_file(self, organism_name):
+        if organism_name in self.genome_files:
+            return self.genome_files[organism_name]
+        if self.genome_dir:
+            clean_organism_name = organism_name.replace("/", "")
+            for extension in genome_extensions:
+                genome_path = Path(self.genome_dir) / (clean_organism_name + extension)
+                if genome_path.exists():
+                    return genome_path
+        return self.default_genome
+
+    def has_genome(self, organism_name):
+        """Return True if the organism has a genome fasta, it is looked up once."""
+        if organism_name not in self.organism_genome_files:
+            genome_file = self.get_genome_file(organism_name)
+            if not genome_file:
+                print(f"No genome fasta for {organism_name}")
+            self.organism_genome_files[organism_name] = genome_file
+        return bool(self.organism_genome_files[organism_name])
+
+    def get_genome(self, organism_name):
+        """Return the open genome of the organism, or None if it has no fasta."""
+        if not self.has_genome(organism_name):
+            return None
+        # Organisms can share a genome file, like the default_genome
+        genome_file = str(self.organism_genome_files[organism_name])
+        if genome_file in self.genomes:
+            self.genomes.move_to_end(genome_file)
+            return self.genomes[genome_file]
+        if len(self.genomes) >= self.max_open:
+            _, genome = self.genomes.popitem(last=False)
+            genome.close()
+        self.genomes[genome_file] = fasta_file.IndexedFasta(genome_file)
+        return self.genomes[genome_file]
+
+    def get_scaffold(self, organism_name, scaffold):
+        genome = self.get_genome(organism_name)
+        if genome is None or scaffold not in genome:
+            return None
+        return genome[scaffold]
+
+    def close(self):
+        for genome in self.genomes.values():
+            genome.close()
+        self.genomes = OrderedDict()
+
+    def get_cds_sequence(self, organism_name, scaffold, strand, cds_segments):
+        """Return the spliced coding sequence, or None if it can't be assembled.
+
+        cds_segments is a list of (begin, end, phase) in 1-based gff coordinates.
+        """
+        scaffold_sequence = self.get_scaffold(organism_name, scaffold)
+        if scaffold_sequence is None or not cds_segments:
+            return None
+        return splice_cds(scaffold_sequence, strand, cds_segments)
+
+
+def reverse_complement(sequence: str) -> str:
+    return sequence.translate(complement_table)[::-1]
+
+
+def splice_cds(scaffold_sequence, strand, cds_segments) -> str:
+    """Join the CDS segments of a transcript and trim the phase of its first one.
+
+    The scaffold_sequence can be a str or a fasta_file.FastaRecord.
+    """
+    segments = sorted(cds_segments)
+    pieces = [scaffold_sequence[begin - 1 : end] for begin, end, _ in segments]
+    sequence = "".join(pieces).upper()
+
+    if strand == "-":
+        sequence = reverse_complement(sequence)
+        _, _, phase = segments[-1]
+    else:
+        _, _, phase = segments[0]
+    if phase:
+        sequence = sequence[phase:]
+    return sequence
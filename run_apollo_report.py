@@ -13,64 +13,131 @@ limitations under the License.
 """
 import argparse
 import configparser
-import sys
 from module.apollo_reporter import ApolloReporter
+from module.run_report import stage_names
 
-sys.setrecursionlimit(1500)
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description="Check annotations and send reports based on a config file."
-    )
-    parser.add_argument("config_file", help="Config file to use")
-    parser.add_argument(
-        "--nosend", action="store_true", help="Do not send emails (for testing)"
-    )
-    args = parser.parse_args()
 
+def run_pipeline(apollo_reporter, report_config, args):
+    """Run the summary and recent stages set in the PIPELINE config."""
     send_email = not args.nosend
-    config_file = args.config_file
-
-    # Parse config
-    report_config = configparser.ConfigParser()
-    report_config.read(config_file)
-    apollo_reporter = ApolloReporter(report_config)
+    run_manifest = apollo_reporter.load_run_manifest(resume=args.resume)
 
     # Summary annotations
-    if report_config["PIPELINE"]["summary_annotation"] == "yes":
-        gene_to_organism, master_gff = apollo_reporter.prepare_summary_gff()
+    summary_sent = run_manifest.is_done("summary_sent") and run_manifest.is_done(
+        "summary_error_sent"
+    )
+    if report_config["PIPELINE"]["summary_annotation"] == "yes" and not summary_sent:
+        if run_manifest.is_done("summary_written"):
+            emails = apollo_reporter.load_written_emails("summary")
+            error_emails = apollo_reporter.load_written_emails("error")
+        else:
+            summary_state = apollo_reporter.load_summary_state()
+            if summary_state is None:
+                organism_gffs = apollo_reporter.prepare_summary_gff()
+                # Parse the organism gffs once for the summary and the error emails
+                summary_gff_object = apollo_reporter.read_gff(organism_gffs)
+                emails = apollo_reporter.prepare_summary_emails(
+                    summary_gff_object, "summary"
+                )
+            else:
+                # With incremental_summary, only the changed organisms are read
+                summary_gff_object = apollo_reporter.update_summary_state(
+                    summary_state, full_rebuild=args.full_summary
+                )
+                emails = apollo_reporter.prepare_summary_emails(
+                    summary_state, "summary"
+                )
+
+            error_emails = list()
+            if summary_gff_object is not None:
+                error_emails = apollo_reporter.prepare_error_emails(
+                    summary_gff_object, "error"
+                )
+            # Without the spool, a resumed run renders the emails again
+            if apollo_reporter.wait_email_spool():
+                run_manifest.set_done("summary_written")
 
-        emails = apollo_reporter.prepare_summary_emails(
-            master_gff, gene_to_organism, "summary"
-        )
         if send_email:
-            apollo_reporter.send_emails("summary", emails)
+            apollo_reporter.send_emails("summary", emails, "summary_sent")
         else:
             for email in emails:
-                user_id, email_message = email
-                print(f"Summary email not sent to {user_id}")
+                print(f"Summary email not sent to {email.user_id}")
 
-        error_emails = apollo_reporter.prepare_error_emails(
-            master_gff, gene_to_organism, "error"
-        )
         if send_email:
-            apollo_reporter.send_emails("error", error_emails)
+            apollo_reporter.send_emails("error", error_emails, "summary_error_sent")
         else:
             for email in error_emails:
-                user_id, email_message = email
-                print(f"Error email not sent to {user_id}")
+                print(f"Error email not sent to {email.user_id}")
 
     # Recent annotations
-    if report_config["PIPELINE"]["recent_annotation"] == "yes":
-        recent_genes, recent_gff = apollo_reporter.prepare_recent_gff()
+    recent_sent = run_manifest.is_done("recent_error_sent")
+    if report_config["PIPELINE"]["recent_annotation"] == "yes" and not recent_sent:
+        if run_manifest.is_done("recent_written"):
+            error_emails = apollo_reporter.load_written_emails("error")
+        else:
+            recent_genes, recent_gff = apollo_reporter.prepare_recent_gff()
+            error_emails = list()
+            if recent_genes:
+                recent_gff_object = apollo_reporter.read_gff(recent_gff, recent_genes)
 
-        # Write error emails
-        error_emails = apollo_reporter.prepare_error_emails(
-            recent_gff, recent_genes, "error"
-        )
+                # Write error emails
+                error_emails = apollo_reporter.prepare_error_emails(
+                    recent_gff_object, "error"
+                )
+            if apollo_reporter.wait_email_spool():
+                run_manifest.set_done("recent_written")
         if send_email:
-            apollo_reporter.send_emails("error", error_emails)
+            apollo_reporter.send_emails("error", error_emails, "recent_error_sent")
         else:
             for email in error_emails:
-                user_id, email_message = email
-                print(f"Error email not sent to {user_id}")
+                print(f"Error email not sent to {email.user_id}")
+
+    run_manifest.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check annotations and send reports based on a config file."
+    )
+    parser.add_argument("config_file", help="Config file to use")
+    parser.add_argument(
+        "--nosend", action="store_true", help="Do not send emails (for testing)"
+    )
+    parser.add_argument(
+        "--full_summary",
+        action="store_true",
+        help="Read all the organisms to rebuild the summary state and check it",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the last run if it did not finish, skipping the work done",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="*",
+        choices=stage_names,
+        metavar="STAGE",
+        help="Profile the given stages, or all of them, to <dir>/profile: "
+        + ", ".join(stage_names),
+    )
+    args = parser.parse_args()
+
+    config_file = args.config_file
+
+    # Parse config
+    report_config = configparser.ConfigParser()
+    report_config.read(config_file)
+    apollo_reporter = ApolloReporter(report_config)
+    if args.profile is not None:
+        apollo_reporter.enable_profiling(args.profile)
+
+    status = "failed"
+    try:
+        run_pipeline(apollo_reporter, report_config, args)
+        status = "finished"
+    finally:
+        try:
+            apollo_reporter.write_run_report(status)
+        finally:
+            apollo_reporter.close()
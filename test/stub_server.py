@@ -0,0 +1,43 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Base of the test handlers: reads the posted body, answers, does not log."""
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers["Content-Length"]))
+
+    def read_json(self):
+        return json.loads(self.read_body())
+
+    def send_answer(self, status, answer=b"", headers=None) -> None:
+        self.send_response(status)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def send_json(self, data) -> None:
+        self.send_answer(
+            200, json.dumps(data).encode(), {"Content-Type": "application/json"}
+        )
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(test_case, handler_class) -> str:
+    """Serve handler_class until the end of test_case, return the server url.
+
+    The server is shut down and closed by the cleanups of test_case, even
+    when the test fails.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The cleanups run last in first out: shutdown, then server_close
+    test_case.addCleanup(server.server_close)
+    test_case.addCleanup(server.shutdown)
+    return f"http://127.0.0.1:{server.server_address[1]}/"
@@ -1,7 +1,65 @@
 import unittest
 import filecmp
 import datetime
+import gzip
+import os
+import tempfile
+import time
+from pathlib import Path
+import requests
 from module import annotation_quality_report, gff_file
+from module.annotator import AnnotatorSummary
+from stub_server import StubHandler, serve
+
+
+class GzipExportHandler(StubHandler):
+    """Answer with a gzip compressed gff when the client accepts it."""
+
+    gff_text = "##gff-version 3\n" + "chr1\t.\tgene\t1\t10\t.\t+\t.\tID=gene-1\n" * 500
+
+    def do_POST(self):
+        self.read_body()
+        answer = GzipExportHandler.gff_text.encode()
+        headers = dict()
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            answer = gzip.compress(answer)
+            headers["Content-Encoding"] = "gzip"
+        self.send_answer(200, answer, headers)
+
+
+class SlowExportHandler(StubHandler):
+    """Answer with a gff sent a line at a time, a line every 0.1 second."""
+
+    gff_lines = [b"##gff-version 3\n"] + [b"chr1\t.\tgene\t1\t10\t.\t+\t.\n"] * 9
+
+    def do_POST(self):
+        self.read_body()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(b"".join(self.gff_lines))))
+        self.end_headers()
+        for gff_line in self.gff_lines:
+            self.wfile.write(gff_line)
+            self.wfile.flush()
+            time.sleep(0.1)
+
+
+class GeneGffHandler(StubHandler):
+    """Answer getGff3 with a line per gene, the first request for gene-3 fails."""
+
+    failed_genes = set()
+    requests = list()
+
+    def do_POST(self):
+        gene_ids = [feature["uniquename"] for feature in self.read_json()["features"]]
+        GeneGffHandler.requests.append(gene_ids)
+        if "gene-3" in gene_ids and "gene-3" not in GeneGffHandler.failed_genes:
+            GeneGffHandler.failed_genes.add("gene-3")
+            self.send_answer(400)
+            return
+        answer = "##gff-version 3\n" + "".join(
+            f"chr1\t.\tgene\t1\t10\t.\t+\t.\tID={gene_id}\n" for gene_id in gene_ids
+        )
+        self.send_answer(200, answer.encode())
 
 
 class MyTestCase(unittest.TestCase):
@@ -226,6 +284,135 @@ class MyTestCase(unittest.TestCase):
             ),
         )
 
+    def test_validate_parsed_gff(self):
+        false_gff_file = "./input_files/simple_false.gff"
+
+        false_gene_organism = dict()
+        with open("./input_files/simple_organism.tsv") as file_handle:
+            for line in file_handle:
+                gene_id, organism = line.rstrip().split("\t")
+                false_gene_organism[gene_id] = organism
+
+        # The same parsed object is used for the summary and the validation
+        false_gff = gff_file.HandleGFF(false_gff_file, false_gene_organism, "")
+        false_gff.read_gff_file()
+        self.assertEqual(True, "simple@ebi.ac.uk" in false_gff.annotators)
+
+        validated_gff = annotation_quality_report.validate_parsed_gff(
+            None, None, None, false_gff
+        )
+        self.assertIs(false_gff, validated_gff)
+        self.assertEqual(4, len(validated_gff.errors))
+
+    def test_download_gff(self):
+        base_url = serve(self, GzipExportHandler) + "apollo/"
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            stats = dict()
+            gff_file_name = annotation_quality_report.download_gff(
+                base_url, "user", "secret", "org", out_dir + "/", stats=stats
+            )
+            with open(gff_file_name) as gff_file_handle:
+                self.assertEqual(GzipExportHandler.gff_text, gff_file_handle.read())
+
+        self.assertEqual(len(GzipExportHandler.gff_text), stats["written_bytes"])
+        compressed = gzip.compress(GzipExportHandler.gff_text.encode())
+        self.assertEqual(len(compressed), stats["transferred_bytes"])
+        self.assertGreater(stats["throughput"], 0)
+
+    def test_download_gff_deadline(self):
+        base_url = serve(self, SlowExportHandler) + "apollo/"
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            # Each line comes before the timeout, the whole gff does not
+            with self.assertRaises(requests.Timeout):
+                annotation_quality_report.download_gff(
+                    base_url, "user", "secret", "org", out_dir + "/", timeout=0.5
+                )
+            self.assertEqual([], os.listdir(out_dir))
+
+    def test_email_spool(self):
+        summary = AnnotatorSummary("ann.1")
+        summary.total_gene_count = 2
+        summary.finished_gene_count = 1
+        summary.total_mrna_count = 2
+        summary.finished_mrna_count = 1
+        summary.unfinished_mrnas.add("gene-2")
+        message = annotation_quality_report.summary_email(summary)
+        self.assertEqual(
+            [
+                "Dear Annotator (ann.1),\n",
+                "Here is a summary of your annotation in Apollo hosted at"
+                " VEuPathDB.org.\n",
+                "Finished protein-coding genes: 1\n",
+                "Unfinished protein-coding genes: 1\n",
+            ],
+            message.body,
+        )
+        message.footer = ["--\n"]
+        self.assertEqual("--\n", message.lines[-1])
+
+        # The spool gives the same emails back, without the footer
+        with tempfile.TemporaryDirectory() as out_dir:
+            annotation_quality_report.write_email_spool([message], Path(out_dir))
+            self.assertEqual(
+                ["ann.1.gene_list", "ann.1.summary"], sorted(os.listdir(out_dir))
+            )
+            spooled = annotation_quality_report.read_email_spool(
+                Path(out_dir), "summary"
+            )
+        self.assertEqual(1, len(spooled))
+        self.assertEqual("ann.1", spooled[0].user_id)
+        self.assertEqual(message.body, spooled[0].body)
+        self.assertEqual(message.gene_list, spooled[0].gene_list)
+        self.assertEqual([], spooled[0].footer)
+
+    def test_split_mailgun_batches(self):
+        emails = [
+            ("a.1", "a@example.org", "mod@example.org", "Summary", "", ""),
+            ("b.2", "b@example.org", "mod@example.org", "Summary", "", None),
+            ("c.3", "c@example.org", "mod@example.org", "Summary", "", "gene-1\n"),
+            ("d.4", "a@example.org", "mod@example.org", "Summary", "", None),
+            ("e.5", "e@example.org", "mod@example.org", "Summary", "", None),
+            ("f.6", "f@example.org", "mod@example.org", "Errors", "", None),
+        ]
+        groups = annotation_quality_report.split_mailgun_batches(emails, 3)
+        self.assertEqual([[0, 1, 4], [2], [3], [5]], groups)
+
+    def test_get_gff_in_batches(self):
+        GeneGffHandler.failed_genes = set()
+        GeneGffHandler.requests = list()
+        base_url = serve(self, GeneGffHandler) + "apollo/"
+        genes = {f"gene-{index}": "org" for index in range(10)}
+        retry_delay = annotation_quality_report.BATCH_RETRY_DELAY
+        annotation_quality_report.BATCH_RETRY_DELAY = 0
+
+        try:
+            with tempfile.TemporaryDirectory() as out_dir:
+                stats = dict()
+                gff_file_name = annotation_quality_report.get_gff(
+                    base_url,
+                    "user",
+                    "secret",
+                    genes,
+                    out_dir + "/",
+                    stats,
+                    batch_size=4,
+                    workers=3,
+                )
+                with open(gff_file_name) as gff_file_handle:
+                    gff_lines = gff_file_handle.read().splitlines()
+                self.assertEqual([Path(gff_file_name).name], os.listdir(out_dir))
+        finally:
+            annotation_quality_report.BATCH_RETRY_DELAY = retry_delay
+
+        self.assertEqual("##gff-version 3", gff_lines[0])
+        self.assertEqual(
+            list(genes), [line.split("ID=")[1] for line in gff_lines[1:]]
+        )
+        self.assertEqual(4, len(GeneGffHandler.requests))
+        self.assertEqual(3, stats["batches"])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,169 @@
+import argparse
+import configparser
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from module.apollo_reporter import ApolloReporter
+from run_apollo_report import run_pipeline
+from stub_server import StubHandler, serve
+
+
+class ExportStubHandler(StubHandler):
+    """Answer IOService/write with one gene per organism."""
+
+    exports = list()
+    recent_genes = dict()
+
+    def do_POST(self):
+        body = self.read_json()
+        if self.path.endswith("getRecentAnnotations"):
+            self.send_json(ExportStubHandler.recent_genes)
+            return
+        organism = body["organism"]
+        ExportStubHandler.exports.append(organism)
+        if organism == "broken":
+            self.send_answer(500, b"export failed")
+            return
+        if organism == "slow":
+            time.sleep(1)
+        elif organism == "first":
+            time.sleep(0.2)
+        gene_line = (
+            f"chr1\t.\tgene\t1\t10\t.\t+\t.\towner=a@ebi.ac.uk;"
+            f"ID=gene-{organism};Name={organism}\n"
+        )
+        self.send_answer(200, ("##gff-version 3\n" + gene_line).encode())
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        ExportStubHandler.exports = list()
+        ExportStubHandler.recent_genes = dict()
+        self.base_url = serve(self, ExportStubHandler)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_path = Path(temp_dir.name)
+
+    def make_config(self, organisms, apollo=None, setup=None):
+        """Return a config for the stub server and an organism file of organisms."""
+        organism_file = self.temp_path / "organisms.txt"
+        organism_file.write_text("\n".join(organisms) + "\n")
+        config = configparser.ConfigParser()
+        config["APOLLO"] = {
+            "base_url": self.base_url + "apollo/",
+            "username": "user",
+            "password": "secret",
+            **(apollo or dict()),
+        }
+        config["SETUP"] = {
+            "dir": str(self.temp_path / "out"),
+            "organism_file": str(organism_file),
+            **(setup or dict()),
+        }
+        config["EMAIL"] = {"moderator": "moderator@ebi.ac.uk"}
+        return config
+
+    def test_prepare_summary_gff(self):
+        config = self.make_config(
+            ["first", "broken", "", "slow", "second", "third"],
+            apollo={"download_workers": "4", "download_timeout": "0.5"},
+        )
+        reporter = ApolloReporter(config)
+        organism_gffs = reporter.prepare_summary_gff()
+        gff_file_object = reporter.read_gff(organism_gffs)
+
+        # In the organism file order, without the failed organisms
+        organisms = ["first", "second", "third"]
+        self.assertEqual(organisms, [organism for organism, _ in organism_gffs])
+        self.assertEqual(["broken", "slow"], sorted(reporter.failed_organisms))
+
+        # The organism of each gene is set while reading
+        gene_organism = gff_file_object.gene_organism
+        self.assertEqual([f"gene-{name}" for name in organisms], list(gene_organism))
+        self.assertEqual(organisms, list(gene_organism.values()))
+
+    def test_prepare_summary_gff_with_export_cache(self):
+        config = self.make_config(
+            ["first", "second", "third"],
+            apollo={"download_workers": "2"},
+            setup={"export_cache": str(self.temp_path / "exports")},
+        )
+        first_run = ApolloReporter(config).prepare_summary_gff()
+        exported = sorted(ExportStubHandler.exports)
+        self.assertEqual(["first", "second", "third"], exported)
+
+        # Only the organism with a recent annotation is exported again
+        ExportStubHandler.exports = list()
+        ExportStubHandler.recent_genes = {"gene-second": "second"}
+        second_run = ApolloReporter(config).prepare_summary_gff()
+        self.assertEqual(["second"], ExportStubHandler.exports)
+        self.assertEqual(
+            [organism for organism, _ in first_run],
+            [organism for organism, _ in second_run],
+        )
+        cached_gff = dict(second_run)["first"]
+        self.assertTrue(cached_gff.startswith(str(self.temp_path / "exports")))
+        with open(cached_gff) as gff_file_handle:
+            self.assertIn("ID=gene-first", gff_file_handle.read())
+
+    def test_prepare_summary_gff_resume(self):
+        config = self.make_config(["first", "broken", "second"])
+        reporter = ApolloReporter(config)
+        reporter.load_run_manifest()
+        first_run = reporter.prepare_summary_gff()
+        self.assertTrue((self.temp_path / "out.run_manifest.json").exists())
+
+        # Only the organism that failed is downloaded again
+        ExportStubHandler.exports = list()
+        reporter = ApolloReporter(config)
+        reporter.load_run_manifest(resume=True)
+        resumed_run = reporter.prepare_summary_gff()
+        self.assertEqual(["broken"], ExportStubHandler.exports)
+        self.assertEqual(first_run, resumed_run)
+        for _, gff_file_path in resumed_run:
+            self.assertTrue(Path(gff_file_path).exists())
+
+        # Without resume, the run starts again
+        ExportStubHandler.exports = list()
+        reporter = ApolloReporter(config)
+        reporter.load_run_manifest()
+        reporter.prepare_summary_gff()
+        self.assertEqual(3, len(ExportStubHandler.exports))
+
+    def test_run_pipeline_without_recent_genes(self):
+        config = self.make_config(["first"], setup={"days": "1"})
+        config["PIPELINE"] = {"summary_annotation": "no", "recent_annotation": "yes"}
+        args = argparse.Namespace(nosend=True, full_summary=False, resume=True)
+        for _ in range(2):
+            reporter = ApolloReporter(config)
+            run_pipeline(reporter, config, args)
+            reporter.close()
+            # Nothing to check, the run still finishes, the next one starts anew
+            self.assertFalse(reporter.run_manifest.resumed)
+            self.assertIsNotNone(reporter.run_manifest.run["finished"])
+
+
+    def test_persistent_paths(self):
+        out_dir = self.temp_path / "out"
+        config = self.make_config(
+            ["first"],
+            setup={
+                "sequence_cache": str(out_dir / "sequences.sqlite"),
+                "summary_state": str(self.temp_path / "summary_state.json"),
+                "run_manifest": str(out_dir / "manifest.json"),
+            },
+        )
+        reporter = ApolloReporter(config)
+        # The files kept between runs can't be in the output dir
+        self.assertIsNone(reporter.load_sequence_cache())
+        self.assertIsNotNone(reporter.load_summary_state())
+        reporter.load_run_manifest()
+        self.assertEqual(
+            self.temp_path / "out.run_manifest.json",
+            reporter.run_manifest.manifest_path,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
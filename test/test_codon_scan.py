@@ -0,0 +1,48 @@
+import unittest
+from module import codon_scan, transcript
+
+
+class MyTestCase(unittest.TestCase):
+    def test_count_internal_stop_codons(self):
+        # The last codon is not internal, the out of frame TAA is not counted
+        self.assertEqual(0, codon_scan.count_internal_stop_codons("ATGCACTGA"))
+        self.assertEqual(2, codon_scan.count_internal_stop_codons("ATGTAGTGACTAATGA"))
+        self.assertEqual(
+            [1, 0, 0, 0],
+            codon_scan.count_internal_stop_codons_batch(["ATGTAACAC", "TAA", "", "A"]),
+        )
+
+    def test_scan_coding_sequences(self):
+        sequences = ["ATGCACTGA", "ATCCACTAATAGCAT", "ATGCACTGAA"]
+        self.assertEqual(
+            [
+                {},
+                {
+                    "start_codon": "no start codon",
+                    "stop_codon": "no stop codon",
+                    "no_internal_stop_codon": "2 internal stop codon",
+                },
+                {
+                    "stop_codon": "no stop codon",
+                    "no_internal_stop_codon": "1 internal stop codon",
+                    "frame": "a length of 10, not a multiple of 3",
+                },
+            ],
+            codon_scan.scan_coding_sequences(sequences),
+        )
+
+    def test_same_errors_as_coding_sequence(self):
+        sequences = ["ATGTGATAAGCATAG", "TTAGATGA", "TAGTAGTAGTAG", "AT"]
+        batch_errors = codon_scan.scan_coding_sequences(sequences)
+        for sequence, errors in zip(sequences, batch_errors):
+            mrna = transcript.CodingSequence("mrna-1", "org", "3R")
+            mrna.sequence = sequence
+            mrna.coding_sequence_has_start_codon()
+            mrna.coding_sequence_has_stop_codon()
+            mrna.coding_sequence_no_internal_stop_codon()
+            mrna.coding_sequence_in_frame()
+            self.assertEqual(mrna.errors, errors)
+
+
+if __name__ == "__main__":
+    unittest.main()
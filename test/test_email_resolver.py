@@ -0,0 +1,76 @@
+import tempfile
+import unittest
+from pathlib import Path
+from module import email_resolver
+from stub_server import StubHandler, serve
+
+
+class EmailLookupHandler(StubHandler):
+    """Answer the address of a userId, user 404 is unknown."""
+
+    requests = list()
+
+    def do_POST(self):
+        user_number = self.read_json()["query"]["userId"]
+        EmailLookupHandler.requests.append(user_number)
+        if user_number == 404:
+            self.send_answer(404)
+            return
+        self.send_json({"email": f"user{user_number}@example.org"})
+
+
+class MyTestCase(unittest.TestCase):
+    def setUp(self):
+        EmailLookupHandler.requests = list()
+        self.base_url = serve(self, EmailLookupHandler)
+
+    def test_resolve_all(self):
+        user_ids = ["ann.1", "bob.2", "ann.1", "nobody", "lost.404"]
+        with email_resolver.EmailResolver(
+            self.base_url, "client", "secret", workers=3
+        ) as resolver:
+            addresses = resolver.resolve_all(user_ids)
+            self.assertEqual(
+                {
+                    "ann.1": "user1@example.org",
+                    "bob.2": "user2@example.org",
+                    "nobody": False,
+                    "lost.404": False,
+                },
+                addresses,
+            )
+            # The error emails use the addresses of the summary emails
+            self.assertEqual("user2@example.org", resolver.resolve("bob.2"))
+        self.assertEqual([1, 2, 404], sorted(EmailLookupHandler.requests))
+        self.assertEqual(
+            {"cache_hits": 0, "lookups": 3, "not_found": 1, "no_user_id": 1},
+            resolver.stats,
+        )
+
+    def test_address_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_path = Path(temp_dir) / "addresses.json"
+            cache = email_resolver.AddressCache(cache_path, max_age_days=7)
+            with email_resolver.EmailResolver(
+                self.base_url, "client", "secret", address_cache=cache
+            ) as resolver:
+                resolver.resolve_all(["ann.1", "lost.404"])
+
+            # The next run only looks up the unknown user again
+            cache = email_resolver.AddressCache(cache_path, max_age_days=7)
+            with email_resolver.EmailResolver(
+                self.base_url, "client", "secret", address_cache=cache
+            ) as resolver:
+                self.assertEqual("user1@example.org", resolver.resolve("ann.1"))
+                self.assertFalse(resolver.resolve("lost.404"))
+            self.assertEqual([1, 404, 404], EmailLookupHandler.requests)
+            self.assertEqual(1, resolver.stats["cache_hits"])
+
+            resolved = cache.addresses["1"]["resolved"]
+            too_late = resolved + 8 * email_resolver.SECONDS_PER_DAY
+            self.assertEqual("user1@example.org", cache.get(1, now=resolved + 10))
+            self.assertIsNone(cache.get(1, now=too_late))
+
+
+if __name__ == "__main__":
+    unittest.main()
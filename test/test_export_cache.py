@@ -0,0 +1,34 @@
+import tempfile
+import unittest
+from pathlib import Path
+from module import export_cache
+
+
+class MyTestCase(unittest.TestCase):
+    def test_get_and_put(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_dir = Path(temp_dir) / "exports"
+            cache = export_cache.ExportCache(cache_dir, max_age_days=7)
+            self.assertIsNone(cache.get("sand/box", set()))
+
+            new_export = Path(temp_dir) / "apollo.gff"
+            new_export.write_text("##gff-version 3\n")
+            now = 1000 * export_cache.SECONDS_PER_DAY
+            cached_gff = cache.put("sand/box", new_export, now)
+            self.assertEqual(cache_dir / "sandbox.gff", cached_gff)
+
+            # The manifest is kept for the next run
+            cache = export_cache.ExportCache(cache_dir, max_age_days=7)
+            self.assertEqual(cached_gff, cache.get("sand/box", set(), now=now + 10))
+            self.assertIsNone(cache.get("sand/box", {"sand/box"}, now=now + 10))
+            too_late = now + 8 * export_cache.SECONDS_PER_DAY
+            self.assertIsNone(cache.get("sand/box", set(), now=too_late))
+            self.assertEqual({"hits": 1, "misses": 2, "stored": 0}, cache.stats())
+
+            three_days_later = now + 2.5 * export_cache.SECONDS_PER_DAY
+            self.assertEqual(3, cache.recent_days(["sand/box"], now=three_days_later))
+            self.assertEqual(1, cache.recent_days(["other"], now=three_days_later))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+import unittest
+from module import fasta_file
+
+
+class MyTestCase(unittest.TestCase):
+    def test_build_fasta_index(self):
+        index = fasta_file.build_fasta_index("./input_files/genome.fasta")
+        self.assertEqual((60, 6, 25, 26), index["chrT"])
+        self.assertEqual((10, 75, 10, 11), index["chrU"])
+
+    def test_fetch(self):
+        index_path = "./input_files/genome.fasta.fai"
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+        with fasta_file.IndexedFasta("./input_files/genome.fasta") as genome:
+            self.assertEqual(True, os.path.exists(index_path))
+            self.assertEqual(["chrT", "chrU"], genome.names())
+            # Across a line break
+            self.assertEqual("cTCAGGG", genome.fetch("chrT", 33, 40))
+            self.assertEqual("ATGAAA", genome["chrT"][2:8])
+            self.assertEqual("ACGTACGTAC", genome["chrU"][:])
+            self.assertEqual("AC", genome["chrU"][8:20])
+
+        # The saved index is used the second time
+        with fasta_file.IndexedFasta("./input_files/genome.fasta") as genome:
+            self.assertEqual(60, len(genome["chrT"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
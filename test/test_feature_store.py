@@ -0,0 +1,47 @@
+import unittest
+from module import feature_store
+
+
+class MyTestCase(unittest.TestCase):
+    def test_add_feature(self):
+        store = feature_store.FeatureStore()
+        # The exon comes before its mRNA
+        store.add_feature("exon-1", "exon", None, "mrna-1", "3R", "-", 5, 10, True)
+        store.add_feature("mrna-1", "mRNA", "owner", "gene-1", "3R", "-", 1, 20, True)
+        store.add_feature("gene-1", "gene", "owner", "gene-1", "3R", "-", 1, 20, False)
+
+        self.assertEqual(3, len(store))
+        added_ids = [store.ids[row] for row in store.rows]
+        self.assertEqual(["exon-1", "mrna-1", "gene-1"], added_ids)
+        self.assertEqual(1, len(store.owners.values))
+        self.assertEqual(1, len(store.scaffolds.values))
+
+        exon_row = store.index["exon-1"]
+        self.assertEqual("exon", store.feature_type(exon_row))
+        self.assertEqual(None, store.owner(exon_row))
+        self.assertEqual((5, 10), store.position(exon_row))
+        self.assertEqual(store.index["mrna-1"], store.parent[exon_row])
+
+    def test_views(self):
+        store = feature_store.FeatureStore()
+        store.add_feature("gene-1", "gene", "owner", "gene-1", "3R", "+", 1, 20, False)
+        store.add_feature("mrna-1", "mRNA", "owner", "gene-1", "2L", "+", 1, 20, True)
+        store.add_feature("orphan-1", "exon", None, None, "2L", "+", 1, 20, True)
+
+        parents = feature_store.ParentView(store)
+        self.assertEqual({"gene-1": "gene-1", "mrna-1": "gene-1"}, dict(parents))
+        self.assertNotIn("orphan-1", parents)
+
+        fields = feature_store.FieldsView(store)
+        self.assertEqual("2L", fields[("scaffold", "mrna-1")])
+        self.assertEqual((1, 20), fields[("position", "mrna-1")])
+        self.assertNotIn(("scaffold", "gene-1"), fields)
+        self.assertEqual(6, len(fields))
+
+        owners = feature_store.FeatureOwnerView(store)
+        self.assertEqual(None, owners["orphan-1"])
+        self.assertEqual("mRNA", feature_store.FeatureTypeView(store)["mrna-1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,18 @@
+import tempfile
 import unittest
-from module import gff_file
+from pathlib import Path
+from module import gff_file, sequence_cache, transcript
+from stub_server import StubHandler, serve
+
+
+class SequenceStubHandler(StubHandler):
+    """Answer sequenceByName with a CDS without stop codon, keep the names."""
+
+    feature_names = list()
+
+    def do_POST(self):
+        SequenceStubHandler.feature_names.append(self.read_json()["featureName"])
+        self.send_answer(200, b"ATGCACCAC")
 
 
 class MyTestCase(unittest.TestCase):
@@ -95,6 +108,202 @@ class MyTestCase(unittest.TestCase):
         )
         self.assertEqual("3R", scaffold_error.gff_format_error[0].get("parent_value"))
 
+    def test_ancestry_index(self):
+        mini_gff_file = "./input_files/mini.gff"
+        mini_gff = gff_file.HandleGFF(mini_gff_file, {}, "")
+        mini_gff.read_gff_file()
+
+        cds_id = "79cdd16a-3988-4d9a-81a6-e0a17384013c"
+        self.assertEqual(
+            "14f85617-72a1-4658-8abc-05f94e551114", mini_gff.get_mrna_id(cds_id)
+        )
+        self.assertEqual("annotator2@ebi.ac.uk", mini_gff.get_parent_owner(cds_id))
+        self.assertEqual(
+            None, mini_gff.get_mrna_id("78fbaf52-0a8b-4acb-a93c-5d50238e47bf")
+        )
+        self.assertEqual({}, mini_gff.lineage_errors)
+
+    def test_ancestry_index_broken_chains(self):
+        broken_gff = gff_file.HandleGFF(None, {}, "")
+        parents = {"a": "b", "b": "a", "gene": "gene"}
+        deep_id = "gene"
+        for depth in range(gff_file.MAX_ITERATION + 1):
+            parents["deep" + str(depth)] = deep_id
+            deep_id = "deep" + str(depth)
+        for feature_id, parent_id in parents.items():
+            feature_type = "gene" if feature_id == "gene" else "exon"
+            broken_gff.store.add_feature(
+                feature_id, feature_type, "owner", parent_id, "1", "+", 1, 10, True
+            )
+
+        broken_gff.build_ancestry_index()
+
+        self.assertEqual({"a", "b", deep_id}, set(broken_gff.lineage_errors))
+        self.assertRaises(RecursionError, broken_gff.get_gene_id, "a")
+        self.assertRaises(RecursionError, broken_gff.get_gene_id, deep_id)
+        self.assertEqual("gene", broken_gff.get_gene_id("deep5"))
+
+    def test_filter_disqualified_features(self):
+        disqualified_gff_file = "./input_files/disqualified.gff"
+        with open(disqualified_gff_file) as file_handle:
+            feature_ids = [
+                gff_fields[4]
+                for _, fields, gff_fields in gff_file.filter_gff_features(file_handle)
+                if fields
+            ]
+        self.assertEqual(13, len(feature_ids))
+        for dropped_id in (
+            "utr-1",
+            "utr-child-1",
+            "repeat-1",
+            "repeat-exon-1",
+            "repeat-cds-1",
+        ):
+            self.assertNotIn(dropped_id, feature_ids)
+
+        disqualified_gff = gff_file.HandleGFF(disqualified_gff_file, {}, "")
+        disqualified_gff.read_gff_file()
+        disqualified_gff.scan_gff_for_errors()
+        self.assertEqual({}, disqualified_gff.errors)
+        self.assertEqual(["annotator1@ebi.ac.uk"], list(disqualified_gff.annotators))
+
+    def test_iter_gene_block_errors(self):
+        two_genes_gff = gff_file.HandleGFF("./input_files/two_genes_false.gff", {}, "")
+        two_genes_gff.read_gff_file()
+        two_genes_gff.scan_gff_for_errors()
+
+        # One exon of the second gene is written in the block of the first gene
+        for gff_file_path in (
+            "./input_files/two_genes_false.gff",
+            "./input_files/out_of_order.gff",
+        ):
+            streamed_gff = gff_file.HandleGFF(gff_file_path, {}, "")
+            errors = dict(streamed_gff.iter_gene_block_errors())
+
+            self.assertEqual(set(two_genes_gff.errors), set(errors))
+            for feature_id, error in errors.items():
+                self.assertEqual(
+                    two_genes_gff.errors[feature_id].gff_error_text(),
+                    error.gff_error_text(),
+                )
+            self.assertEqual(
+                two_genes_gff.annotators["twoGenes@ebi.ac.uk"].get_unfinished(),
+                streamed_gff.annotators["twoGenes@ebi.ac.uk"].get_unfinished(),
+            )
+            # Nothing is left after the last block
+            self.assertEqual(0, len(streamed_gff.store))
+
+        # An exon written after the block of its gene, once it is validated
+        late_child_gff = gff_file.HandleGFF("./input_files/late_child.gff", {}, "")
+        late_child_gff.read_gff_file()
+        late_child_gff.scan_gff_for_errors()
+        streamed_gff = gff_file.HandleGFF("./input_files/late_child.gff", {}, "")
+        errors = dict(streamed_gff.iter_gene_block_errors())
+        self.assertIn("60a49f41-e279-40fc-964a-415c3d046bb9", errors)
+        self.assertEqual(set(late_child_gff.errors), set(errors))
+        for feature_id, error in errors.items():
+            self.assertEqual(
+                late_child_gff.errors[feature_id].gff_error_text(),
+                error.gff_error_text(),
+            )
+        # The summaries of the genes read again are not counted twice
+        self.assertEqual(len(late_child_gff.gene_meta_info), streamed_gff.gene_count)
+        self.assertEqual(
+            len(late_child_gff.transcripts), streamed_gff.transcript_count
+        )
+        self.assertEqual(
+            vars(late_child_gff.annotators["twoGenes@ebi.ac.uk"]),
+            vars(streamed_gff.annotators["twoGenes@ebi.ac.uk"]),
+        )
+
+    def test_scan_mrna_sequence_with_genome(self):
+        genome_gff = gff_file.HandleGFF("./input_files/genome.gff", {}, "")
+        genome_gff.read_gff_file()
+        genome = transcript.GenomeSequences(default_genome="./input_files/genome.fasta")
+        genome_gff.scan_mrna_sequence(genome=genome)
+
+        self.assertEqual(["mrna-plus"], list(genome_gff.errors))
+        sequence_error = genome_gff.errors["mrna-plus"].sequence_error
+        self.assertEqual(1, len(sequence_error))
+        self.assertEqual("1 internal stop codon", sequence_error[0]["error_text"])
+
+    def test_scan_mrna_sequence_without_genome_fasta(self):
+        gff_files = [
+            ("sand_box", "./input_files/mini.gff"),
+            ("genome_box", "./input_files/genome.gff"),
+        ]
+        organism_gff = gff_file.HandleGFF(gff_files, dict(), "")
+        organism_gff.read_gff_file()
+        genome = transcript.GenomeSequences(
+            genome_files={"genome_box": "./input_files/genome.fasta"}
+        )
+        SequenceStubHandler.feature_names = list()
+        base_url = serve(self, SequenceStubHandler) + "apollo/"
+        organism_gff.scan_mrna_sequence(base_url, "user", "secret", genome=genome)
+        genome.close()
+
+        # The sand_box transcripts are checked through Apollo
+        sand_box_ids = [
+            mrna_id
+            for mrna_id, organism, _ in organism_gff.transcripts
+            if organism == "sand_box"
+        ]
+        self.assertTrue(sand_box_ids)
+        self.assertEqual(
+            sorted(sand_box_ids), sorted(SequenceStubHandler.feature_names)
+        )
+        sequence_error = organism_gff.errors["mrna-plus"].sequence_error
+        self.assertEqual("1 internal stop codon", sequence_error[0]["error_text"])
+        for mrna_id in sand_box_ids:
+            sequence_error = organism_gff.errors[mrna_id].sequence_error
+            error_names = [error["error_name"] for error in sequence_error]
+            self.assertIn("stop_codon", error_names)
+
+    def test_read_organism_gff_files(self):
+        gff_files = [
+            ("sand_box", "./input_files/mini.gff"),
+            ("genome_box", "./input_files/genome.gff"),
+        ]
+        gff_file_object = gff_file.HandleGFF(gff_files, dict(), "")
+        gff_file_object.read_gff_file()
+
+        gene_organism = gff_file_object.gene_organism
+        mini_gene_id = "9519cfca-0c42-44d4-ab09-d37d33245d07"
+        self.assertEqual("sand_box", gene_organism[mini_gene_id])
+        self.assertEqual("genome_box", gene_organism["gene-minus"])
+        transcript_organisms = {
+            mrna_id: organism for mrna_id, organism, _ in gff_file_object.transcripts
+        }
+        self.assertEqual("genome_box", transcript_organisms["mrna-plus"])
+        self.assertEqual(
+            "sand_box", transcript_organisms["5d7a93e5-6390-4568-832b-a5d7ca162ac6"]
+        )
+
+    def test_scan_mrna_sequence_with_cache(self):
+        genome_gff = gff_file.HandleGFF("./input_files/genome.gff", {}, "")
+        genome_gff.read_gff_file()
+        cds_segments = genome_gff.get_cds_segments()
+        sequences = {"mrna-plus": "ATGTAATGA", "mrna-minus": "ATGGGGCCCTGA"}
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = sequence_cache.SequenceCache(Path(cache_dir) / "cds.sqlite")
+            for mrna_id, organism, scaffold in genome_gff.transcripts:
+                version = genome_gff.get_sequence_version(mrna_id, cds_segments)
+                cache.put(organism, scaffold, mrna_id, version, sequences[mrna_id])
+
+            # Nothing listens there, the sequences can only come from the cache
+            fetcher = transcript.ApolloSequenceFetcher(
+                "http://127.0.0.1:9/apollo/", "user", "secret", retries=0
+            )
+            genome_gff.scan_mrna_sequence(
+                sequence_fetcher=fetcher, sequence_cache=cache
+            )
+            self.assertEqual(2, cache.hits)
+            self.assertEqual(0, cache.misses)
+            cache.close()
+
+        self.assertEqual(["mrna-plus"], list(genome_gff.errors))
+
 
 if __name__ == "__main__":
     unittest.main()
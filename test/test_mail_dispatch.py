@@ -0,0 +1,152 @@
+import json
+import tempfile
+import time
+import unittest
+import urllib.parse
+from pathlib import Path
+from module import mail_dispatch
+from stub_server import StubHandler, serve
+
+
+class MailgunHandler(StubHandler):
+    """Answer the first send to each address with a 429, bounce@ with a 400."""
+
+    throttled = set()
+    sent = list()
+
+    def do_POST(self):
+        body = self.read_body().decode()
+        to = [field for field in body.split("&") if field.startswith("to=")][0]
+        if to not in MailgunHandler.throttled:
+            MailgunHandler.throttled.add(to)
+            self.send_answer(429, headers={"Retry-After": "0"})
+            return
+        if "bounce" in to:
+            self.send_answer(400, b"Bad address")
+            return
+        MailgunHandler.sent.append(to)
+        self.send_json({"id": f"<{len(MailgunHandler.sent)}>"})
+
+
+class BatchHandler(StubHandler):
+    """Keep the form of each send."""
+
+    forms = list()
+
+    def do_POST(self):
+        BatchHandler.forms.append(urllib.parse.parse_qs(self.read_body().decode()))
+        self.send_json({"id": "<batch>"})
+
+
+class MyTestCase(unittest.TestCase):
+    def test_token_bucket(self):
+        token_bucket = mail_dispatch.TokenBucket(rate=50, burst=5)
+        start = time.monotonic()
+        for _ in range(15):
+            token_bucket.acquire()
+        # 5 at once, then 10 at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+        token_bucket = mail_dispatch.TokenBucket()
+        token_bucket.pause(0.1)
+        start = time.monotonic()
+        token_bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_send_all(self):
+        MailgunHandler.throttled = set()
+        MailgunHandler.sent = list()
+        url = serve(self, MailgunHandler) + "messages"
+        addresses = [f"user{index}@example.org" for index in range(6)]
+        addresses.append("bounce@example.org")
+        emails = [
+            (f"user.{index}", address, "moderator@example.org", "Summary", "Hi")
+            for index, address in enumerate(addresses)
+        ]
+
+        on_delivery = list()
+        with mail_dispatch.MailgunDispatcher(
+            url, "key", "apollo@example.org", workers=3
+        ) as dispatcher:
+            deliveries = dispatcher.send_all(emails, on_delivery.append)
+
+        self.assertEqual(len(emails), len(on_delivery))
+        self.assertEqual(addresses, [delivery["to"] for delivery in deliveries])
+        self.assertEqual(["sent"] * 6 + ["failed"], [d["status"] for d in deliveries])
+        self.assertEqual([2] * 7, [delivery["attempts"] for delivery in deliveries])
+        self.assertEqual(400, deliveries[-1]["http_status"])
+        self.assertEqual("Bad address", deliveries[-1]["error"])
+        self.assertIsNotNone(deliveries[0]["message_id"])
+        self.assertEqual(
+            {"sent": 6, "failed": 1, "rate_limited": 7, "batches": 0},
+            dispatcher.stats,
+        )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            report_path = Path(temp_dir) / "deliveries.json"
+            mail_dispatch.write_delivery_report(deliveries, report_path)
+            with report_path.open() as report_file:
+                delivery_report = json.load(report_file)
+        self.assertEqual({"sent": 6, "failed": 1}, delivery_report["statuses"])
+        self.assertEqual(deliveries, delivery_report["deliveries"])
+
+    def test_send_all_in_batches(self):
+        BatchHandler.forms = list()
+        url = serve(self, BatchHandler) + "messages"
+        footer = ["--\n", "Apollo\n"]
+        emails = [
+            (
+                f"user.{index}",
+                f"user{index}@example.org",
+                "moderator@example.org",
+                "Summary",
+                [f"Dear user{index},\n", f"Genes: {index}\n"] + footer,
+            )
+            for index in range(5)
+        ]
+
+        emails[4] += ("gene-1\n",)
+        with mail_dispatch.MailgunDispatcher(
+            url, "key", "apollo@example.org", workers=2
+        ) as dispatcher:
+            deliveries = dispatcher.send_all(emails, batch_size=3)
+
+        # A batch of 3 and its moderator copy, the 4th email alone and the one
+        # with a gene list alone
+        self.assertEqual(4, len(BatchHandler.forms))
+        self.assertEqual(["sent"] * 5, [d["status"] for d in deliveries])
+        self.assertEqual(1, dispatcher.stats["batches"])
+        self.assertEqual(5, dispatcher.stats["sent"])
+        batch_form = [
+            form for form in BatchHandler.forms if "recipient-variables" in form
+        ][0]
+        self.assertEqual(3, len(batch_form["to"]))
+        self.assertNotIn("bcc", batch_form)
+        moderator_form = [
+            form
+            for form in BatchHandler.forms
+            if form.get("to") == ["moderator@example.org"]
+        ][0]
+        self.assertIn("To: user0@example.org\n", moderator_form["text"])
+        self.assertEqual(["moderator@example.org"], moderator_form["to"])
+        self.assertIn("Dear user2,\n", moderator_form["text"])
+        self.assertEqual(["%recipient.body%--\nApollo\n"], batch_form["text"])
+        recipient_variables = json.loads(batch_form["recipient-variables"][0])
+        self.assertEqual(
+            {"body": "Dear user0,\nGenes: 0\n"},
+            recipient_variables["user0@example.org"],
+        )
+
+    def test_retry_after_seconds(self):
+        class Response:
+            headers = {"Retry-After": "3"}
+
+        self.assertEqual(3.0, mail_dispatch.retry_after_seconds(Response, 1.0))
+        Response.headers = {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}
+        self.assertEqual(0.0, mail_dispatch.retry_after_seconds(Response, 1.0))
+        Response.headers = dict()
+        self.assertEqual(1.0, mail_dispatch.retry_after_seconds(Response, 1.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import tempfile
+import unittest
+from pathlib import Path
+from module.run_manifest import RunManifest
+
+
+class MyTestCase(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest_path = Path(temp_dir) / "out.run_manifest.json"
+            run_manifest = RunManifest(manifest_path)
+            self.assertFalse(run_manifest.resumed)
+            run_manifest.add_item("summary_download", "org", "out/org/apollo.gff")
+            run_manifest.set_done("summary_written")
+            run_manifest.add_item("summary_sent", "annotator@ebi.ac.uk")
+
+            # The unfinished run is continued only with resume
+            self.assertFalse(RunManifest(manifest_path).resumed)
+            run_manifest.save()
+            resumed_manifest = RunManifest(manifest_path, resume=True)
+            self.assertTrue(resumed_manifest.resumed)
+            self.assertTrue(resumed_manifest.is_done("summary_written"))
+            self.assertFalse(resumed_manifest.is_done("summary_sent"))
+            self.assertEqual(
+                {"annotator@ebi.ac.uk": True},
+                resumed_manifest.get_items("summary_sent"),
+            )
+            self.assertEqual(dict(), resumed_manifest.get_items("recent_download"))
+
+            # A finished run is not resumed, the next one starts from scratch
+            resumed_manifest.finish()
+            new_manifest = RunManifest(manifest_path, resume=True)
+            self.assertFalse(new_manifest.resumed)
+            self.assertFalse(new_manifest.is_done("summary_written"))
+
+
+if __name__ == "__main__":
+    unittest.main()
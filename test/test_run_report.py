@@ -0,0 +1,89 @@
+import json
+import pstats
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from module import run_report
+
+
+def count_up(count):
+    return sum(range(count))
+
+
+class MyTestCase(unittest.TestCase):
+    def test_stages(self):
+        report = run_report.RunReport()
+        with report.stage("download") as counts:
+            counts["organisms"] = 2
+        for _ in range(3):
+            with report.stage("send") as counts:
+                counts["sent"] = 1
+        with self.assertRaises(ValueError):
+            with report.stage("parse"):
+                raise ValueError("broken gff")
+        with run_report.stage(None, "ignored") as counts:
+            counts["items"] = 1
+        report.finish("failed")
+
+        self.assertEqual(["download", "send", "parse"], list(report.stages))
+        self.assertEqual(3, report.stages["send"]["calls"])
+        self.assertEqual({"sent": 3}, report.stages["send"]["counts"])
+        self.assertGreater(report.stages["parse"]["peak_rss_bytes"], 0)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_path = Path(temp_dir) / "report.json"
+            report.write_json(json_path)
+            with json_path.open() as json_file:
+                run = json.load(json_file)
+            self.assertEqual("failed", run["status"])
+            self.assertEqual({"organisms": 2}, run["stages"]["download"]["counts"])
+
+            prometheus_path = Path(temp_dir) / "textfile" / "apollo_report.prom"
+            report.write_prometheus(prometheus_path)
+            lines = prometheus_path.read_text().splitlines()
+        self.assertIn("apollo_report_run_finished 0", lines)
+        self.assertIn('apollo_report_stage_count{stage="send",item="sent"} 3', lines)
+        self.assertIn("# TYPE apollo_report_stage_seconds gauge", lines)
+
+    def test_profile_stages(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profiler = run_report.StageProfiler(Path(temp_dir), stages=["parse"])
+            report = run_report.RunReport(profiler=profiler)
+            with report.stage("parse"):
+                lines = [str(index) * 9 for index in range(1000)]
+            with report.stage("download"):
+                sum(range(1000))
+            profiler.write()
+            written = sorted(path.name for path in Path(temp_dir).iterdir())
+            allocations = (Path(temp_dir) / "parse.allocations.txt").read_text()
+
+        self.assertEqual(1000, len(lines))
+        self.assertEqual(["parse.allocations.txt", "parse.prof"], written)
+        self.assertIn("test_run_report.py", allocations)
+        self.assertIn("parse (peak", profiler.format_summary())
+        self.assertIn("download", report.stages)
+
+    def test_profile_threads(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profiler = run_report.StageProfiler(Path(temp_dir))
+            report = run_report.RunReport(profiler=profiler)
+            with report.stage("send"):
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    totals = list(executor.map(count_up, [1000] * 4))
+            with report.stage("download"):
+                thread = threading.Thread(target=count_up, args=(1000,))
+                thread.start()
+                thread.join()
+            profiler.write()
+            send_stats = pstats.Stats(str(Path(temp_dir) / "send.prof")).stats
+            download_stats = pstats.Stats(str(Path(temp_dir) / "download.prof")).stats
+
+        self.assertEqual([499500] * 4, totals)
+        for stats in (send_stats, download_stats):
+            self.assertIn("count_up", {function for _, _, function in stats})
+
+
+if __name__ == "__main__":
+    unittest.main()
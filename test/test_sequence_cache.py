@@ -0,0 +1,53 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from module import sequence_cache
+
+
+class MyTestCase(unittest.TestCase):
+    def test_get_and_put(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_path = Path(cache_dir) / "cache" / "cds.sqlite"
+            with sequence_cache.SequenceCache(cache_path) as cache:
+                self.assertIsNone(cache.get("org", "3R", "mrna-1", "2020-01-01"))
+                cache.put("org", "3R", "mrna-1", "2020-01-01", "ATGTGA")
+                sequence = cache.get("org", "3R", "mrna-1", "2020-01-01")
+                self.assertEqual("ATGTGA", sequence)
+                # The gene was modified since
+                self.assertIsNone(cache.get("org", "3R", "mrna-1", "2020-02-01"))
+                self.assertEqual(1, cache.hits)
+                self.assertEqual(2, cache.misses)
+
+            # The sequences are kept between runs
+            with sequence_cache.SequenceCache(cache_path) as cache:
+                sequence = cache.get("org", "3R", "mrna-1", "2020-01-01")
+                self.assertEqual("ATGTGA", sequence)
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_path = Path(cache_dir) / "cds.sqlite"
+            cache = sequence_cache.SequenceCache(cache_path, max_entries=2)
+            for mrna_id in ("mrna-1", "mrna-2", "mrna-3"):
+                cache.put("org", "3R", mrna_id, "v1", "ATGTGA")
+            cache.connection.execute(
+                "UPDATE cds SET last_used = ? WHERE mrna_id = 'mrna-2'",
+                (time.time() - 10 * sequence_cache.SECONDS_PER_DAY,),
+            )
+            self.assertEqual(1, cache.evict())
+            self.assertIsNone(cache.get("org", "3R", "mrna-2", "v1"))
+            self.assertEqual(2, len(cache))
+
+            cache.max_age_days = 5
+            cache.connection.execute(
+                "UPDATE cds SET last_used = ? WHERE mrna_id = 'mrna-1'",
+                (time.time() - 10 * sequence_cache.SECONDS_PER_DAY,),
+            )
+            self.assertEqual(1, cache.evict())
+            self.assertEqual(1, len(cache))
+            self.assertEqual(2, cache.stats()["evicted"])
+            cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
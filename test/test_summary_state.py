@@ -0,0 +1,72 @@
+import tempfile
+import unittest
+from pathlib import Path
+from module import gff_file, summary_state
+
+
+def read_summaries(gff_files, gene_organism=None):
+    gff_file_object = gff_file.HandleGFF(
+        gff_files, gene_organism or dict(), "", keep_gene_summaries=True
+    )
+    gff_file_object.read_gff_file()
+    return gff_file_object
+
+
+class MyTestCase(unittest.TestCase):
+    def test_rebuild(self):
+        mini_gff = read_summaries("./input_files/mini.gff")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            state_path = Path(temp_dir) / "summary_state.json"
+            state = summary_state.SummaryState(state_path)
+            self.assertTrue(state.is_empty())
+            state.rebuild(mini_gff.gene_summaries, {}, 1000.0)
+            state.save()
+
+            state = summary_state.SummaryState(state_path)
+            self.assertEqual(2, len(state.genes))
+            self.assertEqual([], state.compare(mini_gff.annotators))
+            annotators = state.annotators
+            self.assertEqual(
+                vars(mini_gff.annotators["annotator2@ebi.ac.uk"]),
+                vars(annotators["annotator2@ebi.ac.uk"]),
+            )
+
+    def test_update(self):
+        state = summary_state.SummaryState("./not_saved.json")
+        full_gff = read_summaries(
+            [
+                ("sand_box", "./input_files/mini.gff"),
+                ("other", "./input_files/genome.gff"),
+            ]
+        )
+        state.rebuild(full_gff.gene_summaries, full_gff.gene_organism, 1000.0)
+
+        # The second gene of mini.gff was deleted, the other organism not read
+        deleted_gene = "78fbaf52-0a8b-4acb-a93c-5d50238e47bf"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            first_gene_gff = Path(temp_dir) / "first_gene.gff"
+            with open("./input_files/mini.gff") as mini_file:
+                first_gene_gff.write_text("".join(mini_file.readlines()[:16]))
+            changed_gff = read_summaries([("sand_box", str(first_gene_gff))])
+            deleted_genes = state.update(
+                changed_gff.gene_summaries,
+                changed_gff.gene_organism,
+                ["sand_box"],
+                2000.0,
+            )
+            self.assertEqual([deleted_gene], deleted_genes)
+            self.assertEqual("other", state.genes["gene-plus"]["organism"])
+
+            full_gff = read_summaries(
+                [
+                    ("sand_box", str(first_gene_gff)),
+                    ("other", "./input_files/genome.gff"),
+                ]
+            )
+        self.assertEqual([], state.compare(full_gff.annotators))
+        mini_gff = read_summaries("./input_files/mini.gff")
+        different_owners = state.compare(mini_gff.annotators)
+        self.assertEqual(["annotator2@ebi.ac.uk", "genome@ebi.ac.uk"], different_owners)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,28 @@
+import contextlib
+import io
+import shutil
+import tempfile
 import unittest
+from pathlib import Path
 from module import transcript
+from stub_server import StubHandler, serve
+
+
+class SequenceStubHandler(StubHandler):
+    """Answer sequenceByName with a sequence made from the feature name."""
+
+    flaky_calls = 0
+
+    def do_POST(self):
+        feature_name = self.read_json()["featureName"]
+        if feature_name == "flaky" and SequenceStubHandler.flaky_calls == 0:
+            SequenceStubHandler.flaky_calls += 1
+            self.send_answer(503)
+            return
+        if feature_name == "missing":
+            self.send_answer(404)
+            return
+        self.send_answer(200, ("ATG" + "CAC" * len(feature_name) + "TGA").encode())
 
 
 class MyTestCase(unittest.TestCase):
@@ -60,6 +83,82 @@ class MyTestCase(unittest.TestCase):
         mrna.coding_sequence_no_internal_stop_codon()
         self.assertEqual(mrna.errors["no_internal_stop_codon"], "2 internal stop codon")
 
+    def test_splice_cds(self):
+        scaffold = "ccATGAAAccccTAGTAAcc"
+        plus_cds = transcript.splice_cds(scaffold, "+", [(13, 18, 0), (3, 8, 0)])
+        self.assertEqual("ATGAAATAGTAA", plus_cds)
+
+        minus_cds = transcript.splice_cds(scaffold, "-", [(13, 18, 0), (3, 8, 0)])
+        self.assertEqual("TTACTATTTCAT", minus_cds)
+
+        # The phase of the first CDS in the direction of the transcript is trimmed
+        phased_cds = transcript.splice_cds(scaffold, "+", [(3, 8, 2), (13, 18, 0)])
+        self.assertEqual("GAAATAGTAA", phased_cds)
+        phased_cds = transcript.splice_cds(scaffold, "-", [(3, 8, 0), (13, 18, 1)])
+        self.assertEqual("TACTATTTCAT", phased_cds)
+
+    def test_genome_sequence(self):
+        genome = transcript.GenomeSequences(default_genome="./input_files/genome.fasta")
+        mrna = transcript.CodingSequence("mrna-minus", "sand_box", "chrT")
+        mrna.get_sequence(
+            genome=genome, strand="-", cds_segments=[(45, 50, 0), (35, 40, 0)]
+        )
+        self.assertEqual("ATGGGGCCCTGA", mrna.sequence)
+
+        mrna = transcript.CodingSequence("mrna-minus", "sand_box", "chrX")
+        self.assertEqual(
+            False,
+            mrna.get_sequence(genome=genome, strand="-", cds_segments=[(1, 3, 0)]),
+        )
+        genome.close()
+
+    def test_genome_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            other_genome = Path(temp_dir) / "other.fasta"
+            shutil.copy("./input_files/genome.fasta", other_genome)
+            genome = transcript.GenomeSequences(
+                genome_files={
+                    "sand_box": "./input_files/genome.fasta",
+                    "other": str(other_genome),
+                },
+                max_open=1,
+            )
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                for organism_name in ["sand_box", "other", "sand_box", "none", "none"]:
+                    genome.get_scaffold(organism_name, "chrT")
+            # The least recently used genome is closed, a missing one reported once
+            self.assertEqual(["./input_files/genome.fasta"], list(genome.genomes))
+            self.assertEqual("No genome fasta for none\n", output.getvalue())
+            self.assertIsNotNone(genome.get_scaffold("other", "chrT"))
+            genome.close()
+            self.assertEqual(0, len(genome.genomes))
+
+    def test_apollo_sequence_fetcher(self):
+        SequenceStubHandler.flaky_calls = 0
+        base_url = serve(self, SequenceStubHandler) + "apollo/"
+
+        feature_names = ["a", "flaky", "missing"] + ["m" * i for i in range(1, 20)]
+        mrnas = [transcript.CodingSequence(name, "org", "3R") for name in feature_names]
+        fetcher = transcript.ApolloSequenceFetcher(
+            base_url,
+            "user",
+            "secret",
+            workers=4,
+            timeout=5,
+            backoff_factor=0,
+            chunk_size=5,
+        )
+        with fetcher:
+            fetched = list(fetcher.fetch(mrnas))
+
+        self.assertEqual(feature_names, [mrna.feature_name for mrna in fetched])
+        self.assertEqual("ATGCACTGA", fetched[0].sequence)
+        # The 503 is retried
+        self.assertEqual("ATG" + "CAC" * 5 + "TGA", fetched[1].sequence)
+        self.assertEqual("", fetched[2].sequence)
+        self.assertEqual("ATG" + "CAC" * 19 + "TGA", fetched[-1].sequence)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -13,11 +13,8 @@ limitations under the License.
 """
 import argparse
 import configparser
-import sys
 from module.apollo_reporter import ApolloReporter
 
-sys.setrecursionlimit(2500)
-
 
 def main():
     parser = argparse.ArgumentParser(
@@ -36,21 +33,17 @@ def main():
 
     # Summary annotations
     if config["PIPELINE"]["summary_annotation"] == "yes":
-        gene_to_organism, master_gff = apollo_reporter.prepare_summary_gff()
-        emails = apollo_reporter.prepare_summary_emails(
-            master_gff, gene_to_organism, "summary"
-        )
-        error_emails = apollo_reporter.prepare_error_emails(
-            master_gff, gene_to_organism, "error"
-        )
+        organism_gffs = apollo_reporter.prepare_summary_gff()
+        summary_gff_object = apollo_reporter.read_gff(organism_gffs)
+        emails = apollo_reporter.prepare_summary_emails(summary_gff_object, "summary")
+        error_emails = apollo_reporter.prepare_error_emails(summary_gff_object, "error")
 
     # Recent annotations
     if config["PIPELINE"]["recent_annotation"] == "yes":
         recent_genes, recent_gff = apollo_reporter.prepare_recent_gff()
+        recent_gff_object = apollo_reporter.read_gff(recent_gff, recent_genes)
         # Write error emails
-        error_emails = apollo_reporter.prepare_error_emails(
-            recent_gff, recent_genes, "error"
-        )
+        error_emails = apollo_reporter.prepare_error_emails(recent_gff_object, "error")
 
 
 if __name__ == "__main__":
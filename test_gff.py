@@ -13,11 +13,9 @@ limitations under the License.
 """
 import argparse
 from pathlib import Path
-import sys
-from module import gff_file
+from module import gff_file, transcript
 from module import annotation_quality_report as report
-
-sys.setrecursionlimit(2500)
+from module.run_report import RunReport, StageProfiler, stage_names
 
 moderator_name = "moderator_name"
 
@@ -31,27 +29,57 @@ def main():
         type=str,
         help="Fasta with 1 CDS sequence that goes with the GFF, assuming it has a single CDS",
     )
+    parser.add_argument(
+        "--genome",
+        type=str,
+        help="Genome fasta of the GFF, to check the CDS of every transcript",
+    )
     parser.add_argument("--out_dir", type=str, required=True, help="Outdir")
     parser.add_argument("--type", choices=("summary", "error"), help="What do check")
+    parser.add_argument(
+        "--profile",
+        nargs="*",
+        choices=stage_names,
+        metavar="STAGE",
+        help="Profile the given stages, or all of them, to <out_dir>/profile",
+    )
 
     args = parser.parse_args()
     out_dir = Path(args.out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
+    run_report = RunReport()
+    if args.profile is not None:
+        run_report.profiler = StageProfiler(out_dir / "profile", args.profile)
 
     if args.type == "error":
         gff_file_object = gff_file.HandleGFF(args.gff, {}, moderator_name)
-        gff_file_object.read_gff_file()
-        gff_file_object.scan_gff_for_errors()
-        if args.fasta:
-            gff_file_object.scan_mrna_sequence(fasta_file=args.fasta)
+        with run_report.stage("parse"):
+            gff_file_object.read_gff_file()
+        with run_report.stage("structural_scan"):
+            gff_file_object.scan_gff_for_errors()
+        with run_report.stage("sequence_scan"):
+            if args.genome:
+                genome = transcript.GenomeSequences(default_genome=args.genome)
+                gff_file_object.scan_mrna_sequence(genome=genome)
+            elif args.fasta:
+                gff_file_object.scan_mrna_sequence(fasta_file=args.fasta)
 
-        report.write_email_texts(gff_file_object.errors, out_dir)
+        with run_report.stage("error_render"):
+            report.write_email_texts(gff_file_object.errors, out_dir)
 
     elif args.type == "summary":
         gff_file_object = gff_file.HandleGFF(args.gff, {}, moderator_name)
-        gff_file_object.read_gff_file()
-        for owner, annotator_object in gff_file_object.annotators.items():
-            report.write_summary_text(annotator_object, out_dir)
+        with run_report.stage("parse"):
+            gff_file_object.read_gff_file()
+        with run_report.stage("summary_render"):
+            for owner, annotator_object in gff_file_object.annotators.items():
+                report.write_summary_text(annotator_object, out_dir)
+
+    if run_report.profiler is not None:
+        print(run_report.format())
+        run_report.profiler.write()
+        print(run_report.profiler.format_summary())
+        print(f"Profiles written to {run_report.profiler.profile_dir}")
 
 
 if __name__ == "__main__":